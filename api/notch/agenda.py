@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import time
+from datetime import date, datetime, timedelta
+from typing import Any
+from zoneinfo import ZoneInfo
+
+from fastapi import HTTPException
+
+from . import recurrence
+from .archive import TODO_COLUMNS
+from .auth import Principal
+from .db import tx
+from .settings import settings
+from .shares import shared_ids_sql
+from .todos import _rows_to_todos
+
+# Agenda: open todos that are due or remind within a time window.
+#
+# Each visibility branch (created / assigned / shared) is a range query over a
+# partial (user, due_at) or (user, remind_at) index that only holds open todos
+# with that time set (migration 10), so the cost follows the size of the window,
+# not of the user's todo list. Recurring todos only store their next occurrence;
+# later occurrences inside the window are projected with recurrence.next_after.
+
+KINDS = ("due", "remind")
+MAX_DAYS = 31
+MAX_ENTRIES = 500
+MAX_OVERDUE = 100
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def range_sql(col: str) -> str:
+    """Open visible todos with `col` in [?, ?) (params: (user, lo, hi) x 3, limit)."""
+    if col not in ("due_at", "remind_at"):
+        raise ValueError(f"not an agenda column: {col}")
+    cond = f"done=0 AND deleted_at IS NULL AND {col} >= ? AND {col} < ?"
+    return (
+        f"SELECT {TODO_COLUMNS} FROM todos WHERE created_by=? AND {cond}"
+        f" UNION SELECT {TODO_COLUMNS} FROM todos WHERE assigned_to=? AND {cond}"
+        f" UNION SELECT {TODO_COLUMNS} FROM todos WHERE id IN ({shared_ids_sql('todo')}) AND {cond}"
+        f" ORDER BY {col} ASC LIMIT ?"
+    )
+
+
+def fetch_range(con, col: str, user_id: str, lo: int, hi: int, limit: int) -> list[dict[str, Any]]:
+    """Open todos visible to `user_id` with `col` in [lo, hi), earliest first."""
+    params = [user_id, lo, hi] * 3 + [limit]
+    return _rows_to_todos(con.execute(range_sql(col), params))
+
+
+def _occurrences(todo: dict[str, Any], kind: str, lo: int, hi: int) -> list[int]:
+    at = todo["due_at"] if kind == "due" else todo["remind_at"]
+    if at is None:
+        return []
+    out = [at] if lo <= at < hi else []
+    if not todo.get("recur") or todo.get("remind_at") is None:
+        return out
+    # due_at moves with remind_at, so both follow the reminder's occurrences.
+    offset = at - todo["remind_at"]
+    r = todo["remind_at"]
+    while len(out) < MAX_ENTRIES:
+        try:
+            r = recurrence.next_after(todo["recur"], r)
+        except ValueError:
+            break
+        if r is None or r + offset >= hi:
+            break
+        if r + offset >= lo:
+            out.append(r + offset)
+    return out
+
+
+def entries(user_id: str, lo: int, hi: int) -> tuple[list[dict[str, Any]], bool]:
+    """(entries sorted by time, truncated) for [lo, hi).
+
+    An entry is {"at", "kind": "due"|"remind", "todo"}; a recurring todo yields one
+    entry per occurrence in the window.
+    """
+    # Recurring todos hold their next occurrence, which may lie between now and
+    # a window starting later; fetch from there and filter below.
+    start = min(lo, now())
+    out: list[dict[str, Any]] = []
+    truncated = False
+    recurring: set[str] = set()
+    with tx() as con:
+        for kind in KINDS:
+            rows = fetch_range(con, f"{kind}_at", user_id, start, hi, MAX_ENTRIES + 1)
+            truncated = truncated or len(rows) > MAX_ENTRIES
+            for todo in rows[:MAX_ENTRIES]:
+                kinds: tuple[str, ...] = (kind,)
+                if todo.get("recur"):
+                    # Either fetch may be the only one to see a recurring todo
+                    # whose later occurrences fall in the window; expand both once.
+                    if todo["id"] in recurring:
+                        continue
+                    recurring.add(todo["id"])
+                    kinds = KINDS
+                for k in kinds:
+                    for at in _occurrences(todo, k, lo, hi):
+                        out.append({"at": at, "kind": k, "todo": todo})
+    out.sort(key=lambda e: (e["at"], e["kind"], e["todo"]["id"]))
+    if len(out) > MAX_ENTRIES:
+        out = out[:MAX_ENTRIES]
+        truncated = True
+    return out, truncated
+
+
+def _day_start(d: date, tz: ZoneInfo) -> int:
+    return int(datetime.combine(d, datetime.min.time(), tz).timestamp())
+
+
+def agenda(*, p: Principal, days: int = 7, start: str | None = None) -> dict[str, Any]:
+    """Entries for `days` local days from `start` (YYYY-MM-DD, default today), grouped by day."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not 1 <= int(days) <= MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"days must be 1..{MAX_DAYS}")
+    tz = ZoneInfo(settings.TZ)
+    t = now()
+    if start:
+        try:
+            first = date.fromisoformat(start)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="start must be YYYY-MM-DD")
+    else:
+        first = datetime.fromtimestamp(t, tz).date()
+    try:
+        lo = _day_start(first, tz)
+        hi = _day_start(first + timedelta(days=int(days)), tz)
+    except (OverflowError, ValueError, OSError):
+        raise HTTPException(status_code=400, detail="start is out of range")
+    uid = p.user["id"]
+
+    items, truncated = entries(uid, lo, hi)
+    by_day: dict[str, dict[str, Any]] = {}
+    for i in range(int(days)):
+        d = (first + timedelta(days=i)).isoformat()
+        by_day[d] = {"date": d, "count": 0, "due": 0, "remind": 0, "items": []}
+    for e in items:
+        day = by_day[datetime.fromtimestamp(e["at"], tz).date().isoformat()]
+        day["items"].append(e)
+        day["count"] += 1
+        day[e["kind"]] += 1
+
+    overdue: list[dict[str, Any]] = []
+    if lo <= t:
+        # Still open and due before the window.
+        with tx() as con:
+            rows = fetch_range(con, "due_at", uid, 0, lo, MAX_OVERDUE)
+        overdue = [{"at": r["due_at"], "kind": "due", "todo": r} for r in rows]
+    return {
+        "tz": settings.TZ,
+        "start": lo,
+        "end": hi,
+        "count": len(items),
+        "truncated": truncated,
+        "overdue": overdue,
+        "days": list(by_day.values()),
+    }
+
+
+def upcoming(*, p: Principal, hours: int = 24, limit: int = 50) -> dict[str, Any]:
+    """Entries from now through the next `hours` hours, soonest first."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not 1 <= int(hours) <= 24 * MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"hours must be 1..{24 * MAX_DAYS}")
+    limit = max(1, min(int(limit), MAX_ENTRIES))
+    t = now()
+    items, truncated = entries(p.user["id"], t, t + int(hours) * 3600)
+    return {"count": min(len(items), limit), "truncated": truncated or len(items) > limit, "items": items[:limit]}
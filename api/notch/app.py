@@ -1,25 +1,55 @@
 from __future__ import annotations
 
-import json
+import logging
 import time
 import uuid
 import secrets
 from pathlib import Path
 
-from fastapi import Depends, FastAPI, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import FileResponse, ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import MutableHeaders
 
 import asyncio
 
-from .auth import Principal, hash_password, issue_session, require_principal, verify_password
-from .db import tx
+from .auth import (
+    Principal,
+    hash_password_async,
+    invalidate_user_directory,
+    is_admin_user,
+    issue_session,
+    login_guard,
+    require_principal,
+    verify_password_async,
+)
+from . import auth
+from . import db
+from .db import request_stats, tx
+from .defaults import provision_defaults
 from .settings import settings
 from . import todos as todos_api
 from . import lists as lists_api
 from . import notes as notes_api
-from .scheduler import run_once
-
+from . import scheduler
+from .scheduler import run_once, wait as scheduler_wait
+from . import maintenance
+from . import retention
+from . import archive
+from . import backup
+from . import metrics
+from . import idempotency
+from . import profiler
+from . import transfer
+from . import agenda
+from . import ics
+from . import counts
+from . import note_shares
+
+log = logging.getLogger("notch.app")
+
+LOGIN_SQL = "SELECT id,handle,display_name,password_hash FROM users WHERE handle=?"
+USER_SQL = "SELECT id,handle,display_name FROM users WHERE id=?"
 
 def _html_escape(s: str) -> str:
     return (
@@ -36,29 +66,27 @@ def now() -> int:
     return int(time.time())
 
 
-def is_admin_user(user_id: str) -> bool:
-    # Admin = the first user ever created (bootstrap user). Simple and works for LAN MVP.
-    with tx() as con:
-        row = con.execute("SELECT id FROM users ORDER BY created_at ASC LIMIT 1").fetchone()
-        if not row:
-            return False
-        return row["id"] == user_id
-
-
 def init_db() -> None:
     from . import schema  # noqa
 
 
-app = FastAPI(title="notch", version="0.1.0")
+app = FastAPI(title="notch", version="0.1.0", default_response_class=ORJSONResponse)
 
 
 @app.on_event("startup")
 async def _startup():
-    # Initialize schema
-    from .schema import apply_schema
+    # Initialize schema (no-op when already at the latest version)
+    from .schema import apply_schema, pending_jobs, run_pending_jobs
 
     apply_schema()
 
+    # Warm the password-hashing pool so the first login doesn't pay for spawning it.
+    auth.start_hash_pool()
+
+    # Heavy migration work (backfills) runs in batches after boot.
+    if pending_jobs():
+        asyncio.create_task(run_pending_jobs())
+
     # Background scheduler loop (reminders -> ntfy)
     async def _loop():
         # tiny delay so app finishes booting
@@ -69,30 +97,145 @@ async def _startup():
             except Exception:
                 # best-effort; logs will show details via uvicorn
                 pass
-            await asyncio.sleep(max(0.25, float(settings.SCHEDULER_POLL_SECONDS)))
+            await scheduler_wait(max(0.25, float(settings.SCHEDULER_POLL_SECONDS)))
 
     if settings.SCHEDULER_ENABLED:
         asyncio.create_task(_loop())
 
+    # Background DB maintenance (checkpoint / optimize / vacuum when idle)
+    async def _maintenance_loop():
+        while True:
+            await asyncio.sleep(5.0)
+            # Each pass on its own, so one failing doesn't skip the others.
+            # Maintenance runs blocking PRAGMAs (checkpoint, optimize, VACUUM),
+            # so it goes to a thread like backups do.
+            for name, step in (
+                ("maintenance", lambda: asyncio.to_thread(maintenance.run_once)),
+                ("archive", archive.run_due),
+                ("retention", retention.run_due),
+                ("backup", backup.run_due),
+            ):
+                try:
+                    await step()
+                except Exception:
+                    log.exception("%s pass failed", name)
+
+    if (
+        settings.MAINTENANCE_ENABLED
+        or settings.RETENTION_ENABLED
+        or settings.ARCHIVE_ENABLED
+        or settings.BACKUP_ENABLED
+    ):
+        asyncio.create_task(_maintenance_loop())
+
+    if settings.LOOP_LAG_MONITOR_ENABLED:
+        asyncio.create_task(profiler.lag_monitor(), name="notch-lag-monitor")
+
+
+class _RequestMiddleware:
+    """Activity tracking, per-request metrics and SQL tracing in one pure ASGI layer.
+
+    (Stacked BaseHTTPMiddleware layers each add a task and a stream hop per request.)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # Health probes don't count as activity, or maintenance would never see idle.
+        if scope["path"] != "/health":
+            maintenance.mark_activity()
+
+        request_id = uuid.uuid4().hex[:16]
+        want = settings.SQL_TRACE_ALL or (b"x-notch-trace", b"1") in scope["headers"]
+        trace: list | None = [] if want else None
+        stats = {"connections": 0, "statements": 0, "seconds": 0.0}
+        stats_token = request_stats.set(stats)
+        trace_token = db.request_trace.set(trace)
+        status = 500
+
+        async def _send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("X-Request-Id", request_id)
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            request_stats.reset(stats_token)
+            db.request_trace.reset(trace_token)
+            elapsed = time.perf_counter() - t0
+            # Label by route template, not raw path, to keep cardinality bounded.
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            metrics.http_latency.observe(elapsed, method=method, route=route)
+            metrics.http_requests.inc(method=method, route=route, status=str(status))
+            metrics.db_connections_per_request.observe(stats["connections"], route=route)
+            metrics.db_statements_per_request.observe(stats["statements"], route=route)
+            metrics.db_seconds_per_request.observe(stats["seconds"], route=route)
+            if trace is not None:
+                db.store_trace(
+                    request_id,
+                    {
+                        "at": now(),
+                        "method": method,
+                        "path": scope["path"],
+                        "status": status,
+                        "ms": round(elapsed * 1000, 2),
+                        "sql_ms": round(sum(e["ms"] for e in trace), 2),
+                        "statements": trace,
+                    },
+                )
+
+
+app.add_middleware(_RequestMiddleware)
+
+
+@app.get("/metrics")
+async def metrics_endpoint(authorization: str | None = Header(default=None)):
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not found")
+    # Scrapers send METRICS_TOKEN; anyone else needs an admin session.
+    if not (settings.METRICS_TOKEN and authorization == f"Bearer {settings.METRICS_TOKEN}"):
+        p = require_principal(authorization)
+        if not is_admin_user(p.user["id"]):
+            raise HTTPException(status_code=403, detail="Admin required")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 
 @app.get("/health")
 async def health():
     return {"ok": True, "service": "notch"}
 
 
+def client_ip(request: Request) -> str:
+    if settings.TRUST_PROXY_HEADERS:
+        fwd = request.headers.get("x-forwarded-for")
+        if fwd:
+            return fwd.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
 @app.post("/api/auth/login")
-async def login(payload: dict):
+async def login(payload: dict, request: Request):
     handle = (payload.get("handle") or payload.get("username") or "").strip().lower()
     password = (payload.get("password") or "").strip()
     if not handle or not password:
         raise HTTPException(status_code=400, detail="Missing handle/password")
 
-    with tx() as con:
-        row = con.execute("SELECT id,handle,display_name,password_hash FROM users WHERE handle=?", (handle,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=401, detail="Invalid login")
-        if not verify_password(password, row["password_hash"]):
+    with login_guard(handle, client_ip(request)):
+        with tx() as con:
+            row = con.execute(LOGIN_SQL, (handle,)).fetchone()
+        if not row or not await verify_password_async(password, row["password_hash"]):
+            metrics.login_attempts.inc(result="invalid")
             raise HTTPException(status_code=401, detail="Invalid login")
+    metrics.login_attempts.inc(result="ok")
 
     token = issue_session(row["id"])
     return {
@@ -116,21 +259,53 @@ async def me(p: Principal = Depends(require_principal)):
     return {"ok": True, "user": u}
 
 
+def _notification_prefs(user_id: str) -> dict:
+    with tx() as con:
+        row = con.execute("SELECT digest_hour FROM users WHERE id=?", (user_id,)).fetchone()
+    return {
+        "daily_digest_hour": row["digest_hour"] if row else None,
+        "coalesce_seconds": int(settings.NOTIFY_COALESCE_SECONDS),
+    }
+
+
+@app.get("/api/me/notifications")
+async def my_notifications(p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="Not a user session")
+    return {"ok": True, "notifications": _notification_prefs(p.user["id"])}
+
+
+@app.patch("/api/me/notifications")
+async def patch_my_notifications(payload: dict, p: Principal = Depends(require_principal)):
+    """daily_digest_hour (0-23, in TZ) holds reminders for one push a day; null sends them as they come due."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="Not a user session")
+    if "daily_digest_hour" not in payload:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    hour = payload.get("daily_digest_hour")
+    if hour is not None and (not isinstance(hour, int) or isinstance(hour, bool) or not 0 <= hour <= 23):
+        raise HTTPException(status_code=400, detail="daily_digest_hour must be 0-23 or null")
+    uid = p.user["id"]
+    with tx() as con:
+        con.execute("UPDATE users SET digest_hour=? WHERE id=?", (hour, uid))
+        if hour is None:
+            # Release reminders held for the next digest.
+            con.execute(scheduler.RELEASE_DIGEST_SQL, (uid,))
+    return {"ok": True, "notifications": _notification_prefs(uid)}
+
+
 @app.get("/api/users")
 async def list_users(p: Principal = Depends(require_principal)):
     # allow service to map handles; allow users too.
-    with tx() as con:
-        rows = con.execute("SELECT id,handle,display_name,created_at FROM users ORDER BY handle").fetchall()
-    first_id = None
-    if rows:
-        first_id = sorted([dict(r) for r in rows], key=lambda x: int(x.get("created_at") or 0))[0]["id"]
-    users = []
-    for r in rows:
-        d = dict(r)
-        d.pop("created_at", None)
-        d["is_admin"] = (d.get("id") == first_id)
-        users.append(d)
-    return {"ok": True, "users": users}
+    return {"ok": True, "users": auth.list_users()}
+
+
+# --- Counts ---
+
+@app.get("/api/counts")
+async def get_counts(p: Principal = Depends(require_principal)):
+    """Open/done/Trash todos per list and live/Trash notes per group, for the sidebar."""
+    return {"ok": True, **counts.get_counts(p=p)}
 
 
 # --- Todo lists ---
@@ -142,15 +317,36 @@ async def list_lists(p: Principal = Depends(require_principal)):
 
 
 @app.post("/api/lists")
-async def create_list(payload: dict, p: Principal = Depends(require_principal)):
-    lst = lists_api.create_list(p=p, payload=payload)
-    return {"ok": True, "list": lst}
+async def create_list(
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "list": lists_api.create_list(p=p, payload=payload)},
+    )
 
 
 @app.patch("/api/lists/{list_id}")
-async def patch_list(list_id: str, payload: dict, p: Principal = Depends(require_principal)):
-    lst = lists_api.patch_list(p=p, list_id=list_id, payload=payload)
-    return {"ok": True, "list": lst}
+async def patch_list(
+    list_id: str,
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "list": lists_api.patch_list(p=p, list_id=list_id, payload=payload)},
+    )
 
 
 @app.delete("/api/lists/{list_id}")
@@ -158,12 +354,83 @@ async def delete_list(list_id: str, p: Principal = Depends(require_principal)):
     return lists_api.delete_list(p=p, list_id=list_id)
 
 
+# --- Export / import ---
+
+@app.get("/api/export")
+async def export_data(p: Principal = Depends(require_principal)):
+    chunks = transfer.export_ndjson(p=p)
+    filename = f"notch-{p.user['handle']}-{time.strftime('%Y%m%d')}.ndjson"
+    return StreamingResponse(
+        chunks,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.post("/api/import")
+async def import_data(request: Request, p: Principal = Depends(require_principal)):
+    result = await transfer.import_ndjson(p=p, chunks=request.stream())
+    return {"ok": True, **result}
+
+
 # --- Todos ---
 
 @app.post("/api/todos")
-async def create_todo(payload: dict, p: Principal = Depends(require_principal)):
-    todo = todos_api.create_todo(p=p, payload=payload)
-    return {"ok": True, "todo": todo}
+async def create_todo(
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "todo": todos_api.create_todo(p=p, payload=payload)},
+    )
+
+
+@app.post("/api/todos/bulk")
+async def create_todos(
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    def create():
+        todos = todos_api.create_todos(p=p, payload=payload)
+        return {"ok": True, "count": len(todos), "todos": todos}
+
+    return idempotency.run(p, idempotency_key, request, payload, create)
+
+
+# --- Agenda / calendar ---
+
+@app.get("/api/agenda")
+async def get_agenda(days: int = 7, start: str | None = None, p: Principal = Depends(require_principal)):
+    return {"ok": True, **agenda.agenda(p=p, days=days, start=start)}
+
+
+@app.get("/api/agenda/upcoming")
+async def get_upcoming(hours: int = 24, limit: int = 50, p: Principal = Depends(require_principal)):
+    return {"ok": True, **agenda.upcoming(p=p, hours=hours, limit=limit)}
+
+
+@app.get("/api/me/calendar")
+async def my_calendar(p: Principal = Depends(require_principal)):
+    return {"ok": True, **ics.calendar_url(p=p)}
+
+
+@app.post("/api/me/calendar")
+async def rotate_my_calendar(p: Principal = Depends(require_principal)):
+    """Create (or replace) the secret ICS feed URL."""
+    return {"ok": True, **ics.rotate_token(p=p)}
+
+
+@app.delete("/api/me/calendar")
+async def revoke_my_calendar(p: Principal = Depends(require_principal)):
+    return {"ok": True, **ics.revoke_token(p=p)}
 
 
 # --- Note groups / Notes ---
@@ -175,15 +442,36 @@ async def list_note_groups(p: Principal = Depends(require_principal)):
 
 
 @app.post("/api/note-groups")
-async def create_note_group(payload: dict, p: Principal = Depends(require_principal)):
-    group = notes_api.create_group(p=p, payload=payload)
-    return {"ok": True, "group": group}
+async def create_note_group(
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "group": notes_api.create_group(p=p, payload=payload)},
+    )
 
 
 @app.patch("/api/note-groups/{group_id}")
-async def patch_note_group(group_id: str, payload: dict, p: Principal = Depends(require_principal)):
-    group = notes_api.patch_group(p=p, group_id=group_id, payload=payload)
-    return {"ok": True, "group": group}
+async def patch_note_group(
+    group_id: str,
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "group": notes_api.patch_group(p=p, group_id=group_id, payload=payload)},
+    )
 
 
 @app.get("/api/notes")
@@ -207,9 +495,19 @@ async def list_notes(
 
 
 @app.post("/api/notes")
-async def create_note(payload: dict, p: Principal = Depends(require_principal)):
-    note = notes_api.create_note(p=p, payload=payload)
-    return {"ok": True, "note": note}
+async def create_note(
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "note": notes_api.create_note(p=p, payload=payload)},
+    )
 
 
 @app.get("/api/notes/{note_id}")
@@ -219,9 +517,20 @@ async def get_note(note_id: str, p: Principal = Depends(require_principal)):
 
 
 @app.patch("/api/notes/{note_id}")
-async def patch_note(note_id: str, payload: dict, p: Principal = Depends(require_principal)):
-    note = notes_api.patch_note(p=p, note_id=note_id, payload=payload)
-    return {"ok": True, "note": note}
+async def patch_note(
+    note_id: str,
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "note": notes_api.patch_note(p=p, note_id=note_id, payload=payload)},
+    )
 
 
 @app.delete("/api/notes/{note_id}")
@@ -236,7 +545,17 @@ async def restore_note(note_id: str, p: Principal = Depends(require_principal)):
 
 
 @app.post("/api/notes/{note_id}/share")
-async def create_note_share(note_id: str, payload: dict, p: Principal = Depends(require_principal)):
+async def create_note_share(
+    note_id: str,
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(p, idempotency_key, request, payload, lambda: _create_note_share(p, note_id, payload))
+
+
+def _create_note_share(p: Principal, note_id: str, payload: dict) -> dict:
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
     # You must be able to see the note to share it.
@@ -274,6 +593,7 @@ async def list_todos(
     list_id: str | None = None,
     include_deleted: int = 0,
     deleted_only: int = 0,
+    digest: str | None = None,
     limit: int = 200,
     p: Principal = Depends(require_principal),
 ):
@@ -284,6 +604,7 @@ async def list_todos(
         list_id=list_id,
         include_deleted=bool(include_deleted),
         deleted_only=bool(deleted_only),
+        digest_id=digest,
         limit=limit,
     )
     return {"ok": True, "todos": todos}
@@ -296,9 +617,20 @@ async def get_todo(todo_id: str, p: Principal = Depends(require_principal)):
 
 
 @app.patch("/api/todos/{todo_id}")
-async def patch_todo(todo_id: str, payload: dict, p: Principal = Depends(require_principal)):
-    todo = todos_api.patch_todo(p=p, todo_id=todo_id, payload=payload)
-    return {"ok": True, "todo": todo}
+async def patch_todo(
+    todo_id: str,
+    payload: dict,
+    request: Request,
+    p: Principal = Depends(require_principal),
+    idempotency_key: str | None = Header(default=None),
+):
+    return idempotency.run(
+        p,
+        idempotency_key,
+        request,
+        payload,
+        lambda: {"ok": True, "todo": todos_api.patch_todo(p=p, todo_id=todo_id, payload=payload)},
+    )
 
 
 @app.delete("/api/todos/{todo_id}")
@@ -331,6 +663,7 @@ async def admin_create_user(payload: dict, p: Principal = Depends(require_princi
         raise HTTPException(status_code=400, detail="Missing handle/password")
 
     uid = str(uuid.uuid4())
+    password_hash = await hash_password_async(password)
     t = now()
     with tx() as con:
         exists = con.execute("SELECT 1 FROM users WHERE handle=?", (handle,)).fetchone()
@@ -338,13 +671,125 @@ async def admin_create_user(payload: dict, p: Principal = Depends(require_princi
             raise HTTPException(status_code=409, detail="Handle already exists")
         con.execute(
             "INSERT INTO users(id,handle,display_name,password_hash,created_at,updated_at) VALUES(?,?,?,?,?,?)",
-            (uid, handle, display_name, hash_password(password), t, t),
+            (uid, handle, display_name, password_hash, t, t),
         )
-        row = con.execute("SELECT id,handle,display_name FROM users WHERE id=?", (uid,)).fetchone()
+        provision_defaults(con, uid)
+        row = con.execute(USER_SQL, (uid,)).fetchone()
+    invalidate_user_directory()
 
     return {"ok": True, "user": dict(row)}
 
 
+@app.get("/api/admin/maintenance")
+async def admin_maintenance(p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    return {
+        "ok": True,
+        "maintenance": maintenance.stats(),
+        "retention": retention.stats(),
+        "archive": archive.stats(),
+        "backup": backup.stats(),
+        "event_loop": profiler.lag_stats(),
+    }
+
+
+@app.get("/api/admin/sql-trace")
+async def admin_sql_traces(p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    return {"ok": True, "traces": db.recent_traces(), "slow": db.recent_slow()}
+
+
+@app.get("/api/admin/sql-trace/{request_id}")
+async def admin_sql_trace(request_id: str, p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    trace = db.get_trace(request_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"ok": True, "request_id": request_id, "trace": trace}
+
+
+@app.get("/api/admin/profile")
+async def admin_profile(
+    seconds: float = 10.0,
+    interval_ms: float = 5.0,
+    format: str = "json",
+    p: Principal = Depends(require_principal),
+):
+    """Sample all threads and asyncio tasks of the live process.
+
+    format=collapsed returns "stack count" lines for flamegraph.pl / speedscope.
+    """
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    try:
+        result = await profiler.profile(seconds, interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "collapsed":
+        return PlainTextResponse(result["collapsed"])
+    return {"ok": True, **result}
+
+
+@app.post("/api/admin/retention/run")
+async def admin_run_retention(p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    deleted = await retention.run_once()
+    return {"ok": True, "deleted": deleted, "rows": retention.table_counts()}
+
+
+@app.get("/api/admin/backups")
+async def admin_list_backups(p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    return {"ok": True, "backups": backup.list_backups(), "status": backup.stats()}
+
+
+@app.post("/api/admin/backups")
+async def admin_start_backup(p: Principal = Depends(require_principal)):
+    """Start a snapshot in the background; poll GET /api/admin/backups for progress."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    try:
+        backup.start("admin")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"ok": True, "started": True}
+
+
+@app.post("/api/admin/backups/{name}/verify")
+async def admin_verify_backup(name: str, p: Principal = Depends(require_principal)):
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    if not is_admin_user(p.user["id"]):
+        raise HTTPException(status_code=403, detail="Admin required")
+    path = backup.snapshot_path(name)
+    if path.parent != backup.backup_dir() or not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        result = await asyncio.to_thread(backup.verify, path)
+    except RuntimeError as e:
+        return {"ok": False, "name": name, "error": str(e)}
+    return {"ok": True, "name": name, **result}
+
+
 @app.post("/api/admin/bootstrap")
 async def bootstrap_admin(payload: dict):
     """One-time bootstrap: create first user if none exist.
@@ -357,6 +802,11 @@ async def bootstrap_admin(payload: dict):
     if not handle or not password:
         raise HTTPException(status_code=400, detail="Missing handle/password")
 
+    # Cheap check first: this endpoint is unauthenticated, so don't hash for nothing.
+    with tx() as con:
+        if con.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            raise HTTPException(status_code=409, detail="Already bootstrapped")
+    password_hash = await hash_password_async(password)
     with tx() as con:
         n = con.execute("SELECT COUNT(*) AS n FROM users").fetchone()["n"]
         if n and int(n) > 0:
@@ -365,12 +815,19 @@ async def bootstrap_admin(payload: dict):
         t = now()
         con.execute(
             "INSERT INTO users(id,handle,display_name,password_hash,created_at,updated_at) VALUES(?,?,?,?,?,?)",
-            (uid, handle, display_name, hash_password(password), t, t),
+            (uid, handle, display_name, password_hash, t, t),
         )
+        provision_defaults(con, uid)
+    invalidate_user_directory()
 
     return {"ok": True, "note": "Bootstrapped"}
 
 
+@app.on_event("shutdown")
+async def _shutdown():
+    auth.stop_hash_pool()
+
+
 # --- SPA/static ---
 
 # In production we serve built assets from api/static.
@@ -380,147 +837,42 @@ if static_dir.exists():
 
 
 @app.get("/share/n/{token}")
-async def public_note_share_page(token: str):
-    # Minimal public editor/viewer (no auth). Fetches note via public API.
-    # Keeps it simple for LAN MVP.
-    token_json = json.dumps(token)
-    html = """<!doctype html>
-<html lang=\"en\">
-<head>
-  <meta charset=\"utf-8\" />
-  <meta name=\"viewport\" content=\"width=device-width, initial-scale=1\" />
-  <title>Notch Share</title>
-  <style>
-    body { margin:0; font-family: system-ui, -apple-system, sans-serif; background:#0b0f14; color:#e6edf3; }
-    .wrap { max-width: 900px; margin: 0 auto; padding: 16px; }
-    .card { border: 1px solid #243041; border-radius: 12px; background:#111826; padding: 12px; }
-    input, textarea { width: 100%; box-sizing: border-box; padding: 10px; border-radius: 10px; border: 1px solid #243041; background:#111826; color:#e6edf3; font: inherit; }
-    textarea { min-height: 320px; resize: vertical; }
-    .row { display:flex; gap:10px; align-items:center; justify-content:space-between; flex-wrap: wrap; }
-    .muted { color:#9aa4af; font-size: 12px; }
-    .pill { border: 1px solid #243041; border-radius: 999px; padding: 2px 8px; font-size: 12px; color:#9aa4af; }
-  </style>
-</head>
-<body>
-  <div class=\"wrap\">
-    <div class=\"row\" style=\"margin-bottom:10px;\">
-      <h2 style=\"margin:0;\">Notch</h2>
-      <span class=\"pill\">Shared note</span>
-    </div>
-    <div class=\"card\">
-      <div class=\"row\">
-        <div class=\"muted\" id=\"status\">Loading…</div>
-      </div>
-      <div style=\"margin-top:10px;\">
-        <input id=\"title\" placeholder=\"Title\" />
-      </div>
-      <div style=\"margin-top:10px;\">
-        <textarea id=\"body\" placeholder=\"Markdown…\"></textarea>
-      </div>
-      <div class=\"muted\" style=\"margin-top:10px;\">Autosaves when you stop typing.</div>
-    </div>
-  </div>
-
-<script>
-const token = __TOKEN__;
-let version = null;
-let canEdit = true;
-let timer = null;
-
-const statusEl = document.getElementById('status');
-const titleEl = document.getElementById('title');
-const bodyEl = document.getElementById('body');
-
-function setStatus(t){ statusEl.textContent = t; }
-
-async function load(){
-  setStatus('Loading…');
-  const res = await fetch(`/api/public/notes/${encodeURIComponent(token)}`);
-  const j = await res.json();
-  if (!res.ok) throw new Error(j?.detail || 'Failed');
-  titleEl.value = j.note.title || '';
-  bodyEl.value = j.note.body_md || '';
-  version = j.note.version;
-  canEdit = !!j.can_edit;
-  titleEl.disabled = !canEdit;
-  bodyEl.disabled = !canEdit;
-  setStatus(canEdit ? 'Editable link' : 'View-only link');
-}
-
-async function save(){
-  if (!canEdit) return;
-  setStatus('Saving…');
-  const res = await fetch(`/api/public/notes/${encodeURIComponent(token)}` , {
-    method: 'PATCH',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ title: titleEl.value, body_md: bodyEl.value, if_version: version })
-  });
-  const j = await res.json();
-  if (!res.ok) {
-    setStatus(j?.detail || 'Save failed');
-    // best-effort reload
-    try { await load(); } catch {}
-    return;
-  }
-  version = j.note.version;
-  setStatus('Saved');
-}
-
-function dirty(){
-  if (!canEdit) return;
-  setStatus('Unsaved');
-  if (timer) clearTimeout(timer);
-  timer = setTimeout(() => { timer=null; save(); }, 650);
-}
-
-titleEl.addEventListener('input', dirty);
-bodyEl.addEventListener('input', dirty);
-
-load().catch(e => { setStatus(String(e?.message || e)); });
-</script>
-</body>
-</html>""".replace("__TOKEN__", token_json)
-
-    return HTMLResponse(content=html)
+async def public_note_share_page(token: str, if_none_match: str | None = Header(default=None)):
+    # Minimal public editor/viewer (no auth). The page is the same for every
+    # token (it reads it from the URL) and fetches the note via the public API.
+    headers = {
+        "ETag": note_shares.SHARE_PAGE_ETAG,
+        "Cache-Control": f"public, max-age={note_shares.PAGE_MAX_AGE}",
+        "Referrer-Policy": "no-referrer",
+    }
+    if if_none_match and note_shares.SHARE_PAGE_ETAG in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=note_shares.SHARE_PAGE_BYTES, media_type="text/html; charset=utf-8", headers=headers)
 
 
 @app.get("/api/public/notes/{token}")
-async def public_get_note(token: str):
-    with tx() as con:
-        row = con.execute("SELECT * FROM note_shares WHERE token=?", (token,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        share = dict(row)
-        if share.get("expires_at") is not None and int(share.get("expires_at") or 0) <= now():
-            raise HTTPException(status_code=410, detail="Link expired")
-        nrow = con.execute("SELECT id,title,body_md,version,updated_at,deleted_at FROM notes WHERE id=?", (share["note_id"],)).fetchone()
-        if not nrow:
-            raise HTTPException(status_code=404, detail="Not found")
-        note = dict(nrow)
-        if note.get("deleted_at") is not None:
-            raise HTTPException(status_code=404, detail="Not found")
-        note.pop("deleted_at", None)
-
-    return {"ok": True, "note": note, "can_edit": bool(int(share.get("can_edit") or 0)), "expires_at": share.get("expires_at")}
+async def public_get_note(token: str, request: Request):
+    note_shares.guard(token, client_ip(request), "read")
+    share, note = note_shares.get_note(token)
+    return {"ok": True, "note": note, "can_edit": share["can_edit"], "expires_at": share["expires_at"]}
 
 
 @app.patch("/api/public/notes/{token}")
-async def public_patch_note(token: str, payload: dict):
-    with tx() as con:
-        row = con.execute("SELECT * FROM note_shares WHERE token=?", (token,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        share = dict(row)
-        if share.get("expires_at") is not None and int(share.get("expires_at") or 0) <= now():
-            raise HTTPException(status_code=410, detail="Link expired")
-        if not bool(int(share.get("can_edit") or 0)):
-            raise HTTPException(status_code=403, detail="Read-only link")
-
-    # Reuse the normal patch logic, but bypass auth with a synthetic principal.
-    # Principal.user only needs id for version check logic.
-    p = Principal(kind="user", user={"id": share["created_by"], "handle": "public", "display_name": "Public"})
-    note = notes_api.patch_note(p=p, note_id=str(share["note_id"]), payload=payload)
-    return {"ok": True, "note": note}
+async def public_patch_note(token: str, payload: dict, request: Request):
+    note_shares.guard(token, client_ip(request), "save")
+    return {"ok": True, "note": await note_shares.save(token, payload)}
+
+
+@app.get("/api/public/calendar/{token}.ics")
+async def public_calendar(token: str, if_none_match: str | None = Header(default=None)):
+    uid = ics.user_for_token(token)
+    if uid is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    f = ics.feed(uid)
+    headers = {"ETag": f["etag"], "Cache-Control": "private, max-age=300"}
+    if if_none_match and f["etag"] in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=f["body"], media_type="text/calendar; charset=utf-8", headers=headers)
 
 
 @app.get("/app/{path:path}")
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import time
+from typing import Any
+
+from .db import tx
+from .settings import settings
+
+# Hot/cold split for todos and notes.
+#
+# Todos completed more than ARCHIVE_DONE_DAYS ago and Trash older than
+# ARCHIVE_TRASH_DAYS are moved into todos_archive / notes_archive, so the
+# default views (open, not deleted) only touch the working set.
+#
+# Archived rows keep their ids and item_shares entries. list_* queries union in
+# the archive when include_done / include_deleted / deleted_only ask for it,
+# get_* falls back to the archive, and every write path calls unarchive() first,
+# so restore/patch/purge work unchanged.
+#
+# Archiving deletes the hot row, which would cascade its note_shares rows
+# away, so trashed notes that still have share links stay in the hot table:
+# restoring them from Trash brings their links back.
+
+# Explicit column lists: legacy DBs have ALTER-added columns in a different order.
+TODO_COLUMNS = (
+    "id,list_id,title,notes,done,due_at,remind_at,remind_sent_at,assigned_to,"
+    "shared_with,created_by,created_at,updated_at,deleted_at,version,recur"
+)
+NOTE_COLUMNS = "id,group_id,title,body_md,shared_with,created_by,created_at,updated_at,deleted_at,version"
+
+_TABLES = {"todos": ("todos_archive", TODO_COLUMNS), "notes": ("notes_archive", NOTE_COLUMNS)}
+
+_next_run = 0.0
+_last_report: dict[str, Any] | None = None
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def move_queries(src: str, dst: str, cols: str, n: int, stamp: bool) -> list[str]:
+    """(copy into dst, delete from src) for `n` ids; `stamp` adds archived_at as the first param."""
+    marks = ",".join("?" for _ in range(n))
+    if stamp:
+        copy = f"INSERT OR REPLACE INTO {dst}({cols},archived_at) SELECT {cols},? FROM {src} WHERE id IN ({marks})"
+    else:
+        copy = f"INSERT OR REPLACE INTO {dst}({cols}) SELECT {cols} FROM {src} WHERE id IN ({marks})"
+    return [copy, f"DELETE FROM {src} WHERE id IN ({marks})"]
+
+
+def archived_sql(table: str, columns: str | None = None) -> str:
+    """Read one archived row of `table` by id (`columns` defaults to the full list)."""
+    archive_table, cols = _TABLES[table]
+    return f"SELECT {columns or cols} FROM {archive_table} WHERE id=?"
+
+
+def candidates_sql(table: str, where: str) -> str:
+    """Ids of `table` matching a policy WHERE (params: cutoff, batch size)."""
+    return f"SELECT id FROM {table} WHERE {where} LIMIT ?"
+
+
+def _move(con: sqlite3.Connection, src: str, dst: str, cols: str, ids: list[str], archived_at: int | None) -> None:
+    copy, delete = move_queries(src, dst, cols, len(ids), archived_at is not None)
+    con.execute(copy, ids if archived_at is None else [archived_at, *ids])
+    con.execute(delete, ids)
+
+
+def unarchive(con: sqlite3.Connection, table: str, item_id: str) -> bool:
+    """Move one row back into the hot table if it is archived. Returns True if moved."""
+    archive_table, cols = _TABLES[table]
+    if not con.execute(archived_sql(table, "1"), (str(item_id),)).fetchone():
+        return False
+    _move(con, archive_table, table, cols, [str(item_id)], None)
+    return True
+
+
+def get_archived(con: sqlite3.Connection, table: str, item_id: str) -> sqlite3.Row | None:
+    return con.execute(archived_sql(table), (str(item_id),)).fetchone()
+
+
+def _archive_batch(table: str, where: str, cutoff: int, batch: int) -> int:
+    archive_table, cols = _TABLES[table]
+    with tx() as con:
+        rows = con.execute(candidates_sql(table, where), (cutoff, batch)).fetchall()
+        ids = [r["id"] for r in rows]
+        if ids:
+            _move(con, table, archive_table, cols, ids, now())
+    return len(ids)
+
+
+def _policies() -> list[tuple[str, str, str, int | None]]:
+    """(name, table, WHERE with one cutoff param, days or None when disabled)."""
+    done_days = int(settings.ARCHIVE_DONE_DAYS) or None
+    trash_days = int(settings.ARCHIVE_TRASH_DAYS) or None
+    return [
+        ("todos_done", "todos", "done=1 AND deleted_at IS NULL AND updated_at <= ?", done_days),
+        ("todos_trash", "todos", "deleted_at IS NOT NULL AND deleted_at <= ?", trash_days),
+        (
+            "notes_trash",
+            "notes",
+            "deleted_at IS NOT NULL AND deleted_at <= ?"
+            " AND NOT EXISTS (SELECT 1 FROM note_shares WHERE note_shares.note_id=notes.id)",
+            trash_days,
+        ),
+    ]
+
+
+async def run_once(pause: float = 0.01) -> dict[str, int]:
+    """Archive everything that is due. Returns moved row counts per policy."""
+    global _last_report
+    t0 = time.perf_counter()
+    batch = max(1, int(settings.ARCHIVE_BATCH_SIZE))
+    moved: dict[str, int] = {}
+    for name, table, where, days in _policies():
+        moved[name] = 0
+        if days is None:
+            continue
+        cutoff = now() - days * 86400
+        while True:
+            n = _archive_batch(table, where, cutoff, batch)
+            moved[name] += n
+            if n < batch:
+                break
+            await asyncio.sleep(pause)
+    _last_report = {
+        "at": now(),
+        "duration_ms": round((time.perf_counter() - t0) * 1000, 2),
+        "moved": moved,
+    }
+    return moved
+
+
+async def run_due() -> bool:
+    global _next_run
+    if not settings.ARCHIVE_ENABLED:
+        return False
+    t = time.monotonic()
+    if t < _next_run:
+        return False
+    _next_run = t + float(settings.ARCHIVE_INTERVAL_SECONDS)
+    await run_once()
+    return True
+
+
+def stats() -> dict[str, Any]:
+    with tx() as con:
+        rows = {
+            "todos": con.execute("SELECT COUNT(*) FROM todos").fetchone()[0],
+            "todos_archive": con.execute("SELECT COUNT(*) FROM todos_archive").fetchone()[0],
+            "notes": con.execute("SELECT COUNT(*) FROM notes").fetchone()[0],
+            "notes_archive": con.execute("SELECT COUNT(*) FROM notes_archive").fetchone()[0],
+        }
+    return {
+        "enabled": settings.ARCHIVE_ENABLED,
+        "policies": {name: days for name, _, _, days in _policies()},
+        "last_run": _last_report,
+        "rows": rows,
+    }
@@ -1,14 +1,23 @@
 from __future__ import annotations
 
+import asyncio
+import multiprocessing
 import secrets
+import threading
 import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import Any, Callable, Iterator
 
 from fastapi import Header, HTTPException
 from passlib.context import CryptContext
 
 from .db import tx
+from .metrics import login_attempts, operation_latency
+from .ratelimit import ConcurrencyLimit, TokenBucket
 from .settings import settings
 
 # Use PBKDF2 (pure python) to avoid bcrypt backend/version issues inside slim containers.
@@ -27,6 +36,195 @@ def verify_password(p: str, h: str) -> bool:
     return pwd.verify(p, h)
 
 
+# PBKDF2 is deliberately CPU-heavy, so request handlers never run it on the
+# event loop: the *_async variants send it to a small process pool (threads
+# would still contend for the GIL on passlib's pure-Python fallback). The
+# number of queued hashes is capped, and login attempts are rate limited per
+# handle and per client IP before any hashing happens.
+
+_hash_pool: ProcessPoolExecutor | None = None
+_hash_inflight = 0
+
+
+def start_hash_pool() -> None:
+    global _hash_pool
+    if _hash_pool is None and settings.AUTH_HASH_WORKERS > 0:
+        # spawn, not fork: the parent has SQLite connections and helper threads.
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=int(settings.AUTH_HASH_WORKERS), mp_context=multiprocessing.get_context("spawn")
+        )
+
+
+def stop_hash_pool() -> None:
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=False, cancel_futures=True)
+        _hash_pool = None
+
+
+async def _offload(fn: Callable[..., Any], *args: Any) -> Any:
+    global _hash_inflight, _hash_pool
+    if _hash_inflight >= max(1, int(settings.AUTH_HASH_QUEUE)):
+        raise HTTPException(status_code=503, detail="Too many logins in progress", headers={"Retry-After": "1"})
+    _hash_inflight += 1
+    try:
+        start_hash_pool()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(_hash_pool, fn, *args)
+        except BrokenProcessPool:
+            # A worker died (OOM kill etc.); start a fresh pool and retry once.
+            _hash_pool = None
+            start_hash_pool()
+            return await loop.run_in_executor(_hash_pool, fn, *args)
+    finally:
+        _hash_inflight -= 1
+
+
+async def hash_password_async(p: str) -> str:
+    with operation_latency.time(op="hash_password"):
+        return await _offload(hash_password, p)
+
+
+async def verify_password_async(p: str, h: str) -> bool:
+    with operation_latency.time(op="verify_password"):
+        return await _offload(verify_password, p, h)
+
+
+_login_limits: tuple[TokenBucket, TokenBucket, ConcurrencyLimit] | None = None
+
+
+def _limits() -> tuple[TokenBucket, TokenBucket, ConcurrencyLimit]:
+    global _login_limits
+    if _login_limits is None:
+        _login_limits = (
+            TokenBucket(settings.LOGIN_HANDLE_BURST, settings.LOGIN_HANDLE_PER_MINUTE),
+            TokenBucket(settings.LOGIN_IP_BURST, settings.LOGIN_IP_PER_MINUTE),
+            ConcurrencyLimit(settings.LOGIN_IP_CONCURRENCY),
+        )
+    return _login_limits
+
+
+@contextmanager
+def login_guard(handle: str, ip: str) -> Iterator[None]:
+    """Rate and concurrency limits for one login attempt; raises 429 when exceeded.
+
+    The strict per-handle bucket is keyed on (handle, ip), so spamming someone
+    else's handle only locks out the spammer's own address.
+    """
+    by_handle, by_ip, ip_slots = _limits()
+    wait = max(by_ip.take(ip), by_handle.take(f"{ip} {handle}"))
+    if wait > 0:
+        login_attempts.inc(result="rate_limited")
+        raise HTTPException(
+            status_code=429, detail="Too many login attempts", headers={"Retry-After": str(int(wait) + 1)}
+        )
+    if not ip_slots.acquire(ip):
+        login_attempts.inc(result="rate_limited")
+        raise HTTPException(status_code=429, detail="Too many concurrent logins", headers={"Retry-After": "1"})
+    try:
+        yield
+    finally:
+        ip_slots.release(ip)
+
+
+# User directory: id/handle maps and the admin id, loaded once and dropped by
+# invalidate_user_directory() whenever a user is created. Users are never
+# renamed or deleted, so creation is the only invalidation point; a lookup that
+# misses reloads (at most every few seconds) in case a user was inserted
+# outside the app.
+
+_directory: dict[str, Any] | None = None
+_directory_loaded_at = 0.0
+_directory_lock = threading.Lock()
+_MISS_RELOAD_SECONDS = 5.0
+
+
+DIRECTORY_SQL = "SELECT id,handle,display_name,inbox_list_id,general_group_id FROM users ORDER BY created_at ASC, rowid ASC"
+SESSION_USER_SQL = (
+    "SELECT u.id,u.handle,u.display_name FROM sessions s JOIN users u ON u.id=s.user_id"
+    " WHERE s.token=? AND (s.expires_at IS NULL OR s.expires_at>?)"
+)
+SESSION_TOUCH_SQL = "UPDATE sessions SET last_seen_at=? WHERE token=?"
+
+
+def _load_directory() -> dict[str, Any]:
+    with tx() as con:
+        # rowid breaks created_at ties (same-second inserts) in insertion order.
+        rows = con.execute(DIRECTORY_SQL).fetchall()
+    users = [{"id": r["id"], "handle": r["handle"], "display_name": r["display_name"]} for r in rows]
+    return {
+        "by_id": {u["id"]: u for u in users},
+        "by_handle": {u["handle"]: u for u in users},
+        "admin_id": users[0]["id"] if users else None,
+        "sorted": sorted(users, key=lambda u: u["handle"]),
+        # Default Inbox list / General group ids (see lists.default_list_id).
+        "defaults": {
+            r["id"]: {"inbox_list_id": r["inbox_list_id"], "general_group_id": r["general_group_id"]} for r in rows
+        },
+    }
+
+
+def user_directory(reload: bool = False) -> dict[str, Any]:
+    global _directory, _directory_loaded_at
+    d = _directory
+    if d is None or reload:
+        with _directory_lock:
+            if _directory is None or (reload and time.monotonic() - _directory_loaded_at >= _MISS_RELOAD_SECONDS):
+                _directory = _load_directory()
+                _directory_loaded_at = time.monotonic()
+            d = _directory
+    return d
+
+
+def invalidate_user_directory() -> None:
+    global _directory
+    with _directory_lock:
+        _directory = None
+
+
+def _lookup(key: str, value: str) -> dict | None:
+    u = user_directory()[key].get(value)
+    if u is None:
+        u = user_directory(reload=True)[key].get(value)
+    return dict(u) if u else None
+
+
+def user_by_id(user_id: str) -> dict | None:
+    return _lookup("by_id", user_id)
+
+
+def user_by_handle(handle: str) -> dict | None:
+    return _lookup("by_handle", handle)
+
+
+def admin_user_id() -> str | None:
+    d = user_directory()
+    return d["admin_id"] if d["admin_id"] else user_directory(reload=True)["admin_id"]
+
+
+def is_admin_user(user_id: str) -> bool:
+    # Admin = the first user ever created (bootstrap user). Simple and works for LAN MVP.
+    return bool(user_id) and user_id == admin_user_id()
+
+
+def default_containers(user_id: str) -> dict[str, str | None]:
+    return dict(user_directory()["defaults"].get(user_id) or {})
+
+
+def remember_default_container(user_id: str, key: str, value: str) -> None:
+    """Record a lazily provisioned default container id in the cached directory."""
+    with _directory_lock:
+        if _directory is not None:
+            _directory["defaults"].setdefault(user_id, {})[key] = value
+
+
+def list_users() -> list[dict]:
+    """All users sorted by handle, with is_admin."""
+    d = user_directory()
+    return [{**u, "is_admin": u["id"] == d["admin_id"]} for u in d["sorted"]]
+
+
 def issue_session(user_id: str) -> str:
     token = secrets.token_urlsafe(32)
     exp = now() + settings.SESSION_DAYS * 86400
@@ -40,13 +238,10 @@ def issue_session(user_id: str) -> str:
 
 def get_user_by_session(token: str) -> dict:
     with tx() as con:
-        row = con.execute(
-            "SELECT u.id,u.handle,u.display_name FROM sessions s JOIN users u ON u.id=s.user_id WHERE s.token=? AND (s.expires_at IS NULL OR s.expires_at>?)",
-            (token, now()),
-        ).fetchone()
+        row = con.execute(SESSION_USER_SQL, (token, now())).fetchone()
         if not row:
             raise HTTPException(status_code=401, detail="Invalid session")
-        con.execute("UPDATE sessions SET last_seen_at=? WHERE token=?", (now(), token))
+        con.execute(SESSION_TOUCH_SQL, (now(), token))
         return dict(row)
 
 
@@ -54,9 +249,15 @@ def get_user_by_session(token: str) -> dict:
 class Principal:
     kind: str  # user|service
     user: dict | None = None
+    service: bool = False  # SERVICE_TOKEN acting as `user`
 
 
 def require_principal(authorization: str | None = Header(default=None)) -> Principal:
+    with operation_latency.time(op="require_principal"):
+        return _resolve_principal(authorization)
+
+
+def _resolve_principal(authorization: str | None) -> Principal:
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing Authorization")
     if not authorization.lower().startswith("bearer "):
@@ -69,22 +270,16 @@ def require_principal(authorization: str | None = Header(default=None)) -> Princ
     if token == settings.SERVICE_TOKEN:
         # For convenience, let the service token act as a real user.
         # This avoids having to special-case every endpoint.
-        with tx() as con:
-            row = None
-            if settings.SERVICE_USER_HANDLE:
-                row = con.execute(
-                    "SELECT id,handle,display_name FROM users WHERE handle=?",
-                    (settings.SERVICE_USER_HANDLE.strip().lower(),),
-                ).fetchone()
-            if not row:
-                # Fallback: first user ever created (bootstrap/admin user)
-                row = con.execute(
-                    "SELECT id,handle,display_name FROM users ORDER BY created_at ASC LIMIT 1"
-                ).fetchone()
-            if not row:
-                raise HTTPException(status_code=503, detail="No users exist yet; bootstrap Notch first")
-            user = dict(row)
-        return Principal(kind="user", user=user)
+        user = None
+        if settings.SERVICE_USER_HANDLE:
+            user = user_by_handle(settings.SERVICE_USER_HANDLE.strip().lower())
+        if not user:
+            # Fallback: first user ever created (bootstrap/admin user)
+            admin_id = admin_user_id()
+            user = user_by_id(admin_id) if admin_id else None
+        if not user:
+            raise HTTPException(status_code=503, detail="No users exist yet; bootstrap Notch first")
+        return Principal(kind="user", user=user, service=True)
 
     # Otherwise treat as user session token
     user = get_user_by_session(token)
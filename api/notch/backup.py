@@ -0,0 +1,368 @@
+"""Online backups.
+
+Snapshots are taken with the SQLite online backup API while the app keeps
+serving: pages are copied BACKUP_PAGES_PER_STEP at a time with a short pause
+between steps, from a pinned read transaction, so the copy is one point in
+time and writers are never blocked (WAL mode). Each snapshot is integrity
+checked, gzipped into BACKUP_DIR with a JSON manifest (size, sha256,
+schema version) and the newest BACKUP_KEEP are kept.
+
+Restore is offline: stop the app, then
+
+    python -m notch.backup list
+    python -m notch.backup verify notch-20260101-030000
+    python -m notch.backup restore notch-20260101-030000
+
+restore decompresses the snapshot, checks it against its manifest and
+integrity_check, and only then copies it over DB_PATH.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any
+
+from . import db
+from .settings import settings
+
+_NAME_RE = re.compile(r"^notch-(\d{8}-\d{6})(?:-(\d+))?$")
+
+_lock = threading.Lock()
+_progress: dict[str, Any] | None = None
+_last_report: dict[str, Any] | None = None
+_next_run: float | None = None
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def backup_dir() -> Path:
+    if settings.BACKUP_DIR:
+        return Path(settings.BACKUP_DIR)
+    return Path(db.DB_PATH).parent / "backups"
+
+
+def snapshot_path(name: str) -> Path:
+    """Path of a snapshot by name (as listed), or a path to a .db.gz file."""
+    if _NAME_RE.match(name):
+        return backup_dir() / f"{name}.db.gz"
+    return Path(name)
+
+
+def _manifest_path(snapshot: Path) -> Path:
+    return snapshot.with_name(snapshot.name.removesuffix(".db.gz") + ".json")
+
+
+def list_backups() -> list[dict[str, Any]]:
+    """Snapshots on disk, newest first."""
+    d = backup_dir()
+    if not d.is_dir():
+        return []
+    found = []
+    for p in d.glob("notch-*.db.gz"):
+        m = _NAME_RE.match(p.name.removesuffix(".db.gz"))
+        if m:
+            # Same-second snapshots get a -2, -3 ... suffix.
+            found.append(((m.group(1), int(m.group(2) or 1)), p))
+    out = []
+    for _, p in sorted(found, reverse=True):
+        name = p.name.removesuffix(".db.gz")
+        try:
+            manifest = json.loads(_manifest_path(p).read_text("utf-8"))
+        except (OSError, ValueError):
+            manifest = {}
+        out.append({**manifest, "name": name, "gz_bytes": p.stat().st_size})
+    return out
+
+
+def _copy(dst_path: Path, progress: dict[str, Any]) -> None:
+    pages = int(settings.BACKUP_PAGES_PER_STEP)
+    pause = max(0.0, float(settings.BACKUP_STEP_PAUSE_MS) / 1000)
+
+    def step(status: int, remaining: int, total: int) -> None:
+        progress["pages_total"] = total
+        progress["pages_done"] = total - remaining
+        if remaining and pause:
+            time.sleep(pause)
+
+    src = db.connect()
+    dst = sqlite3.connect(str(dst_path))
+    try:
+        # Pin one read snapshot for all steps. Without it, any commit from another
+        # connection restarts the copy from page 1; with it, writers carry on in
+        # the WAL and the copy is a consistent point in time.
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=pages, progress=step)
+        src.rollback()
+        # The copy inherits WAL mode from the header; a snapshot should be one self-contained file.
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+
+def _check_db(path: Path) -> int:
+    """integrity_check a DB file; returns its schema version (user_version)."""
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = [r[0] for r in con.execute("PRAGMA integrity_check").fetchall()]
+        version = int(con.execute("PRAGMA user_version").fetchone()[0])
+    finally:
+        con.close()
+    if rows != ["ok"]:
+        raise RuntimeError(f"integrity check failed: {'; '.join(rows[:5])}")
+    return version
+
+
+def _compress(src: Path, dst: Path) -> str:
+    """gzip src into dst (fsynced); returns the sha256 of the uncompressed bytes."""
+    h = hashlib.sha256()
+    with open(src, "rb") as f, open(dst, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as out:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+                out.write(chunk)
+        raw.flush()
+        os.fsync(raw.fileno())
+    return h.hexdigest()
+
+
+def _decompress(src: Path, dst: Path) -> str:
+    h = hashlib.sha256()
+    with gzip.open(src, "rb") as f, open(dst, "wb") as out:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+            out.write(chunk)
+    return h.hexdigest()
+
+
+def rotate(keep: int | None = None) -> list[str]:
+    """Delete all but the newest `keep` (default BACKUP_KEEP) snapshots. Returns deleted names."""
+    keep = max(1, int(settings.BACKUP_KEEP if keep is None else keep))
+    deleted = []
+    for b in list_backups()[keep:]:
+        p = snapshot_path(b["name"])
+        p.unlink(missing_ok=True)
+        _manifest_path(p).unlink(missing_ok=True)
+        deleted.append(b["name"])
+    return deleted
+
+
+def backup_now(reason: str = "manual") -> dict[str, Any]:
+    """Take, verify, compress and rotate one snapshot. Blocking; one at a time."""
+    global _progress, _last_report
+    if not _lock.acquire(blocking=False):
+        raise RuntimeError("backup already running")
+    t0 = time.perf_counter()
+    progress = {"reason": reason, "started_at": now(), "phase": "copy", "pages_done": 0, "pages_total": 0}
+    _progress = progress
+    d = backup_dir()
+    tmp: Path | None = None
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        # Leftovers from an interrupted run.
+        for stale in d.glob("notch-*.partial"):
+            stale.unlink(missing_ok=True)
+        name = time.strftime("notch-%Y%m%d-%H%M%S", time.gmtime())
+        same = [b["name"] for b in list_backups() if b["name"].startswith(name)]
+        if same:
+            # Sorts after every snapshot from the same second.
+            name += f"-{int(_NAME_RE.match(same[0]).group(2) or 1) + 1}"
+        tmp = d / f"{name}.db.partial"
+        _copy(tmp, progress)
+
+        progress["phase"] = "verify"
+        version = _check_db(tmp)
+
+        progress["phase"] = "compress"
+        gz_tmp = d / f"{name}.db.gz.partial"
+        sha256 = _compress(tmp, gz_tmp)
+        manifest = {
+            "name": name,
+            "created_at": progress["started_at"],
+            "reason": reason,
+            "db_bytes": tmp.stat().st_size,
+            "sha256": sha256,
+            "user_version": version,
+            "pages": progress["pages_total"],
+        }
+        _manifest_path(snapshot_path(name)).write_text(json.dumps(manifest, indent=2) + "\n", "utf-8")
+        os.replace(gz_tmp, snapshot_path(name))
+        gz_bytes = snapshot_path(name).stat().st_size
+        deleted = rotate()
+        _last_report = {
+            **manifest,
+            "gz_bytes": gz_bytes,
+            "duration_ms": round((time.perf_counter() - t0) * 1000, 2),
+            "rotated": deleted,
+            "error": None,
+        }
+        return _last_report
+    except Exception as exc:
+        _last_report = {
+            "at": now(),
+            "reason": reason,
+            "duration_ms": round((time.perf_counter() - t0) * 1000, 2),
+            "error": str(exc),
+        }
+        raise
+    finally:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+        _progress = None
+        _lock.release()
+
+
+def verify(snapshot: Path, keep_as: Path | None = None) -> dict[str, Any]:
+    """Decompress a snapshot, check its sha256 against the manifest and run integrity_check.
+
+    The decompressed copy is deleted unless `keep_as` is given.
+    """
+    if not snapshot.is_file():
+        raise FileNotFoundError(f"no such snapshot: {snapshot}")
+    try:
+        manifest = json.loads(_manifest_path(snapshot).read_text("utf-8"))
+    except (OSError, ValueError):
+        manifest = {}
+    out = keep_as or snapshot.with_name(snapshot.name + ".verify.partial")
+    try:
+        try:
+            sha256 = _decompress(snapshot, out)
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            raise RuntimeError(f"snapshot is corrupt: {e}")
+        if manifest.get("sha256") and manifest["sha256"] != sha256:
+            raise RuntimeError("sha256 mismatch: snapshot is corrupt")
+        version = _check_db(out)
+    except Exception:
+        out.unlink(missing_ok=True)
+        raise
+    if keep_as is None:
+        out.unlink(missing_ok=True)
+    return {"snapshot": str(snapshot), "sha256": sha256, "manifest_checked": bool(manifest.get("sha256")), "user_version": version}
+
+
+def restore(snapshot: Path, target: Path) -> dict[str, Any]:
+    """Verify `snapshot` and copy it over the DB at `target`. Run with the app stopped."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    staged = target.with_name(target.name + ".restore.partial")
+    result = verify(snapshot, keep_as=staged)
+    try:
+        src = sqlite3.connect(str(staged))
+        dst = sqlite3.connect(str(target))
+        try:
+            # Through the backup API (not a file copy), so an existing -wal is
+            # handled and the swap is atomic for anyone holding the old file.
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        _check_db(target)
+    finally:
+        staged.unlink(missing_ok=True)
+    return {**result, "restored_to": str(target)}
+
+
+async def run_once(reason: str = "manual") -> dict[str, Any]:
+    return await asyncio.to_thread(backup_now, reason)
+
+
+def start(reason: str = "manual") -> None:
+    """Start a backup in the background; RuntimeError if one is running."""
+    if _lock.locked():
+        raise RuntimeError("backup already running")
+
+    async def _run() -> None:
+        try:
+            await run_once(reason)
+        except Exception:
+            pass  # recorded in _last_report
+
+    asyncio.create_task(_run(), name="notch-backup")
+
+
+async def run_due() -> bool:
+    global _next_run
+    if not settings.BACKUP_ENABLED:
+        return False
+    t = time.monotonic()
+    if _next_run is None:
+        # First check after boot: due when the newest snapshot is older than the interval.
+        backups = list_backups()
+        age = now() - int(backups[0].get("created_at") or 0) if backups else None
+        wait = 0.0 if age is None else max(0.0, float(settings.BACKUP_INTERVAL_SECONDS) - age)
+        _next_run = t + wait
+    if t < _next_run or _lock.locked():
+        return False
+    _next_run = t + float(settings.BACKUP_INTERVAL_SECONDS)
+    try:
+        await run_once("scheduled")
+    except Exception:
+        pass  # recorded in _last_report
+    return True
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "enabled": settings.BACKUP_ENABLED,
+        "dir": str(backup_dir()),
+        "interval_seconds": settings.BACKUP_INTERVAL_SECONDS,
+        "keep": settings.BACKUP_KEEP,
+        "running": dict(_progress) if _progress else None,
+        "last_run": _last_report,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m notch.backup", description="Notch DB backups")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("run", help="take a snapshot now")
+    sub.add_parser("list", help="list snapshots")
+    v = sub.add_parser("verify", help="check a snapshot without restoring it")
+    v.add_argument("snapshot", help="snapshot name (see list) or path to a .db.gz")
+    r = sub.add_parser("restore", help="restore a snapshot over DB_PATH (stop the app first)")
+    r.add_argument("snapshot", help="snapshot name (see list) or path to a .db.gz")
+    r.add_argument("--db", default=None, help="target DB (default: DB_PATH)")
+    args = ap.parse_args(argv)
+
+    try:
+        if args.cmd == "run":
+            result: Any = backup_now("cli")
+        elif args.cmd == "list":
+            result = list_backups()
+        elif args.cmd == "verify":
+            result = verify(snapshot_path(args.snapshot))
+        else:
+            target = Path(args.db or db.DB_PATH)
+            if target.exists():
+                # Keep what is being replaced, in case the wrong snapshot was picked.
+                keep = target.with_name(target.name + f".before-restore-{now()}")
+                old, copy = sqlite3.connect(str(target)), sqlite3.connect(str(keep))
+                try:
+                    old.backup(copy)
+                finally:
+                    copy.close()
+                    old.close()
+                print(f"previous DB copied to {keep}", file=sys.stderr)
+            result = restore(snapshot_path(args.snapshot), target)
+    except (RuntimeError, OSError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""API benchmark / load test.
+
+Seeds a synthetic database (users, lists, groups, heavily shared todos and
+notes, large markdown bodies), then drives a weighted mix of requests through
+the ASGI app in-process with N concurrent clients and reports p50/p95/p99
+latency and throughput per operation.
+
+    python -m notch.bench --out bench.json
+    python -m notch.bench --out new.json --compare bench.json
+
+Seeding and the request mix are driven by --seed, so two runs with the same
+arguments issue the same requests against the same data.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+from . import db
+from .settings import settings
+
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa "
+    "quebec romeo sierra tango uniform victor whiskey xray yankee zulu garden invoice school dentist "
+    "grocery laundry holiday budget birthday plumber insurance recipe passport meeting"
+).split()
+
+# (operation, weight). Mirrors what the web client does: mostly list views and
+# note autosave, occasional creates and logins.
+MIX: list[tuple[str, int]] = [
+    ("list_todos", 25),
+    ("list_todos_done", 5),
+    ("list_notes", 18),
+    ("search_notes", 10),
+    ("get_note", 10),
+    ("autosave_note", 15),
+    ("patch_todo", 8),
+    ("create_todo", 5),
+    ("list_lists", 2),
+    ("login", 2),
+]
+
+PASSWORD = "bench-password"
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def _text(rnd: random.Random, words: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def _markdown(rnd: random.Random, size: int) -> str:
+    parts: list[str] = []
+    n = 0
+    while n < size:
+        block = rnd.choice(("# ", "## ", "- ", "- [ ] ", "")) + _text(rnd, rnd.randint(5, 40))
+        parts.append(block)
+        n += len(block) + 1
+    return "\n".join(parts)
+
+
+def _shared(rnd: random.Random, user_ids: list[str], owner: str, heavy: float) -> list[str]:
+    k = rnd.randint(5, 25) if rnd.random() < heavy else rnd.choice((0, 0, 1, 2, 3))
+    return [u for u in rnd.sample(user_ids, min(k, len(user_ids))) if u != owner]
+
+
+def seed(con: sqlite3.Connection, args: argparse.Namespace) -> dict[str, Any]:
+    """Insert the synthetic dataset. Returns row counts and per-user ids for the workload."""
+    from .auth import hash_password
+
+    rnd = random.Random(args.seed)
+    t = now()
+    pw_hash = hash_password(PASSWORD)
+    users = [(str(uuid.uuid4()), f"bench{i}") for i in range(args.users)]
+    user_ids = [u for u, _ in users]
+    con.executemany(
+        "INSERT INTO users(id,handle,display_name,password_hash,created_at,updated_at) VALUES(?,?,?,?,?,?)",
+        [(u, h, h.title(), pw_hash, t - args.users + i, t) for i, (u, h) in enumerate(users)],
+    )
+
+    shares: list[tuple[str, str, str]] = []
+    lists, groups, todos, notes = [], [], [], []
+    per_user: dict[str, dict[str, list[str]]] = {u: {"todos": [], "notes": []} for u in user_ids}
+    for owner in user_ids:
+        own_lists = []
+        for _ in range(args.lists):
+            lid, sw = str(uuid.uuid4()), _shared(rnd, user_ids, owner, args.heavy_share)
+            lists.append((lid, _text(rnd, 2), owner, json.dumps(sw), t, t))
+            shares += [(u, "list", lid) for u in sw]
+            own_lists.append(lid)
+        own_groups = []
+        for _ in range(args.groups):
+            gid, sw = str(uuid.uuid4()), _shared(rnd, user_ids, owner, args.heavy_share)
+            groups.append((gid, _text(rnd, 2), owner, json.dumps(sw), t, t))
+            shares += [(u, "group", gid) for u in sw]
+            own_groups.append(gid)
+        for _ in range(args.todos):
+            tid, sw = str(uuid.uuid4()), _shared(rnd, user_ids, owner, args.heavy_share)
+            created = t - rnd.randint(0, 90 * 86400)
+            todos.append((
+                tid,
+                rnd.choice(own_lists) if own_lists else None,
+                _text(rnd, rnd.randint(2, 8)),
+                _text(rnd, rnd.randint(0, 30)) or None,
+                1 if rnd.random() < 0.4 else 0,
+                created + rnd.randint(0, 30 * 86400) if rnd.random() < 0.5 else None,
+                rnd.choice(user_ids) if rnd.random() < 0.2 else None,
+                json.dumps(sw),
+                owner,
+                created,
+                created,
+            ))
+            shares += [(u, "todo", tid) for u in sw]
+            per_user[owner]["todos"].append(tid)
+        for _ in range(args.notes):
+            nid, sw = str(uuid.uuid4()), _shared(rnd, user_ids, owner, args.heavy_share)
+            size = args.large_note_bytes if rnd.random() < 0.1 else rnd.randint(200, args.note_bytes)
+            created = t - rnd.randint(0, 90 * 86400)
+            notes.append((
+                nid,
+                rnd.choice(own_groups) if own_groups else None,
+                _text(rnd, rnd.randint(1, 6)),
+                _markdown(rnd, size),
+                json.dumps(sw),
+                owner,
+                created,
+                created,
+            ))
+            shares += [(u, "note", nid) for u in sw]
+            per_user[owner]["notes"].append(nid)
+
+    con.executemany(
+        "INSERT INTO todo_lists(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)", lists
+    )
+    con.executemany(
+        "INSERT INTO note_groups(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)", groups
+    )
+    con.executemany(
+        """
+        INSERT INTO todos(id,list_id,title,notes,done,due_at,assigned_to,shared_with,created_by,created_at,updated_at,version)
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,1)
+        """,
+        todos,
+    )
+    con.executemany(
+        """
+        INSERT INTO notes(id,group_id,title,body_md,shared_with,created_by,created_at,updated_at,version)
+        VALUES(?,?,?,?,?,?,?,?,1)
+        """,
+        notes,
+    )
+    con.executemany("INSERT OR IGNORE INTO item_shares(user_id,kind,item_id) VALUES(?,?,?)", shares)
+
+    # Pre-issued sessions for the simulated clients; logins are part of the mix.
+    active = rnd.sample(users, min(args.active_users, len(users)))
+    sessions = {}
+    for uid, handle in active:
+        token = uuid.uuid4().hex
+        con.execute(
+            "INSERT INTO sessions(token,user_id,created_at,expires_at,last_seen_at) VALUES(?,?,?,?,?)",
+            (token, uid, t, t + 86400, t),
+        )
+        ip = f"10.{len(sessions) // 65536 % 256}.{len(sessions) // 256 % 256}.{len(sessions) % 256}"
+        sessions[uid] = {"handle": handle, "token": token, "ip": ip, **per_user[uid]}
+    con.execute("ANALYZE")
+    return {
+        "rows": {
+            "users": len(users),
+            "todo_lists": len(lists),
+            "note_groups": len(groups),
+            "todos": len(todos),
+            "notes": len(notes),
+            "item_shares": len(shares),
+        },
+        "sessions": sessions,
+    }
+
+
+def _request(op: str, rnd: random.Random, s: dict[str, Any]) -> tuple[str, str, dict[str, Any] | None]:
+    if op == "list_todos":
+        return "GET", "/api/todos", None
+    if op == "list_todos_done":
+        return "GET", "/api/todos?include_done=1", None
+    if op == "list_notes":
+        return "GET", "/api/notes", None
+    if op == "search_notes":
+        return "GET", f"/api/notes?query={rnd.choice(WORDS)}", None
+    if op == "get_note":
+        return "GET", f"/api/notes/{rnd.choice(s['notes'])}", None
+    if op == "autosave_note":
+        return "PATCH", f"/api/notes/{rnd.choice(s['notes'])}", {"body_md": _markdown(rnd, rnd.randint(500, 4000))}
+    if op == "patch_todo":
+        return "PATCH", f"/api/todos/{rnd.choice(s['todos'])}", {"done": rnd.random() < 0.5}
+    if op == "create_todo":
+        return "POST", "/api/todos", {"title": _text(rnd, 4)}
+    if op == "list_lists":
+        return "GET", "/api/lists", None
+    if op == "login":
+        return "POST", "/api/auth/login", {"handle": s["handle"], "password": PASSWORD}
+    raise ValueError(op)
+
+
+def _plan(args: argparse.Namespace, sessions: dict[str, Any]) -> list[tuple[str, str, str, dict[str, Any] | None, dict[str, str]]]:
+    rnd = random.Random(args.seed + 1)
+    ops = [op for op, _ in MIX]
+    weights = [w for _, w in MIX]
+    users = [s for s in sessions.values() if s["notes"] and s["todos"]]
+    out = []
+    for _ in range(args.warmup + args.requests):
+        s = rnd.choice(users)
+        op = rnd.choices(ops, weights)[0]
+        method, path, body = _request(op, rnd, s)
+        out.append((op, method, path, body, {"Authorization": f"Bearer {s['token']}", "X-Forwarded-For": s["ip"]}))
+    return out
+
+
+def _pct(sorted_ms: list[float], p: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    k = max(0, min(len(sorted_ms) - 1, int(round(p / 100 * len(sorted_ms) + 0.5)) - 1))
+    return round(sorted_ms[k], 3)
+
+
+def _summary(samples: list[float], errors: int, seconds: float) -> dict[str, Any]:
+    ms = sorted(samples)
+    return {
+        "count": len(ms),
+        "errors": errors,
+        "rps": round(len(ms) / seconds, 2) if seconds else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": _pct(ms, 50),
+        "p95_ms": _pct(ms, 95),
+        "p99_ms": _pct(ms, 99),
+        "max_ms": round(ms[-1], 3) if ms else 0.0,
+    }
+
+
+async def run_load(args: argparse.Namespace, sessions: dict[str, Any]) -> dict[str, Any]:
+    from .app import app
+
+    # Each simulated user gets its own client address, as behind a real proxy,
+    # so per-IP login limits apply per user rather than to the whole run.
+    settings.TRUST_PROXY_HEADERS = True
+    plan = _plan(args, sessions)
+    samples: dict[str, list[float]] = {op: [] for op, _ in MIX}
+    errors: dict[str, int] = {op: 0 for op, _ in MIX}
+    status: dict[str, int] = {}
+    next_i = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def worker(until: int, record: bool) -> None:
+            nonlocal next_i
+            while next_i < until:
+                op, method, path, body, headers = plan[next_i]
+                next_i += 1
+                t0 = time.perf_counter()
+                r = await client.request(method, path, json=body, headers=headers)
+                elapsed = (time.perf_counter() - t0) * 1000
+                if not record:
+                    continue
+                samples[op].append(elapsed)
+                status[str(r.status_code)] = status.get(str(r.status_code), 0) + 1
+                if r.status_code >= 400:
+                    errors[op] += 1
+
+        await asyncio.gather(*(worker(args.warmup, False) for _ in range(args.concurrency)))
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(len(plan), True) for _ in range(args.concurrency)))
+        seconds = time.perf_counter() - t0
+
+    everything = [x for v in samples.values() for x in v]
+    return {
+        "seconds": round(seconds, 3),
+        "status": status,
+        "overall": _summary(everything, sum(errors.values()), seconds),
+        "endpoints": {op: _summary(samples[op], errors[op], seconds) for op, _ in MIX if samples[op]},
+    }
+
+
+def _git_rev() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _print(result: dict[str, Any], baseline: dict[str, Any] | None) -> None:
+    base = (baseline or {}).get("endpoints", {})
+    print(f"{'operation':<16}{'count':>7}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    rows = list(result["endpoints"].items()) + [("overall", result["overall"])]
+    if baseline:
+        base = {**base, "overall": baseline.get("overall", {})}
+    for op, s in rows:
+        line = f"{op:<16}{s['count']:>7}{s['errors']:>5}{s['rps']:>9.1f}{s['p50_ms']:>9.2f}{s['p95_ms']:>9.2f}{s['p99_ms']:>9.2f}"
+        b = base.get(op)
+        if b and b.get("p95_ms"):
+            line += f"   p95 {(s['p95_ms'] - b['p95_ms']) / b['p95_ms'] * 100:+.1f}%"
+        print(line)
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m notch.bench", description=__doc__.splitlines()[0])
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--lists", type=int, default=3, help="todo lists per user")
+    ap.add_argument("--groups", type=int, default=2, help="note groups per user")
+    ap.add_argument("--todos", type=int, default=30, help="todos per user")
+    ap.add_argument("--notes", type=int, default=10, help="notes per user")
+    ap.add_argument("--note-bytes", type=int, default=3000, help="max size of a regular note body")
+    ap.add_argument("--large-note-bytes", type=int, default=32000, help="size of the 10%% large note bodies")
+    ap.add_argument("--heavy-share", type=float, default=0.2, help="fraction of items shared with 5-25 users")
+    ap.add_argument("--active-users", type=int, default=100, help="users issuing requests")
+    ap.add_argument("--requests", type=int, default=3000)
+    ap.add_argument("--warmup", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", help="database file (default: a fresh temp file)")
+    ap.add_argument("--out", help="write results as JSON to this file")
+    ap.add_argument("--compare", help="previous results JSON to diff against")
+    args = ap.parse_args(argv)
+
+    db_path = Path(args.db) if args.db else Path(tempfile.mkdtemp(prefix="notch-bench-")) / "bench.db"
+    if db_path.exists():
+        print(f"refusing to overwrite existing {db_path}", file=sys.stderr)
+        return 2
+    db.DB_PATH = str(db_path)
+
+    from .schema import apply_schema
+
+    t0 = time.perf_counter()
+    apply_schema()
+    with db.tx() as con:
+        seeded = seed(con, args)
+    seed_seconds = time.perf_counter() - t0
+    print(f"seeded {seeded['rows']} in {seed_seconds:.1f}s ({db_path}, {db_path.stat().st_size // 1024} KiB)")
+
+    load = asyncio.run(run_load(args, seeded["sessions"]))
+    result = {
+        "meta": {
+            "at": now(),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "db")},
+        },
+        "seed": {"rows": seeded["rows"], "seconds": round(seed_seconds, 3), "db_bytes": db_path.stat().st_size},
+        **load,
+    }
+    baseline = json.loads(Path(args.compare).read_text("utf-8")) if args.compare else None
+    _print(result, baseline)
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2) + "\n", "utf-8")
+        print(f"wrote {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
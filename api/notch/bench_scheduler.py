@@ -0,0 +1,271 @@
+"""Reminder delivery benchmark.
+
+Schedules a burst of reminders all due at the same moment (the 9am case),
+points NTFY_BASE_URL at a local fake ntfy server with configurable latency and
+failure rate, and drives scheduler.run_once() the way the app's background
+loop does until every reminder is sent. Reports end-to-end lag from remind_at
+to delivery, throughput, duplicate deliveries and how long the backlog takes
+to drain after the fake server stops failing.
+
+    python -m notch.bench_scheduler --reminders 2000 --out sched.json
+    python -m notch.bench_scheduler --fail-rate 0.2 --fail-seconds 5 --compare sched.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+from . import db
+from .bench import _git_rev, _pct, now
+from .settings import settings
+
+
+class FakeNtfy:
+    """Minimal HTTP/1.1 server that accepts ntfy publishes and records them."""
+
+    def __init__(self, latency_ms: float, fail_rate: float, fail_seconds: float, seed: int):
+        self.latency = latency_ms / 1000
+        self.fail_rate = fail_rate
+        self.fail_until = 0.0
+        self.fail_seconds = fail_seconds
+        self.rnd = random.Random(seed)
+        self.ok: list[tuple[str, str, float]] = []  # (topic, click url, received at)
+        self.failed = 0
+        self.port = 0
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.fail_until = time.time() + self.fail_seconds if self.fail_seconds else float("inf")
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def failing(self) -> bool:
+        return self.fail_rate > 0 and time.time() < self.fail_until
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            headers: dict[str, str] = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                k, _, v = line.partition(":")
+                headers[k.strip().lower()] = v.strip()
+            await reader.readexactly(int(headers.get("content-length") or 0))
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            topic = request_line.split(" ")[1].lstrip("/")
+            if self.failing() and self.rnd.random() < self.fail_rate:
+                self.failed += 1
+                status, body = "500 Internal Server Error", b'{"error":"fake failure"}'
+            else:
+                self.ok.append((topic, headers.get("click", ""), time.time()))
+                status, body = "200 OK", b"{}"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1")
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def seed(con: sqlite3.Connection, args: argparse.Namespace, remind_at: int) -> tuple[dict[str, str], dict[str, int]]:
+    """Insert users and due reminders. Returns (topic -> user id, todo id -> recipient count)."""
+    from .ntfy import topic_for_handle
+
+    rnd = random.Random(args.seed)
+    t = now()
+    users = [(str(uuid.uuid4()), f"sched{i}") for i in range(args.users)]
+    user_ids = [u for u, _ in users]
+    con.executemany(
+        "INSERT INTO users(id,handle,display_name,password_hash,created_at,updated_at) VALUES(?,?,?,?,?,?)",
+        [(u, h, h, "x", t + i, t) for i, (u, h) in enumerate(users)],
+    )
+    todos, shares, recipients = [], [], {}
+    for i in range(args.reminders):
+        tid = str(uuid.uuid4())
+        owner = rnd.choice(user_ids)
+        sw = rnd.sample(user_ids, min(args.recipients, len(user_ids)))
+        assigned = rnd.choice(user_ids) if rnd.random() < 0.3 else None
+        todos.append((tid, f"reminder {i}", remind_at, assigned, json.dumps(sw), owner, t, t))
+        shares += [(u, "todo", tid) for u in sw]
+        recipients[tid] = len(set(sw) | ({assigned} if assigned else set()))
+    con.executemany(
+        """
+        INSERT INTO todos(id,title,remind_at,assigned_to,shared_with,created_by,created_at,updated_at,version)
+        VALUES(?,?,?,?,?,?,?,?,1)
+        """,
+        todos,
+    )
+    con.executemany("INSERT OR IGNORE INTO item_shares(user_id,kind,item_id) VALUES(?,?,?)", shares)
+    return {topic_for_handle(h): u for u, h in users}, recipients
+
+
+def _pending() -> int:
+    with db.tx() as con:
+        todos = con.execute(
+            "SELECT COUNT(*) FROM todos WHERE done=0 AND remind_at IS NOT NULL AND remind_sent_at IS NULL"
+        ).fetchone()[0]
+        outbox = con.execute("SELECT COUNT(*) FROM outbox_notifications WHERE status='pending'").fetchone()[0]
+        return todos + outbox
+
+
+def _clicked_todos(click: str) -> list[str]:
+    """Todo ids a push links to: one todo, or every todo of a digest."""
+    if "?digest=" in click:
+        with db.tx() as con:
+            rows = con.execute(
+                "SELECT todo_id FROM outbox_notifications WHERE digest_id=?", (click.rsplit("=", 1)[-1],)
+            ).fetchall()
+        return [r[0] for r in rows]
+    return [click.rsplit("/", 1)[-1]]
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    from .scheduler import run_once
+
+    fake = FakeNtfy(args.latency_ms, args.fail_rate, args.fail_seconds, args.seed)
+    await fake.start()
+    settings.NTFY_BASE_URL = f"http://127.0.0.1:{fake.port}"
+    settings.SCHEDULER_ENABLED = True
+    if args.coalesce is not None:
+        settings.NOTIFY_COALESCE_SECONDS = args.coalesce
+    poll = max(0.25, float(args.poll if args.poll is not None else settings.SCHEDULER_POLL_SECONDS))
+
+    remind_at = now()
+    with db.tx() as con:
+        topics, recipients = seed(con, args, remind_at)
+
+    t0 = time.time()
+    passes = 0
+    drained_at = None
+    # Same cadence as the app's scheduler loop: one pass, then sleep.
+    while time.time() - t0 < args.timeout:
+        await run_once()
+        passes += 1
+        if _pending() == 0:
+            drained_at = time.time()
+            break
+        await asyncio.sleep(poll)
+    await fake.stop()
+
+    first: dict[tuple[str, str], float] = {}
+    received = 0
+    for topic, click, at in fake.ok:
+        for todo_id in _clicked_todos(click):
+            key = (todo_id, topics.get(topic, topic))
+            first[key] = min(first.get(key, at), at)
+            received += 1
+    lags = sorted((at - remind_at) * 1000 for at in first.values())
+    expected = sum(recipients.values())
+    duplicates = received - len(first)
+    elapsed = (drained_at or time.time()) - t0
+    with db.tx() as con:
+        outbox = {r[0]: r[1] for r in con.execute("SELECT status, COUNT(*) FROM outbox_notifications GROUP BY status")}
+    recovered_after = None
+    if drained_at and fake.fail_rate and fake.fail_seconds:
+        recovered_after = round(max(0.0, drained_at - fake.fail_until), 3)
+    return {
+        "reminders": len(recipients),
+        "expected_deliveries": expected,
+        "delivered": len(first),
+        "drained": drained_at is not None,
+        "drain_seconds": round(elapsed, 3),
+        "recovery_seconds": recovered_after,
+        "scheduler_passes": passes,
+        "deliveries_per_second": round(len(first) / elapsed, 2) if elapsed else 0.0,
+        "publish_ok": len(fake.ok),
+        "publish_failed": fake.failed,
+        "duplicates": duplicates,
+        "duplicate_rate": round(duplicates / len(first), 4) if first else 0.0,
+        "lag_ms": {
+            "p50": _pct(lags, 50),
+            "p95": _pct(lags, 95),
+            "p99": _pct(lags, 99),
+            "max": round(lags[-1], 3) if lags else 0.0,
+        },
+        "outbox": outbox,
+    }
+
+
+def _print(result: dict[str, Any], baseline: dict[str, Any] | None) -> None:
+    keys = ("drain_seconds", "deliveries_per_second", "duplicate_rate", "recovery_seconds")
+    for k in keys:
+        line = f"{k:<24}{result[k]!s:>12}"
+        b = (baseline or {}).get(k)
+        if b:
+            line += f"   was {b} ({(float(result[k] or 0) - b) / b * 100:+.1f}%)"
+        print(line)
+    for k, v in result["lag_ms"].items():
+        line = f"{'lag_' + k + '_ms':<24}{v:>12}"
+        b = (baseline or {}).get("lag_ms", {}).get(k)
+        if b:
+            line += f"   was {b} ({(v - b) / b * 100:+.1f}%)"
+        print(line)
+    print(
+        f"delivered {result['delivered']}/{result['expected_deliveries']} in {result['scheduler_passes']} passes; "
+        f"publish ok={result['publish_ok']} failed={result['publish_failed']} duplicates={result['duplicates']}; "
+        f"outbox {result['outbox']}"
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m notch.bench_scheduler", description=__doc__.splitlines()[0])
+    ap.add_argument("--reminders", type=int, default=2000, help="reminders due at the same moment")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--recipients", type=int, default=3, help="users each reminder is shared with")
+    ap.add_argument("--latency-ms", type=float, default=5.0, help="fake ntfy response delay")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="fraction of publishes answered with 500")
+    ap.add_argument("--fail-seconds", type=float, default=0.0, help="only fail for the first N seconds (0 = always)")
+    ap.add_argument("--poll", type=float, help="scheduler poll interval (default: SCHEDULER_POLL_SECONDS)")
+    ap.add_argument("--coalesce", type=int, help="NOTIFY_COALESCE_SECONDS (0 = one push per reminder)")
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="write results as JSON to this file")
+    ap.add_argument("--compare", help="previous results JSON to diff against")
+    args = ap.parse_args(argv)
+
+    db.DB_PATH = str(Path(tempfile.mkdtemp(prefix="notch-bench-")) / "sched.db")
+    from .schema import apply_schema
+
+    apply_schema()
+    result = {
+        "meta": {
+            "at": now(),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        **asyncio.run(run(args)),
+    }
+    baseline = json.loads(Path(args.compare).read_text("utf-8")) if args.compare else None
+    _print(result, baseline)
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2) + "\n", "utf-8")
+        print(f"wrote {args.out}")
+    return 0 if result["drained"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
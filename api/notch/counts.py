@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import sqlite3
+from typing import Any
+
+from fastapi import HTTPException
+
+from . import notes as notes_api
+from . import todos as todos_api
+from .auth import Principal
+from .db import tx
+
+# Sidebar counters: open/done/Trash todos per list and live/Trash notes per
+# group, kept per viewing user in item_counts.
+#
+# Counts are per viewer because visibility is: a todo counts for its creator,
+# its assignee and everyone it is shared with; a note for its creator, its
+# shares and the sharees of its group. Each visible item counts once per user.
+#
+# SQLite triggers (installed by migration 11) keep the rows current on every
+# write to todos, notes, their archive tables and item_shares, so bulk paths
+# (list deletion, archiving, import, retention) need no extra bookkeeping.
+# Archived rows still count: they show up in the done and Trash views.
+#
+# Triggers only touch users listed in item_counts_ready. A user's counters are
+# computed from scratch on their first /api/counts call, in the same write
+# transaction that marks them ready, so no backfill job is needed.
+
+TODO_STATE = "CASE WHEN {r}.deleted_at IS NOT NULL THEN 'trash' WHEN {r}.done THEN 'done' ELSE 'open' END"
+NOTE_STATE = "CASE WHEN {r}.deleted_at IS NOT NULL THEN 'trash' ELSE 'live' END"
+
+READY_SQL = "SELECT 1 FROM item_counts_ready WHERE user_id=?"
+MARK_READY_SQL = "INSERT OR IGNORE INTO item_counts_ready(user_id) VALUES(?)"
+RESET_SQL = "DELETE FROM item_counts WHERE user_id=?"
+GET_SQL = "SELECT kind, container_id, state, n FROM item_counts WHERE user_id=? AND n>0"
+
+_READY = "(SELECT user_id FROM item_counts_ready)"
+_UPSERT = " ON CONFLICT(user_id,kind,container_id,state) DO UPDATE SET n=n+excluded.n;"
+
+
+def _viewers(kind: str, r: str) -> str:
+    if kind == "todo":
+        return (
+            f"SELECT {r}.created_by AS uid UNION SELECT {r}.assigned_to WHERE {r}.assigned_to IS NOT NULL"
+            f" UNION SELECT user_id FROM item_shares WHERE kind='todo' AND item_id={r}.id"
+        )
+    return (
+        f"SELECT {r}.created_by AS uid UNION SELECT user_id FROM item_shares WHERE kind='note' AND item_id={r}.id"
+        f" UNION SELECT user_id FROM item_shares WHERE kind='group' AND item_id={r}.group_id"
+    )
+
+
+def _row_delta(kind: str, r: str, n: int) -> str:
+    """Add `n` to the bucket of row `r` (NEW/OLD) for each ready viewer."""
+    container, state = ("list", TODO_STATE) if kind == "todo" else ("group", NOTE_STATE)
+    col = f"{container}_id"
+    return (
+        f"INSERT INTO item_counts(user_id,kind,container_id,state,n)"
+        f" SELECT v.uid,'{container}',COALESCE({r}.{col},''),{state.format(r=r)},{n}"
+        f" FROM ({_viewers(kind, r)}) v WHERE v.uid IN {_READY}" + _UPSERT
+    )
+
+
+def _share_delta(kind: str, r: str, n: int) -> str:
+    """Add `n` per item that share row `r` makes (in)visible to its user and nothing else does."""
+    uid = f"{r}.user_id"
+    if kind == "todo":
+        cols = "list_id,done,deleted_at,created_by,assigned_to"
+        src = f"SELECT {cols} FROM todos WHERE id={r}.item_id UNION ALL SELECT {cols} FROM todos_archive WHERE id={r}.item_id"
+        other = f"{uid} IS NOT t.created_by AND {uid} IS NOT t.assigned_to"
+        container, state, col = "list", TODO_STATE, "list_id"
+    elif kind == "note":
+        cols = "group_id,deleted_at,created_by"
+        src = f"SELECT {cols} FROM notes WHERE id={r}.item_id UNION ALL SELECT {cols} FROM notes_archive WHERE id={r}.item_id"
+        other = (
+            f"{uid} IS NOT t.created_by AND NOT EXISTS"
+            f" (SELECT 1 FROM item_shares WHERE user_id={uid} AND kind='group' AND item_id=t.group_id)"
+        )
+        container, state, col = "group", NOTE_STATE, "group_id"
+    else:
+        cols = "id,group_id,deleted_at,created_by"
+        src = f"SELECT {cols} FROM notes WHERE group_id={r}.item_id UNION ALL SELECT {cols} FROM notes_archive WHERE group_id={r}.item_id"
+        other = (
+            f"{uid} IS NOT t.created_by AND NOT EXISTS"
+            f" (SELECT 1 FROM item_shares WHERE user_id={uid} AND kind='note' AND item_id=t.id)"
+        )
+        container, state, col = "group", NOTE_STATE, "group_id"
+    return (
+        f"INSERT INTO item_counts(user_id,kind,container_id,state,n)"
+        f" SELECT {uid},'{container}',COALESCE(t.{col},''),{state.format(r='t')},{n} * COUNT(*)"
+        f" FROM ({src}) t WHERE {other} AND {uid} IN {_READY} GROUP BY 2,3,4" + _UPSERT
+    )
+
+
+def trigger_sql() -> list[str]:
+    """CREATE TRIGGER statements maintaining item_counts."""
+    out = []
+    for kind, tables, cols in (
+        ("todo", ("todos", "todos_archive"), ("list_id", "done", "deleted_at", "created_by", "assigned_to")),
+        ("note", ("notes", "notes_archive"), ("group_id", "deleted_at", "created_by")),
+    ):
+        for table in tables:
+            changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in cols)
+            out += [
+                f"CREATE TRIGGER IF NOT EXISTS trg_counts_{table}_ins AFTER INSERT ON {table} BEGIN"
+                f" {_row_delta(kind, 'NEW', 1)} END",
+                f"CREATE TRIGGER IF NOT EXISTS trg_counts_{table}_del AFTER DELETE ON {table} BEGIN"
+                f" {_row_delta(kind, 'OLD', -1)} END",
+                f"CREATE TRIGGER IF NOT EXISTS trg_counts_{table}_upd AFTER UPDATE OF {','.join(cols)} ON {table}"
+                f" WHEN {changed} BEGIN {_row_delta(kind, 'OLD', -1)} {_row_delta(kind, 'NEW', 1)} END",
+            ]
+    for kind in ("todo", "note", "group"):
+        out += [
+            f"CREATE TRIGGER IF NOT EXISTS trg_counts_share_{kind}_ins AFTER INSERT ON item_shares"
+            f" WHEN NEW.kind='{kind}' BEGIN {_share_delta(kind, 'NEW', 1)} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_counts_share_{kind}_del AFTER DELETE ON item_shares"
+            f" WHEN OLD.kind='{kind}' BEGIN {_share_delta(kind, 'OLD', -1)} END",
+        ]
+    return out
+
+
+def init_sql() -> list[str]:
+    """Statements computing one user's counters from scratch (params: user id per `?`)."""
+    out = []
+    for container, state, col, cols, visible, tables in (
+        ("list", TODO_STATE, "list_id", "list_id,done,deleted_at", todos_api.VISIBLE_SQL, ("todos", "todos_archive")),
+        ("group", NOTE_STATE, "group_id", "group_id,deleted_at", notes_api.VISIBLE_SQL, ("notes", "notes_archive")),
+    ):
+        rows = " UNION ALL ".join(f"SELECT {cols} FROM {t} WHERE {visible}" for t in tables)
+        out.append(
+            f"INSERT INTO item_counts(user_id,kind,container_id,state,n)"
+            f" SELECT ?,'{container}',COALESCE(r.{col},''),{state.format(r='r')},COUNT(*) FROM ({rows}) r"
+            f" WHERE true GROUP BY 3,4"
+        )
+    return out
+
+
+def _init(con: sqlite3.Connection, user_id: str) -> None:
+    con.execute(RESET_SQL, (user_id,))
+    for sql in init_sql():
+        con.execute(sql, [user_id] * sql.count("?"))
+    con.execute(MARK_READY_SQL, (user_id,))
+
+
+def get_counts(*, p: Principal) -> dict[str, Any]:
+    """Per-list and per-group counts (and totals) of what the user can see."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    uid = p.user["id"]
+    with tx() as con:
+        if not con.execute(READY_SQL, (uid,)).fetchone():
+            _init(con, uid)
+        rows = con.execute(GET_SQL, (uid,)).fetchall()
+    out: dict[str, Any] = {
+        "lists": {},
+        "groups": {},
+        "todos": {"open": 0, "done": 0, "trash": 0},
+        "notes": {"live": 0, "trash": 0},
+    }
+    for r in rows:
+        container, total = ("lists", out["todos"]) if r["kind"] == "list" else ("groups", out["notes"])
+        c = out[container].setdefault(r["container_id"], dict.fromkeys(total, 0))
+        c[r["state"]] = r["n"]
+        total[r["state"]] += r["n"]
+    return out
@@ -1,21 +1,228 @@
 from __future__ import annotations
 
+import logging
 import os
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from typing import Any
+
+from .settings import settings
 
 DB_PATH = os.environ.get("DB_PATH", "/data/app.db")
 
+log = logging.getLogger("notch.sql")
+
+# Per-request DB accounting ({"connections", "statements", "seconds"}). The
+# metrics middleware sets a fresh dict per request; tx() adds to it when set.
+request_stats: ContextVar[dict | None] = ContextVar("notch_db_request_stats", default=None)
+
+# Per-request SQL trace (list of statement entries), set by the trace middleware
+# when a request asks for it. Finished traces are kept in a small ring buffer.
+request_trace: ContextVar[list | None] = ContextVar("notch_db_request_trace", default=None)
+
+_traces: OrderedDict[str, dict[str, Any]] = OrderedDict()
+_slow: deque[dict[str, Any]] = deque(maxlen=100)
+_lock = threading.Lock()
+
+_WS = re.compile(r"\s+")
+
+# Per-table write generations, bumped when a transaction that wrote to the table
+# commits. In-process caches (see ics.py) compare them to know whether a table
+# changed without querying it. Write paths can also note_write() a finer key
+# (e.g. shares.todos_key) that is bumped the same way.
+_generations: dict[str, int] = {}
+_WRITE_RE = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+(\w+)",
+    re.IGNORECASE,
+)
+_COMMIT_RE = re.compile(r"^\s*(?:COMMIT|END)\b", re.IGNORECASE)
+
+
+def generation(*tables: str) -> tuple[int, ...]:
+    """Current write generation of each table (changes after every committed write)."""
+    with _lock:
+        return tuple(_generations.get(t, 0) for t in tables)
+
+
+def _params_shape(params: Any) -> list[str] | dict[str, str]:
+    # Types only: traces and slow logs must not leak note bodies or tokens.
+    if isinstance(params, dict):
+        return {k: type(v).__name__ for k, v in params.items()}
+    return [type(v).__name__ for v in (params or ())]
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Times execute + fetch and counts rows for the trace / slow-query log."""
+
+    _entry: dict[str, Any] | None = None
+
+    def execute(self, sql: str, params: Any = (), /):  # type: ignore[override]
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._begin(sql, params, time.perf_counter() - t0)
+
+    def executemany(self, sql: str, seq: Any, /):  # type: ignore[override]
+        seq = list(seq)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self._begin(sql, seq[0] if seq else (), time.perf_counter() - t0, batch=len(seq))
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        self._add(time.perf_counter() - t0, 0 if row is None else 1)
+        return row
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._add(time.perf_counter() - t0, len(rows))
+        return rows
+
+    def _begin(self, sql: str, params: Any, elapsed: float, batch: int | None = None) -> None:
+        stats = request_stats.get()
+        if stats is not None:
+            stats["statements"] += 1
+        self._entry = {
+            "sql": _WS.sub(" ", sql).strip(),
+            "params": _params_shape(params),
+            "ms": elapsed * 1000,
+            "rows": 0,
+        }
+        if batch is not None:
+            self._entry["batch"] = batch
+        self._raw = (sql, params)
+        m = _WRITE_RE.match(sql)
+        if m:
+            self.connection.note_write(m.group(1).lower())
+        elif _COMMIT_RE.match(sql):
+            self.connection.bump_generations()
+        trace = request_trace.get()
+        if trace is not None:
+            trace.append(self._entry)
+        self._check_slow()
+
+    def _add(self, elapsed: float, rows: int) -> None:
+        if self._entry is None:
+            return
+        self._entry["ms"] += elapsed * 1000
+        self._entry["rows"] += rows
+        self._check_slow()
+
+    def _check_slow(self) -> None:
+        e = self._entry
+        threshold = float(settings.SQL_SLOW_MS)
+        if threshold <= 0 or e is None or e.get("slow") or e["ms"] < threshold:
+            return
+        e["slow"] = True
+        sql, params = self._raw
+        plan: list[str] = []
+        if sql.lstrip()[:6].upper() in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+            try:
+                # Plain cursor, so the EXPLAIN itself is not traced.
+                rows = self.connection.cursor().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                plan = [r[3] for r in rows]
+            except Exception:
+                pass
+        record = {**e, "at": int(time.time()), "plan": plan}
+        with _lock:
+            _slow.append(record)
+        log.warning("slow query %.1fms rows=%d params=%s: %s | plan: %s", e["ms"], e["rows"], e["params"], e["sql"], " / ".join(plan))
+
+
+class TracedConnection(sqlite3.Connection):
+    _written: set[str] | None = None
+
+    def note_write(self, table: str) -> None:
+        if self._written is None:
+            self._written = set()
+        self._written.add(table)
+
+    def bump_generations(self) -> None:
+        if not self._written:
+            return
+        with _lock:
+            for t in self._written:
+                _generations[t] = _generations.get(t, 0) + 1
+        self._written = None
+
+    def commit(self) -> None:
+        super().commit()
+        self.bump_generations()
+
+    def rollback(self) -> None:
+        super().rollback()
+        self._written = None
+
+    def execute(self, sql: str, params: Any = (), /):  # type: ignore[override]
+        return self.cursor(TracedCursor).execute(sql, params)
+
+    def executemany(self, sql: str, seq: Any, /):  # type: ignore[override]
+        return self.cursor(TracedCursor).executemany(sql, seq)
+
+
+def store_trace(request_id: str, trace: dict[str, Any]) -> None:
+    with _lock:
+        _traces[request_id] = trace
+        while len(_traces) > max(1, int(settings.SQL_TRACE_BUFFER)):
+            _traces.popitem(last=False)
+
+
+def get_trace(request_id: str) -> dict[str, Any] | None:
+    with _lock:
+        return _traces.get(request_id)
+
+
+def recent_traces() -> list[dict[str, Any]]:
+    with _lock:
+        items = list(_traces.items())
+    return [
+        {k: v for k, v in t.items() if k != "statements"} | {"request_id": rid, "statement_count": len(t["statements"])}
+        for rid, t in reversed(items)
+    ]
+
+
+def recent_slow() -> list[dict[str, Any]]:
+    with _lock:
+        return list(reversed(_slow))
+
 
 def ensure_dirs() -> None:
     p = Path(DB_PATH)
     p.parent.mkdir(parents=True, exist_ok=True)
 
 
+def create_if_missing() -> None:
+    """Create the DB file with auto_vacuum=INCREMENTAL if it doesn't exist yet.
+
+    The setting only takes on a new file, before the WAL switch, so it is made
+    once here rather than on every connection; existing DBs are converted by
+    maintenance.convert_auto_vacuum().
+    """
+    ensure_dirs()
+    if Path(DB_PATH).exists():
+        return
+    con = sqlite3.connect(DB_PATH)
+    try:
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("PRAGMA journal_mode = WAL")
+    finally:
+        con.close()
+
+
 def connect() -> sqlite3.Connection:
     ensure_dirs()
-    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, factory=TracedConnection)
     con.row_factory = sqlite3.Row
     con.execute("PRAGMA foreign_keys = ON")
     con.execute("PRAGMA journal_mode = WAL")
@@ -24,7 +231,11 @@ def connect() -> sqlite3.Connection:
 
 @contextmanager
 def tx():
+    stats = request_stats.get()
+    t0 = time.perf_counter()
     con = connect()
+    if stats is not None:
+        stats["connections"] += 1
     try:
         yield con
         con.commit()
@@ -33,3 +244,5 @@ def tx():
         raise
     finally:
         con.close()
+        if stats is not None:
+            stats["seconds"] += time.perf_counter() - t0
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+import uuid
+
+# Every user has an Inbox list and a General note group. Their ids live on the
+# user row (users.inbox_list_id / general_group_id, migration 5) and in the
+# auth user directory, so the list/create paths don't look them up by name.
+
+# (table, users column, name)
+DEFAULTS = (("todo_lists", "inbox_list_id", "Inbox"), ("note_groups", "general_group_id", "General"))
+
+BACKFILL_SQL = "SELECT rowid, id, inbox_list_id, general_group_id FROM users WHERE rowid>? ORDER BY rowid LIMIT ?"
+
+
+def provision_queries(table: str, column: str) -> list[str]:
+    """(current id, find by name, set id) for one kind of default container."""
+    return [
+        f"SELECT {column} FROM users WHERE id=?",
+        f"SELECT id FROM {table} WHERE created_by=? AND lower(name)=lower(?) LIMIT 1",
+        f"UPDATE users SET {column}=? WHERE id=?",
+    ]
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def provision(con: sqlite3.Connection, user_id: str, table: str, column: str, name: str) -> str:
+    """Find or create the user's container `name` in `table` on `con` and record its id in users.`column`."""
+    current, by_name, set_id = provision_queries(table, column)
+    row = con.execute(current, (user_id,)).fetchone()
+    if row and row[column]:
+        return row[column]
+    row = con.execute(by_name, (user_id, name)).fetchone()
+    if row:
+        cid = row["id"]
+    else:
+        cid = str(uuid.uuid4())
+        t = now()
+        con.execute(
+            f"INSERT INTO {table}(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)",
+            (cid, name, user_id, json.dumps([]), t, t),
+        )
+    con.execute(set_id, (cid, user_id))
+    return cid
+
+
+def provision_defaults(con: sqlite3.Connection, user_id: str) -> None:
+    """Create (or adopt existing) default containers for a user, on `con`."""
+    for table, column, name in DEFAULTS:
+        provision(con, user_id, table, column, name)
+
+
+def backfill_batch(con: sqlite3.Connection, cursor: str | None, batch: int = 200) -> str | None:
+    """Provision defaults for one batch of existing users.
+
+    `cursor` is the last users rowid handled (None to start). Returns the next
+    cursor, or None when done.
+    """
+    after = int(cursor or 0)
+    rows = con.execute(BACKFILL_SQL, (after, batch)).fetchall()
+    for r in rows:
+        if not r["inbox_list_id"] or not r["general_group_id"]:
+            provision_defaults(con, r["id"])
+    if len(rows) == batch:
+        return str(rows[-1]["rowid"])
+    return None
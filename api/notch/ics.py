@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import hashlib
+import secrets
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any
+from zoneinfo import ZoneInfo
+
+from fastapi import HTTPException
+
+from . import recurrence
+from .agenda import fetch_range
+from .auth import Principal
+from .db import generation, tx
+from .metrics import calendar_feeds
+from .settings import settings
+from .shares import todos_key
+
+# ICS calendar feed of a user's open todos (one VEVENT per todo with a due or
+# reminder time), for calendar apps that poll a secret URL.
+#
+# Feeds are built in memory and kept per user. A poll is answered from the
+# cached document without touching the DB unless a todo the user can see has
+# been written since it was built (db.generation of shares.todos_key, bumped by
+# the todo write paths for its creator, assignee and sharees) or it is older
+# than MAX_AGE_SECONDS. Writes that cannot change a feed (reminder marked
+# sent, archiving done or trashed todos) bump nothing. A rebuild runs the agenda range queries and reuses the
+# VEVENT text of every todo whose version is unchanged, so only edited todos
+# are rendered again. The ETag is a hash of the document, so clients polling an
+# unchanged feed get 304.
+#
+# Recurring todos are exported with their RRULE and DTSTART;TZID in settings.TZ.
+# No VTIMEZONE is emitted; calendar apps resolve IANA zone names themselves.
+
+PRODID = "-//Notch//Todos//EN"
+PAST_DAYS = 30
+MAX_EVENTS = 1000
+MAX_AGE_SECONDS = 3600
+MAX_CACHED_FEEDS = 256
+
+TOKEN_USER_SQL = "SELECT id FROM users WHERE calendar_token=?"
+GET_TOKEN_SQL = "SELECT calendar_token FROM users WHERE id=?"
+SET_TOKEN_SQL = "UPDATE users SET calendar_token=? WHERE id=?"
+
+_feeds: OrderedDict[str, dict[str, Any]] = OrderedDict()
+_tokens: dict[str, str] = {}
+_tokens_gen: tuple[int, ...] | None = None
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def _escape(text: str) -> str:
+    return (
+        text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+    )
+
+
+def _fold(line: str) -> str:
+    """Fold a content line at 75 octets (RFC 5545 3.1) without splitting a UTF-8 sequence."""
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line + "\r\n"
+    parts = []
+    limit = 75
+    while raw:
+        cut = min(limit, len(raw))
+        while cut < len(raw) and (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode("utf-8"))
+        raw = raw[cut:]
+        limit = 74  # continuation lines start with a space
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _utc(ts: int) -> str:
+    return datetime.fromtimestamp(int(ts), ZoneInfo("UTC")).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _duration(seconds: int) -> str:
+    sign = "-" if seconds < 0 else ""
+    return f"{sign}PT{abs(int(seconds))}S"
+
+
+def event(todo: dict[str, Any]) -> str:
+    """VEVENT for an open todo; starts at due_at, else remind_at."""
+    start = todo["due_at"] if todo.get("due_at") is not None else todo["remind_at"]
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{todo['id']}@notch",
+        f"DTSTAMP:{_utc(todo['updated_at'])}",
+        f"SEQUENCE:{int(todo.get('version') or 1)}",
+        f"SUMMARY:{_escape(todo.get('title') or '')}",
+    ]
+    rrule = None
+    if todo.get("recur"):
+        try:
+            rrule = recurrence.ical_rrule(todo["recur"])
+        except ValueError:
+            rrule = None
+    if rrule:
+        local = datetime.fromtimestamp(int(start), ZoneInfo(settings.TZ)).strftime("%Y%m%dT%H%M%S")
+        lines += [f"DTSTART;TZID={settings.TZ}:{local}", rrule]
+    else:
+        lines.append(f"DTSTART:{_utc(start)}")
+    if todo.get("remind_at") is not None:
+        lines += [
+            "BEGIN:VALARM",
+            "ACTION:DISPLAY",
+            f"DESCRIPTION:{_escape(todo.get('title') or 'Reminder')}",
+            f"TRIGGER:{_duration(int(todo['remind_at']) - int(start))}",
+            "END:VALARM",
+        ]
+    lines.append("END:VEVENT")
+    return "".join(_fold(line) for line in lines)
+
+
+def _build(user_id: str, old: dict[str, Any] | None) -> dict[str, Any]:
+    t = now()
+    lo = t - PAST_DAYS * 86400
+    with tx() as con:
+        rows = fetch_range(con, "due_at", user_id, lo, 2**31, MAX_EVENTS)
+        rows += fetch_range(con, "remind_at", user_id, lo, 2**31, MAX_EVENTS)
+    todos: dict[str, dict[str, Any]] = {}
+    for r in rows:
+        todos.setdefault(r["id"], r)
+
+    cached = old["events"] if old else {}
+    events: dict[str, tuple[int, str]] = {}
+    for todo in sorted(todos.values(), key=lambda r: (r["due_at"] or r["remind_at"], r["id"]))[:MAX_EVENTS]:
+        hit = cached.get(todo["id"])
+        if hit is None or hit[0] != todo["version"]:
+            hit = (todo["version"], event(todo))
+        events[todo["id"]] = hit
+
+    header = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:Notch",
+        f"X-WR-TIMEZONE:{settings.TZ}",
+    ]
+    body = (
+        "".join(_fold(line) for line in header) + "".join(text for _, text in events.values()) + "END:VCALENDAR\r\n"
+    ).encode("utf-8")
+    return {
+        "events": events,
+        "body": body,
+        "etag": '"' + hashlib.sha256(body).hexdigest()[:32] + '"',
+        "built_at": t,
+    }
+
+
+def feed(user_id: str) -> dict[str, Any]:
+    """The user's cached feed ({"body", "etag", ...}), rebuilt only when stale."""
+    gen = generation(todos_key(user_id))
+    f = _feeds.get(user_id)
+    if f is not None and f["gen"] == gen and now() - f["built_at"] < MAX_AGE_SECONDS:
+        _feeds.move_to_end(user_id)
+        calendar_feeds.inc(result="cached")
+        return f
+    f = _build(user_id, f)
+    f["gen"] = gen
+    _feeds[user_id] = f
+    _feeds.move_to_end(user_id)
+    while len(_feeds) > MAX_CACHED_FEEDS:
+        _feeds.popitem(last=False)
+    calendar_feeds.inc(result="rebuilt")
+    return f
+
+
+def user_for_token(token: str) -> str | None:
+    global _tokens_gen
+    gen = generation("users")
+    if gen != _tokens_gen:
+        _tokens.clear()
+        _tokens_gen = gen
+    if token in _tokens:
+        return _tokens[token]
+    with tx() as con:
+        row = con.execute(TOKEN_USER_SQL, (token,)).fetchone()
+    if row is None:
+        return None
+    _tokens[token] = row["id"]
+    return row["id"]
+
+
+def _url(token: str | None) -> str | None:
+    return f"/api/public/calendar/{token}.ics" if token else None
+
+
+def calendar_url(*, p: Principal) -> dict[str, Any]:
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    with tx() as con:
+        row = con.execute(GET_TOKEN_SQL, (p.user["id"],)).fetchone()
+    return {"url": _url(row["calendar_token"] if row else None)}
+
+
+def rotate_token(*, p: Principal) -> dict[str, Any]:
+    """Create the feed URL, or replace it (the old URL stops working)."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    token = secrets.token_urlsafe(24)
+    with tx() as con:
+        con.execute(SET_TOKEN_SQL, (token, p.user["id"]))
+    return {"url": _url(token)}
+
+
+def revoke_token(*, p: Principal) -> dict[str, Any]:
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    with tx() as con:
+        con.execute(SET_TOKEN_SQL, (None, p.user["id"]))
+    _feeds.pop(p.user["id"], None)
+    return {"url": None}
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import hashlib
+import time
+from typing import Any, Callable
+
+import orjson
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from .auth import Principal
+from .db import tx
+from .metrics import idempotent_requests
+from .settings import settings
+
+# Idempotency-Key support for create/patch endpoints.
+#
+# A client sends the same Idempotency-Key header on every retry of one logical
+# request. The first request reserves (user, key) in idempotency_keys, runs the
+# handler and stores its JSON response; retries get that stored response back
+# (with "Idempotent-Replayed: true") and the handler does not run again.
+# Requests made with SERVICE_TOKEN act as a user but are keyed separately
+# (idempotency_keys.service), so the integration and that user never share
+# (or collide on) a key.
+#
+# - A retry arriving while the first attempt is still running gets 409.
+# - A key reused for a different method/path/body gets 422.
+# - If the handler fails, the reservation is dropped so the request can be retried.
+# - A reservation with no response after STALE_SECONDS (process died mid-request)
+#   is taken over by the next retry.
+#
+# Keys expire after IDEMPOTENCY_TTL_SECONDS and are purged by retention.
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+STALE_SECONDS = 60
+
+RELEASE_SQL = (
+    "DELETE FROM idempotency_keys WHERE user_id=? AND service=? AND key=?"
+    " AND (expires_at<=? OR (status IS NULL AND created_at<=?))"
+)
+RESERVE_SQL = (
+    "INSERT OR IGNORE INTO idempotency_keys(user_id,service,key,fingerprint,status,response,created_at,expires_at)"
+    " VALUES(?,?,?,?,NULL,NULL,?,?)"
+)
+GET_SQL = "SELECT fingerprint, status, response FROM idempotency_keys WHERE user_id=? AND service=? AND key=?"
+DELETE_SQL = "DELETE FROM idempotency_keys WHERE user_id=? AND service=? AND key=?"
+STORE_SQL = "UPDATE idempotency_keys SET status=?, response=? WHERE user_id=? AND service=? AND key=?"
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def _fingerprint(request: Request, payload: Any) -> bytes:
+    body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(f"{request.method} {request.url.path}\n".encode() + body).digest()[:16]
+
+
+def _reserve(scope: tuple[str, int], key: str, fingerprint: bytes) -> Any:
+    """Claim (user, service, key). Returns None when claimed, else the existing row."""
+    t = now()
+    with tx() as con:
+        con.execute(RELEASE_SQL, (*scope, key, t, t - STALE_SECONDS))
+        cur = con.execute(
+            RESERVE_SQL, (*scope, key, fingerprint, t, t + max(60, int(settings.IDEMPOTENCY_TTL_SECONDS)))
+        )
+        if cur.rowcount:
+            return None
+        return con.execute(GET_SQL, (*scope, key)).fetchone()
+
+
+def run(
+    p: Principal,
+    key: str | None,
+    request: Request,
+    payload: Any,
+    handler: Callable[[], dict[str, Any]],
+) -> Any:
+    """Run `handler` at most once per Idempotency-Key; replay its response for retries."""
+    if key is None:
+        return handler()
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Invalid {HEADER}")
+    scope = (p.user["id"], 1 if p.service else 0)
+    fingerprint = _fingerprint(request, payload)
+
+    row = _reserve(scope, key, fingerprint)
+    if row is not None:
+        if bytes(row["fingerprint"]) != fingerprint:
+            idempotent_requests.inc(result="mismatch")
+            raise HTTPException(status_code=422, detail=f"{HEADER} was already used for a different request")
+        if row["status"] is None:
+            idempotent_requests.inc(result="in_progress")
+            raise HTTPException(
+                status_code=409,
+                detail=f"A request with this {HEADER} is still in progress",
+                headers={"Retry-After": "1"},
+            )
+        idempotent_requests.inc(result="replayed")
+        return Response(
+            content=row["response"],
+            status_code=row["status"],
+            media_type="application/json",
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        result = handler()
+    except BaseException:
+        with tx() as con:
+            con.execute(DELETE_SQL, (*scope, key))
+        raise
+    body = orjson.dumps(result)
+    with tx() as con:
+        con.execute(STORE_SQL, (200, body, *scope, key))
+    idempotent_requests.inc(result="new")
+    return Response(content=body, media_type="application/json")
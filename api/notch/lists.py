@@ -1,54 +1,53 @@
 from __future__ import annotations
 
 import json
+import sqlite3
 import time
 import uuid
 from typing import Any
 
 from fastapi import HTTPException
 
-from .auth import Principal
+from .auth import Principal, default_containers, remember_default_container
 from .db import tx
+from .defaults import provision
+from .serialize import row_serializer, shared_list
+from .shares import clear_shares, set_shares, shared_ids_sql
 
 
-def now() -> int:
-    return int(time.time())
+BY_ID_SQL = "SELECT * FROM todo_lists WHERE id=?"
+REASSIGN_TODOS_SQL = "UPDATE todos SET list_id=?, updated_at=? WHERE list_id=?"
+REASSIGN_ARCHIVED_SQL = "UPDATE todos_archive SET list_id=? WHERE list_id=?"
+DELETE_SQL = "DELETE FROM todo_lists WHERE id=?"
+LIST_SQL = f"SELECT * FROM todo_lists WHERE created_by=? OR id IN ({shared_ids_sql('list')}) ORDER BY lower(name) ASC"
+
 
+def update_sql(sets: list[str]) -> str:
+    return f"UPDATE todo_lists SET {', '.join(sets)} WHERE id=?"
 
-def _loads_list(s: str | None) -> list[str]:
-    if not s:
-        return []
-    try:
-        v = json.loads(s)
-        if isinstance(v, list):
-            return [str(x) for x in v]
-    except Exception:
-        pass
-    return []
+
+def now() -> int:
+    return int(time.time())
 
 
 def _dumps_list(v: list[str] | None) -> str:
     return json.dumps(v or [], ensure_ascii=False)
 
 
-def ensure_default_list(user_id: str) -> dict[str, Any]:
-    """Ensure an Inbox list exists for a user; return it."""
+def provision_inbox(con: sqlite3.Connection, user_id: str) -> str:
+    """Find or create the user's Inbox on `con` and record its id on the user row."""
+    return provision(con, user_id, "todo_lists", "inbox_list_id", "Inbox")
+
+
+def default_list_id(user_id: str) -> str:
+    """The user's Inbox id: a memory read once provisioned (at user creation or by migration 5)."""
+    lid = default_containers(user_id).get("inbox_list_id")
+    if lid:
+        return lid
     with tx() as con:
-        row = con.execute(
-            "SELECT * FROM todo_lists WHERE created_by=? AND lower(name)=lower(?) LIMIT 1",
-            (user_id, "Inbox"),
-        ).fetchone()
-        if row:
-            return _row_to_list(dict(row))
-
-        lid = str(uuid.uuid4())
-        t = now()
-        con.execute(
-            "INSERT INTO todo_lists(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)",
-            (lid, "Inbox", user_id, _dumps_list([]), t, t),
-        )
-        row2 = con.execute("SELECT * FROM todo_lists WHERE id=?", (lid,)).fetchone()
-        return _row_to_list(dict(row2))
+        lid = provision_inbox(con, user_id)
+    remember_default_container(user_id, "inbox_list_id", lid)
+    return lid
 
 
 def create_list(*, p: Principal, payload: dict) -> dict[str, Any]:
@@ -63,14 +62,16 @@ def create_list(*, p: Principal, payload: dict) -> dict[str, Any]:
     if not isinstance(shared_with, list):
         raise HTTPException(status_code=400, detail="shared_with must be list")
 
+    shared_with = [str(x) for x in shared_with]
     lid = str(uuid.uuid4())
     t = now()
     with tx() as con:
         con.execute(
             "INSERT INTO todo_lists(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)",
-            (lid, name, p.user["id"], _dumps_list([str(x) for x in shared_with]), t, t),
+            (lid, name, p.user["id"], _dumps_list(shared_with), t, t),
         )
-        row = con.execute("SELECT * FROM todo_lists WHERE id=?", (lid,)).fetchone()
+        set_shares(con, "list", lid, shared_with)
+        row = con.execute(BY_ID_SQL, (lid,)).fetchone()
     return _row_to_list(dict(row))
 
 
@@ -93,11 +94,10 @@ def patch_list(*, p: Principal, list_id: str, payload: dict) -> dict[str, Any]:
     if shared_with is not None and not isinstance(shared_with, list):
         raise HTTPException(status_code=400, detail="shared_with must be list")
 
-    # Ensure Inbox exists
-    inbox = ensure_default_list(p.user["id"])
+    inbox_id = default_list_id(p.user["id"])
 
     with tx() as con:
-        row = con.execute("SELECT * FROM todo_lists WHERE id=?", (str(list_id),)).fetchone()
+        row = con.execute(BY_ID_SQL, (str(list_id),)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Not found")
         cur = dict(row)
@@ -106,7 +106,7 @@ def patch_list(*, p: Principal, list_id: str, payload: dict) -> dict[str, Any]:
             raise HTTPException(status_code=403, detail="Only creator can edit")
 
         # Don't allow renaming Inbox itself
-        if str(cur.get("id")) == str(inbox.get("id")) or str(cur.get("name") or "").strip().lower() == "inbox":
+        if str(cur.get("id")) == inbox_id or str(cur.get("name") or "").strip().lower() == "inbox":
             raise HTTPException(status_code=409, detail="Cannot rename Inbox")
 
         sets = []
@@ -125,8 +125,10 @@ def patch_list(*, p: Principal, list_id: str, payload: dict) -> dict[str, Any]:
         params.append(now())
         params.append(str(list_id))
 
-        con.execute(f"UPDATE todo_lists SET {', '.join(sets)} WHERE id=?", params)
-        row2 = con.execute("SELECT * FROM todo_lists WHERE id=?", (str(list_id),)).fetchone()
+        con.execute(update_sql(sets), params)
+        if shared_with is not None:
+            set_shares(con, "list", str(list_id), [str(x) for x in shared_with])
+        row2 = con.execute(BY_ID_SQL, (str(list_id),)).fetchone()
 
     return _row_to_list(dict(row2))
 
@@ -140,11 +142,10 @@ def delete_list(*, p: Principal, list_id: str) -> dict[str, Any]:
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
 
-    # Ensure Inbox exists
-    inbox = ensure_default_list(p.user["id"])
+    inbox_id = default_list_id(p.user["id"])
 
     with tx() as con:
-        row = con.execute("SELECT * FROM todo_lists WHERE id=?", (str(list_id),)).fetchone()
+        row = con.execute(BY_ID_SQL, (str(list_id),)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Not found")
         cur = dict(row)
@@ -153,19 +154,18 @@ def delete_list(*, p: Principal, list_id: str) -> dict[str, Any]:
             raise HTTPException(status_code=403, detail="Only creator can delete")
 
         # Don't allow deleting Inbox itself
-        if str(cur.get("id")) == str(inbox.get("id")) or str(cur.get("name") or "").strip().lower() == "inbox":
+        if str(cur.get("id")) == inbox_id or str(cur.get("name") or "").strip().lower() == "inbox":
             raise HTTPException(status_code=409, detail="Cannot delete Inbox")
 
         # Reassign todos first
-        con.execute(
-            "UPDATE todos SET list_id=?, updated_at=? WHERE list_id=?",
-            (str(inbox["id"]), now(), str(list_id)),
-        )
+        con.execute(REASSIGN_TODOS_SQL, (inbox_id, now(), str(list_id)))
+        con.execute(REASSIGN_ARCHIVED_SQL, (inbox_id, str(list_id)))
 
         # Delete list
-        con.execute("DELETE FROM todo_lists WHERE id=?", (str(list_id),))
+        con.execute(DELETE_SQL, (str(list_id),))
+        clear_shares(con, "list", str(list_id))
 
-    return {"ok": True, "deleted": True, "id": str(list_id), "moved_todos_to": inbox.get("id")}
+    return {"ok": True, "deleted": True, "id": str(list_id), "moved_todos_to": inbox_id}
 
 
 def list_lists(*, p: Principal) -> list[dict[str, Any]]:
@@ -173,18 +173,15 @@ def list_lists(*, p: Principal) -> list[dict[str, Any]]:
         raise HTTPException(status_code=403, detail="User session required")
 
     # Ensure Inbox exists
-    ensure_default_list(p.user["id"])
+    default_list_id(p.user["id"])
 
     with tx() as con:
-        rows = con.execute(
-            """
-            SELECT * FROM todo_lists
-            WHERE created_by=? OR instr(shared_with, ?) > 0
-            ORDER BY lower(name) ASC
-            """,
-            (p.user["id"], p.user["id"]),
-        ).fetchall()
-    return [_row_to_list(dict(r)) for r in rows]
+        cur = con.execute(LIST_SQL, (p.user["id"], p.user["id"]))
+        to_dict = row_serializer(cur.description, LIST_FIELDS, lists=("shared_with",))
+        return [to_dict(r) for r in cur.fetchall()]
+
+
+LIST_FIELDS = ("id", "name", "created_by", "shared_with", "created_at", "updated_at")
 
 
 def _row_to_list(row: dict) -> dict[str, Any]:
@@ -192,7 +189,7 @@ def _row_to_list(row: dict) -> dict[str, Any]:
         "id": row.get("id"),
         "name": row.get("name"),
         "created_by": row.get("created_by"),
-        "shared_with": _loads_list(row.get("shared_with")),
+        "shared_with": shared_list(row.get("shared_with")),
         "created_at": row.get("created_at"),
         "updated_at": row.get("updated_at"),
     }
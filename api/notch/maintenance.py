@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any
+
+from . import db
+from .settings import settings
+
+# Background DB upkeep, driven by the maintenance loop in app startup.
+#
+# - WAL checkpoint every MAINTENANCE_CHECKPOINT_SECONDS: PASSIVE while requests
+#   are flowing, TRUNCATE (shrinks the -wal file) once the app is idle.
+# - PRAGMA optimize (ANALYZE on first run) every MAINTENANCE_OPTIMIZE_SECONDS, idle only.
+# - incremental_vacuum of up to MAINTENANCE_VACUUM_PAGES free pages per tick, idle only.
+#   DBs created before auto_vacuum=INCREMENTAL are converted once by a full
+#   VACUUM, and only if a quarter of the file is free pages and the disk has room.
+
+_last_activity = time.monotonic()
+_next_due: dict[str, float] = {}
+_last_run: dict[str, dict[str, Any]] = {}
+
+
+def mark_activity() -> None:
+    global _last_activity
+    _last_activity = time.monotonic()
+
+
+def is_idle() -> bool:
+    return time.monotonic() - _last_activity >= float(settings.MAINTENANCE_IDLE_SECONDS)
+
+
+def _wal_path() -> Path:
+    return Path(db.DB_PATH + "-wal")
+
+
+def db_stats() -> dict[str, Any]:
+    con = db.connect()
+    try:
+        page_size = con.execute("PRAGMA page_size").fetchone()[0]
+        page_count = con.execute("PRAGMA page_count").fetchone()[0]
+        freelist = con.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = con.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        con.close()
+    wal = _wal_path()
+    return {
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, auto_vacuum),
+        "db_bytes": page_size * page_count,
+        "wal_bytes": wal.stat().st_size if wal.exists() else 0,
+    }
+
+
+def checkpoint(mode: str = "PASSIVE") -> dict[str, Any]:
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"bad checkpoint mode: {mode}")
+    con = db.connect()
+    try:
+        busy, log, done = con.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        con.close()
+    return {"mode": mode, "busy": bool(busy), "wal_pages": log, "checkpointed": done}
+
+
+def optimize() -> dict[str, Any]:
+    con = db.connect()
+    try:
+        analyzed = con.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone()
+        if analyzed:
+            con.execute("PRAGMA optimize")
+        else:
+            con.execute("ANALYZE")
+        con.commit()
+    finally:
+        con.close()
+    return {"analyze": not analyzed}
+
+
+def incremental_vacuum(pages: int) -> dict[str, Any]:
+    con = db.connect()
+    try:
+        before = con.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript steps the pragma to completion; execute() would free one page.
+        con.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = con.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        con.close()
+    return {"freed_pages": before - after, "freelist_count": after}
+
+
+def convert_auto_vacuum() -> dict[str, Any]:
+    """One-time full VACUUM that switches an old DB to auto_vacuum=INCREMENTAL."""
+    con = db.connect()
+    try:
+        # connect() already requested INCREMENTAL; VACUUM makes it stick.
+        con.execute("VACUUM")
+    finally:
+        con.close()
+    return {"converted": True}
+
+
+def _should_convert(st: dict[str, Any]) -> bool:
+    if st["auto_vacuum"] == "incremental" or not st["page_count"]:
+        return False
+    if st["freelist_count"] * 4 < st["page_count"]:
+        return False
+    # VACUUM writes a full copy of the DB before swapping it in.
+    free = shutil.disk_usage(os.path.dirname(db.DB_PATH) or ".").free
+    return free > 2 * st["db_bytes"]
+
+
+def _run(name: str, fn, *args) -> None:
+    t0 = time.perf_counter()
+    try:
+        result = fn(*args)
+        error = None
+    except Exception as exc:
+        result = None
+        error = str(exc)
+    _last_run[name] = {
+        "at": int(time.time()),
+        "duration_ms": round((time.perf_counter() - t0) * 1000, 2),
+        "result": result,
+        "error": error,
+    }
+
+
+def _due(name: str, every: float, t: float) -> bool:
+    if t < _next_due.get(name, 0.0):
+        return False
+    _next_due[name] = t + every
+    return True
+
+
+def run_once() -> list[str]:
+    """Run whatever maintenance is due. Returns the task names that ran."""
+    if not settings.MAINTENANCE_ENABLED:
+        return []
+    ran: list[str] = []
+    t = time.monotonic()
+    idle = is_idle()
+
+    if _due("checkpoint", float(settings.MAINTENANCE_CHECKPOINT_SECONDS), t):
+        _run("checkpoint", checkpoint, "TRUNCATE" if idle else "PASSIVE")
+        ran.append("checkpoint")
+
+    if not idle:
+        return ran
+
+    if _due("optimize", float(settings.MAINTENANCE_OPTIMIZE_SECONDS), t):
+        _run("optimize", optimize)
+        ran.append("optimize")
+
+    st = db_stats()
+    if st["auto_vacuum"] == "incremental" and st["freelist_count"] > 0:
+        _run("incremental_vacuum", incremental_vacuum, int(settings.MAINTENANCE_VACUUM_PAGES))
+        ran.append("incremental_vacuum")
+    elif "convert_auto_vacuum" not in _last_run and _should_convert(st):
+        _run("convert_auto_vacuum", convert_auto_vacuum)
+        ran.append("convert_auto_vacuum")
+    return ran
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "enabled": settings.MAINTENANCE_ENABLED,
+        "idle": is_idle(),
+        "last_run": dict(_last_run),
+        "db": db_stats(),
+    }
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from .db import tx
+
+# Minimal in-process metrics with Prometheus text exposition (no client library).
+# Sync handlers/dependencies run in the threadpool, so every update takes _lock.
+
+_lock = threading.Lock()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+LAG_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+
+def _fmt_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, value: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for key, v in sorted(self._values.items()):
+                out.append(f"{self.name}{_fmt_labels(self.labels, key)} {_num(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        # key -> [count per bucket..., overflow (> last bucket), sum, count]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            st = self._values.get(key)
+            if st is None:
+                st = self._values[key] = [0.0] * (len(self.buckets) + 3)
+            st[i] += 1
+            st[-2] += value
+            st[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        les = ['le="%s"' % _num(b) for b in self.buckets] + ['le="+Inf"']
+        for key, st in items:
+            cum = 0.0
+            for le, n in zip(les, st[:-2]):
+                cum += n
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {_num(cum)}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {_num(st[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {_num(st[-1])}")
+        return out
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name, self.help, self.fn = name, help, fn
+        REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        try:
+            v = float(self.fn())
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_num(v)}"]
+
+
+REGISTRY: list[Counter | Histogram | Gauge] = []
+
+# HTTP
+http_requests = Counter("notch_http_requests_total", "HTTP requests.", ("method", "route", "status"))
+http_latency = Histogram("notch_http_request_seconds", "HTTP request latency.", ("method", "route"))
+
+# DB, per request
+db_connections_per_request = Histogram(
+    "notch_db_connections_per_request", "tx() connections opened per request.", ("route",), COUNT_BUCKETS
+)
+db_statements_per_request = Histogram(
+    "notch_db_statements_per_request", "SQL statements executed per request.", ("route",), COUNT_BUCKETS
+)
+db_seconds_per_request = Histogram("notch_db_seconds_per_request", "Time spent inside tx() per request.", ("route",))
+
+# Auth
+login_attempts = Counter("notch_login_attempts_total", "Login attempts by outcome.", ("result",))
+
+# Idempotency-Key handling (see idempotency.py)
+idempotent_requests = Counter(
+    "notch_idempotent_requests_total", "Requests carrying an Idempotency-Key, by outcome.", ("result",)
+)
+
+# ICS calendar feeds (see ics.py)
+calendar_feeds = Counter(
+    "notch_calendar_feed_requests_total", "Calendar feed requests, by whether the cached document was served.", ("result",)
+)
+
+# Public share links (see note_shares.py)
+share_requests = Counter(
+    "notch_share_requests_total", "Public share-link requests, by operation and outcome.", ("op", "result")
+)
+
+# Named operations (auth, scheduler passes, ...)
+operation_latency = Histogram("notch_operation_seconds", "Latency of internal operations.", ("op",))
+
+# Scheduler / notifications
+reminders_processed = Counter("notch_reminders_processed_total", "Due reminders picked up by the scheduler.")
+reminders_delivered = Counter("notch_reminders_delivered_total", "Reminder notifications delivered (one per todo and recipient).")
+reminder_pushes = Counter("notch_reminder_pushes_total", "Reminder pushes sent, by kind (single, digest, daily).", ("kind",))
+reminder_lag = Histogram("notch_reminder_lag_seconds", "Delay from remind_at to delivery.", (), LAG_BUCKETS)
+ntfy_publish = Counter("notch_ntfy_publish_total", "ntfy publish attempts.", ("result",))
+ntfy_latency = Histogram("notch_ntfy_publish_seconds", "ntfy publish latency.")
+
+# Event loop (see profiler.lag_monitor)
+event_loop_lag = Histogram("notch_event_loop_lag_seconds", "Event loop heartbeat delay.")
+event_loop_blocks = Counter("notch_event_loop_blocks_total", "Times the event loop was blocked past LOOP_LAG_THRESHOLD_MS.")
+
+
+OUTBOX_PENDING_SQL = "SELECT COUNT(*) FROM outbox_notifications WHERE status='pending'"
+REMINDERS_DUE_SQL = (
+    "SELECT COUNT(*) FROM todos WHERE done=0 AND remind_at IS NOT NULL AND remind_at <= ? AND remind_sent_at IS NULL"
+)
+
+
+def _outbox_depth() -> float:
+    with tx() as con:
+        return con.execute(OUTBOX_PENDING_SQL).fetchone()[0]
+
+
+def _reminder_backlog() -> float:
+    with tx() as con:
+        return con.execute(REMINDERS_DUE_SQL, (int(time.time()),)).fetchone()[0]
+
+
+Gauge("notch_outbox_pending", "Outbox notifications not yet sent.", _outbox_depth)
+Gauge("notch_reminders_due", "Reminders past remind_at that are not yet sent.", _reminder_backlog)
+
+
+def render() -> str:
+    lines: list[str] = []
+    for m in REGISTRY:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Any
+
+from fastapi import HTTPException
+
+from .db import generation, tx
+from .metrics import share_requests
+from .ratelimit import TokenBucket
+from .settings import settings
+
+# Public note links (/share/n/<token>, rows in note_shares).
+#
+# The share page is one static document for every link: it reads the token from
+# its own URL, so it is served from memory with an ETag and long-lived cache
+# headers. Token metadata (note id, can_edit, expiry) is cached in memory and
+# dropped whenever note_shares is written (db.generation), so a public read is
+# one primary-key lookup of the note and a public save is one guarded UPDATE.
+#
+# Deleting a note cascades its note_shares rows away without a note_shares
+# write; a cached token for it still fails, because the note lookup does.
+#
+# Public endpoints need no auth, so every request first takes from a token
+# bucket per link and one per client IP, and saves from a stricter per-link
+# bucket; over the limit is a 429 with Retry-After. Saves to the same note that
+# arrive within SHARE_SAVE_COALESCE_MS against the same if_version (or none)
+# are merged (the last writer wins per field) and written with one UPDATE under
+# that version; every save in the batch gets the resulting note. A save against
+# another version flushes the batch and is then checked on its own.
+
+MAX_CACHED_TOKENS = 4096
+PAGE_MAX_AGE = 3600
+PUBLIC_NOTE_COLUMNS = "id,title,body_md,version,updated_at"
+
+BY_TOKEN_SQL = "SELECT note_id, created_by, can_edit, expires_at FROM note_shares WHERE token=?"
+NOTE_SQL = f"SELECT {PUBLIC_NOTE_COLUMNS}, deleted_at FROM notes WHERE id=?"
+
+_tokens: dict[str, dict[str, Any]] = {}
+_tokens_gen: tuple[int, ...] | None = None
+_tokens_lock = threading.Lock()
+
+_share_limits: tuple[TokenBucket, TokenBucket, TokenBucket] | None = None
+_pending: dict[str, dict[str, Any]] = {}  # note id -> batch of saves waiting to be written
+
+
+def now() -> int:
+    return int(time.time())
+
+
+SHARE_PAGE = """<!doctype html>
+<html lang="en">
+<head>
+  <meta charset="utf-8" />
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <title>Notch Share</title>
+  <style>
+    body { margin:0; font-family: system-ui, -apple-system, sans-serif; background:#0b0f14; color:#e6edf3; }
+    .wrap { max-width: 900px; margin: 0 auto; padding: 16px; }
+    .card { border: 1px solid #243041; border-radius: 12px; background:#111826; padding: 12px; }
+    input, textarea { width: 100%; box-sizing: border-box; padding: 10px; border-radius: 10px; border: 1px solid #243041; background:#111826; color:#e6edf3; font: inherit; }
+    textarea { min-height: 320px; resize: vertical; }
+    .row { display:flex; gap:10px; align-items:center; justify-content:space-between; flex-wrap: wrap; }
+    .muted { color:#9aa4af; font-size: 12px; }
+    .pill { border: 1px solid #243041; border-radius: 999px; padding: 2px 8px; font-size: 12px; color:#9aa4af; }
+  </style>
+</head>
+<body>
+  <div class="wrap">
+    <div class="row" style="margin-bottom:10px;">
+      <h2 style="margin:0;">Notch</h2>
+      <span class="pill">Shared note</span>
+    </div>
+    <div class="card">
+      <div class="row">
+        <div class="muted" id="status">Loading…</div>
+      </div>
+      <div style="margin-top:10px;">
+        <input id="title" placeholder="Title" />
+      </div>
+      <div style="margin-top:10px;">
+        <textarea id="body" placeholder="Markdown…"></textarea>
+      </div>
+      <div class="muted" style="margin-top:10px;">Autosaves when you stop typing.</div>
+    </div>
+  </div>
+
+<script>
+// The token is the last path segment (/share/n/<token>), so this page is the
+// same for every link and can be cached.
+const token = decodeURIComponent(location.pathname.split('/').filter(Boolean).pop() || '');
+let version = null;
+let canEdit = true;
+let timer = null;
+
+const statusEl = document.getElementById('status');
+const titleEl = document.getElementById('title');
+const bodyEl = document.getElementById('body');
+
+function setStatus(t){ statusEl.textContent = t; }
+
+async function load(){
+  setStatus('Loading…');
+  const res = await fetch(`/api/public/notes/${encodeURIComponent(token)}`);
+  const j = await res.json();
+  if (!res.ok) throw new Error(j?.detail || 'Failed');
+  titleEl.value = j.note.title || '';
+  bodyEl.value = j.note.body_md || '';
+  version = j.note.version;
+  canEdit = !!j.can_edit;
+  titleEl.disabled = !canEdit;
+  bodyEl.disabled = !canEdit;
+  setStatus(canEdit ? 'Editable link' : 'View-only link');
+}
+
+async function save(){
+  if (!canEdit) return;
+  setStatus('Saving…');
+  const res = await fetch(`/api/public/notes/${encodeURIComponent(token)}` , {
+    method: 'PATCH',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ title: titleEl.value, body_md: bodyEl.value, if_version: version })
+  });
+  const j = await res.json();
+  if (res.status === 429) {
+    // Rate limited: keep the edits and try again when the server says.
+    setStatus('Busy, retrying…');
+    const secs = Number(res.headers.get('Retry-After')) || 1;
+    if (!timer) timer = setTimeout(() => { timer=null; save(); }, secs * 1000);
+    return;
+  }
+  if (!res.ok) {
+    setStatus(j?.detail || 'Save failed');
+    // best-effort reload
+    try { await load(); } catch {}
+    return;
+  }
+  version = j.note.version;
+  setStatus('Saved');
+}
+
+function dirty(){
+  if (!canEdit) return;
+  setStatus('Unsaved');
+  if (timer) clearTimeout(timer);
+  timer = setTimeout(() => { timer=null; save(); }, 650);
+}
+
+titleEl.addEventListener('input', dirty);
+bodyEl.addEventListener('input', dirty);
+
+load().catch(e => { setStatus(String(e?.message || e)); });
+</script>
+</body>
+</html>"""
+
+SHARE_PAGE_BYTES = SHARE_PAGE.encode("utf-8")
+SHARE_PAGE_ETAG = '"' + hashlib.sha256(SHARE_PAGE_BYTES).hexdigest()[:32] + '"'
+
+
+def _lookup(token: str) -> dict[str, Any] | None:
+    global _tokens_gen
+    gen = generation("note_shares")
+    with _tokens_lock:
+        if gen != _tokens_gen:
+            _tokens.clear()
+            _tokens_gen = gen
+        share = _tokens.get(token)
+    if share is not None:
+        return share
+    with tx() as con:
+        row = con.execute(BY_TOKEN_SQL, (token,)).fetchone()
+    if row is None:
+        return None
+    share = {
+        "note_id": row["note_id"],
+        "created_by": row["created_by"],
+        "can_edit": bool(int(row["can_edit"] or 0)),
+        "expires_at": row["expires_at"],
+    }
+    with _tokens_lock:
+        if _tokens_gen == gen:
+            if len(_tokens) >= MAX_CACHED_TOKENS:
+                _tokens.clear()
+            _tokens[token] = share
+    return share
+
+
+def resolve(token: str) -> dict[str, Any]:
+    """Share metadata for a live token; 404 if unknown, 410 once expired."""
+    share = _lookup(token)
+    if share is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    if share["expires_at"] is not None and int(share["expires_at"]) <= now():
+        raise HTTPException(status_code=410, detail="Link expired")
+    return share
+
+
+def get_note(token: str) -> tuple[dict[str, Any], dict[str, Any]]:
+    """(share, note) for a public read."""
+    share = resolve(token)
+    with tx() as con:
+        row = con.execute(NOTE_SQL, (share["note_id"],)).fetchone()
+    if row is None or row["deleted_at"] is not None:
+        raise HTTPException(status_code=404, detail="Not found")
+    note = dict(row)
+    note.pop("deleted_at")
+    return share, note
+
+
+def _limits() -> tuple[TokenBucket, TokenBucket, TokenBucket]:
+    global _share_limits
+    if _share_limits is None:
+        _share_limits = (
+            TokenBucket(settings.SHARE_TOKEN_BURST, settings.SHARE_TOKEN_PER_MINUTE),
+            TokenBucket(settings.SHARE_IP_BURST, settings.SHARE_IP_PER_MINUTE),
+            TokenBucket(settings.SHARE_SAVE_BURST, settings.SHARE_SAVE_PER_MINUTE),
+        )
+    return _share_limits
+
+
+def guard(token: str, ip: str, op: str) -> None:
+    """Per-link and per-IP limits for one public request (op "read" or "save"); raises 429."""
+    by_token, by_ip, saves = _limits()
+    wait = max(by_ip.take(ip), by_token.take(token))
+    if op == "save":
+        wait = max(wait, saves.take(token))
+    if wait > 0:
+        share_requests.inc(op=op, result="rate_limited")
+        raise HTTPException(
+            status_code=429, detail="Too many requests for this link", headers={"Retry-After": str(int(wait) + 1)}
+        )
+
+
+def save_sql(fields: list[str]) -> str:
+    """Guarded UPDATE of `fields` (params: field values, updated_at, note id, if_version)."""
+    sets = ", ".join(f"{k}=?" for k in fields)
+    return (
+        f"UPDATE notes SET {sets}, updated_at=?, version=version+1"
+        " WHERE id=? AND deleted_at IS NULL AND version=COALESCE(?, version)"
+    )
+
+
+def _write(note_id: str, fields: dict[str, str], if_version: int | None) -> dict[str, Any]:
+    with tx() as con:
+        cur = con.execute(save_sql(list(fields)), [*fields.values(), now(), note_id, if_version])
+        if not cur.rowcount:
+            row = con.execute(NOTE_SQL, (note_id,)).fetchone()
+            if row is None:
+                raise HTTPException(status_code=404, detail="Not found")
+            if row["deleted_at"] is not None:
+                raise HTTPException(status_code=409, detail="Note is in trash")
+            raise HTTPException(status_code=409, detail="Version conflict")
+        row = con.execute(NOTE_SQL, (note_id,)).fetchone()
+    note = dict(row)
+    note.pop("deleted_at")
+    return note
+
+
+def _flush(note_id: str) -> None:
+    batch = _pending.pop(note_id)
+    batch["timer"].cancel()
+    done: asyncio.Future = batch["done"]
+    try:
+        done.set_result(_write(note_id, batch["fields"], batch["if_version"]))
+    except Exception as e:
+        done.set_exception(e)
+
+
+async def save(token: str, payload: dict) -> dict[str, Any]:
+    """Save title/body_md through an editable link (other fields are not editable there)."""
+    share = resolve(token)
+    if not share["can_edit"]:
+        raise HTTPException(status_code=403, detail="Read-only link")
+    if_version = payload.get("if_version")
+    if if_version is not None:
+        try:
+            if_version = int(if_version)
+        except Exception:
+            raise HTTPException(status_code=400, detail="if_version must be int")
+    fields = {k: ("" if payload.get(k) is None else str(payload.get(k))) for k in ("title", "body_md") if k in payload}
+    if not fields:
+        raise HTTPException(status_code=400, detail="No fields to update")
+
+    note_id = share["note_id"]
+    delay = int(settings.SHARE_SAVE_COALESCE_MS) / 1000
+    if delay <= 0:
+        return _write(note_id, fields, if_version)
+    batch = _pending.get(note_id)
+    if batch is not None and if_version is not None and if_version != batch["if_version"]:
+        # Written against another version than the batch: write the batch first,
+        # then check this save on its own so a stale one still gets its 409.
+        _flush(note_id)
+        share_requests.inc(op="save", result="written")
+        return _write(note_id, fields, if_version)
+    if batch is None:
+        loop = asyncio.get_running_loop()
+        batch = {"fields": {}, "if_version": if_version, "done": loop.create_future()}
+        # Mark the result as retrieved even if every waiter has gone away.
+        batch["done"].add_done_callback(lambda f: f.cancelled() or f.exception())
+        batch["timer"] = loop.call_later(delay, _flush, note_id)
+        _pending[note_id] = batch
+        share_requests.inc(op="save", result="written")
+    else:
+        share_requests.inc(op="save", result="coalesced")
+    batch["fields"].update(fields)
+    # Shielded: a client that disconnects must not cancel the batch for the others.
+    return await asyncio.shield(batch["done"])
@@ -1,64 +1,71 @@
 from __future__ import annotations
 
 import json
+import sqlite3
 import time
 import uuid
 from typing import Any
 
 from fastapi import HTTPException
 
-from .auth import Principal
+from .archive import NOTE_COLUMNS, unarchive
+from .auth import Principal, default_containers, remember_default_container
 from .db import tx
+from .defaults import provision
+from .serialize import row_serializer, shared_list
+from .shares import get_visible, set_shares, shared_ids_sql
 
 
-def now() -> int:
-    return int(time.time())
+# visible if: own note OR note.shared_with includes me OR note.group is shared with me
+VISIBLE_SQL = f"(created_by=? OR id IN ({shared_ids_sql('note')}) OR group_id IN ({shared_ids_sql('group')}))"
+
+
+BY_ID_SQL = "SELECT * FROM notes WHERE id=?"
+TRASH_SQL = "UPDATE notes SET deleted_at=?, updated_at=?, version=version+1 WHERE id=?"
+RESTORE_SQL = "UPDATE notes SET deleted_at=NULL, updated_at=?, version=version+1 WHERE id=?"
+GROUP_BY_ID_SQL = "SELECT * FROM note_groups WHERE id=?"
+LIST_GROUPS_SQL = f"SELECT * FROM note_groups WHERE created_by=? OR id IN ({shared_ids_sql('group')}) ORDER BY lower(name) ASC"
+
 
+def update_sql(sets: list[str]) -> str:
+    return f"UPDATE notes SET {', '.join(sets)} WHERE id=?"
 
-def _loads_list(s: str | None) -> list[str]:
-    if not s:
-        return []
-    try:
-        v = json.loads(s)
-        if isinstance(v, list):
-            return [str(x) for x in v]
-    except Exception:
-        pass
-    return []
+
+def group_update_sql(sets: list[str]) -> str:
+    return f"UPDATE note_groups SET {', '.join(sets)} WHERE id=?"
+
+
+def now() -> int:
+    return int(time.time())
 
 
 def _dumps_list(v: list[str] | None) -> str:
     return json.dumps(v or [], ensure_ascii=False)
 
 
-def ensure_default_group(user_id: str) -> dict[str, Any]:
+def provision_general(con: sqlite3.Connection, user_id: str) -> str:
+    """Find or create the user's General group on `con` and record its id on the user row."""
+    return provision(con, user_id, "note_groups", "general_group_id", "General")
+
+
+def default_group_id(user_id: str) -> str:
+    gid = default_containers(user_id).get("general_group_id")
+    if gid:
+        return gid
     with tx() as con:
-        row = con.execute(
-            "SELECT * FROM note_groups WHERE created_by=? AND lower(name)=lower(?) LIMIT 1",
-            (user_id, "General"),
-        ).fetchone()
-        if row:
-            return _row_to_group(dict(row))
-        gid = str(uuid.uuid4())
-        t = now()
-        con.execute(
-            "INSERT INTO note_groups(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)",
-            (gid, "General", user_id, _dumps_list([]), t, t),
-        )
-        row2 = con.execute("SELECT * FROM note_groups WHERE id=?", (gid,)).fetchone()
-        return _row_to_group(dict(row2))
+        gid = provision_general(con, user_id)
+    remember_default_container(user_id, "general_group_id", gid)
+    return gid
 
 
 def list_groups(*, p: Principal) -> list[dict[str, Any]]:
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
-    ensure_default_group(p.user["id"])
+    default_group_id(p.user["id"])
     with tx() as con:
-        rows = con.execute(
-            "SELECT * FROM note_groups WHERE created_by=? OR instr(shared_with, ?) > 0 ORDER BY lower(name) ASC",
-            (p.user["id"], p.user["id"]),
-        ).fetchall()
-    return [_row_to_group(dict(r)) for r in rows]
+        cur = con.execute(LIST_GROUPS_SQL, (p.user["id"], p.user["id"]))
+        to_dict = row_serializer(cur.description, GROUP_FIELDS, lists=("shared_with",))
+        return [to_dict(r) for r in cur.fetchall()]
 
 
 def patch_group(*, p: Principal, group_id: str, payload: dict) -> dict[str, Any]:
@@ -77,13 +84,14 @@ def patch_group(*, p: Principal, group_id: str, payload: dict) -> dict[str, Any]
         v = payload.get("shared_with")
         if not isinstance(v, list):
             raise HTTPException(status_code=400, detail="shared_with must be list")
-        fields["shared_with"] = _dumps_list([str(x) for x in v])
+        shared_with = [str(x) for x in v]
+        fields["shared_with"] = _dumps_list(shared_with)
 
     if not fields:
         raise HTTPException(status_code=400, detail="No fields to update")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM note_groups WHERE id=?", (group_id,)).fetchone()
+        row = con.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Not found")
         cur = dict(row)
@@ -99,8 +107,10 @@ def patch_group(*, p: Principal, group_id: str, payload: dict) -> dict[str, Any]
         sets.append("updated_at=?")
         params.append(now())
         params.append(group_id)
-        con.execute(f"UPDATE note_groups SET {', '.join(sets)} WHERE id=?", params)
-        row2 = con.execute("SELECT * FROM note_groups WHERE id=?", (group_id,)).fetchone()
+        con.execute(group_update_sql(sets), params)
+        if "shared_with" in fields:
+            set_shares(con, "group", group_id, shared_with)
+        row2 = con.execute(GROUP_BY_ID_SQL, (group_id,)).fetchone()
 
     return _row_to_group(dict(row2))
 
@@ -117,14 +127,16 @@ def create_group(*, p: Principal, payload: dict) -> dict[str, Any]:
     if not isinstance(shared_with, list):
         raise HTTPException(status_code=400, detail="shared_with must be list")
 
+    shared_with = [str(x) for x in shared_with]
     gid = str(uuid.uuid4())
     t = now()
     with tx() as con:
         con.execute(
             "INSERT INTO note_groups(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)",
-            (gid, name, p.user["id"], _dumps_list([str(x) for x in shared_with]), t, t),
+            (gid, name, p.user["id"], _dumps_list(shared_with), t, t),
         )
-        row = con.execute("SELECT * FROM note_groups WHERE id=?", (gid,)).fetchone()
+        set_shares(con, "group", gid, shared_with)
+        row = con.execute(GROUP_BY_ID_SQL, (gid,)).fetchone()
     return _row_to_group(dict(row))
 
 
@@ -140,13 +152,34 @@ def list_notes(
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
 
+    sql, params = _list_sql(
+        user_id=p.user["id"],
+        query=query,
+        group_id=group_id,
+        include_deleted=include_deleted,
+        deleted_only=deleted_only,
+        limit=limit,
+    )
+    with tx() as con:
+        cur = con.execute(sql, params)
+        to_dict = row_serializer(cur.description, NOTE_FIELDS, lists=("shared_with",))
+        return [to_dict(r) for r in cur.fetchall()]
+
+
+def _list_sql(
+    *,
+    user_id: str,
+    query: str | None,
+    group_id: str | None,
+    include_deleted: bool,
+    deleted_only: bool,
+    limit: int,
+) -> tuple[str, list[Any]]:
+    """Build the list_notes query (also used by the query plan check)."""
     q = (query or "").strip().lower()
     params: list[Any] = []
-    # visible if: own note OR note.shared_with includes me OR note.group is shared with me
-    where = [
-        "(created_by=? OR instr(shared_with, ?) > 0 OR EXISTS(SELECT 1 FROM note_groups g WHERE g.id=notes.group_id AND instr(g.shared_with, ?) > 0))"
-    ]
-    params.extend([p.user["id"], p.user["id"], p.user["id"]])
+    where = [VISIBLE_SQL]
+    params.extend([user_id, user_id, user_id])
 
     if group_id:
         where.append("group_id=?")
@@ -161,12 +194,19 @@ def list_notes(
         where.append("(lower(title) LIKE ? OR lower(body_md) LIKE ?)")
         params.extend([f"%{q}%", f"%{q}%"])
 
-    sql = "SELECT * FROM notes WHERE " + " AND ".join(where) + " ORDER BY updated_at DESC LIMIT ?"
+    w = " AND ".join(where)
+    if include_deleted or deleted_only:
+        # Old Trash may have been moved to the archive.
+        sql = (
+            f"SELECT * FROM (SELECT {NOTE_COLUMNS} FROM notes WHERE {w}"
+            f" UNION ALL SELECT {NOTE_COLUMNS} FROM notes_archive WHERE {w})"
+            " ORDER BY updated_at DESC LIMIT ?"
+        )
+        params = params + params
+    else:
+        sql = f"SELECT * FROM notes WHERE {w} ORDER BY updated_at DESC LIMIT ?"
     params.append(int(limit))
-
-    with tx() as con:
-        rows = con.execute(sql, params).fetchall()
-    return [_row_to_note(dict(r)) for r in rows]
+    return sql, params
 
 
 def create_note(*, p: Principal, payload: dict) -> dict[str, Any]:
@@ -184,8 +224,7 @@ def create_note(*, p: Principal, payload: dict) -> dict[str, Any]:
 
     group_id = payload.get("group_id")
     if not group_id:
-        group = ensure_default_group(p.user["id"])
-        group_id = group["id"]
+        group_id = default_group_id(p.user["id"])
 
     shared_with = payload.get("shared_with")
     if shared_with is None:
@@ -193,6 +232,7 @@ def create_note(*, p: Principal, payload: dict) -> dict[str, Any]:
     if not isinstance(shared_with, list):
         raise HTTPException(status_code=400, detail="shared_with must be list")
 
+    shared_with = [str(x) for x in shared_with]
     nid = str(uuid.uuid4())
     t = now()
     with tx() as con:
@@ -201,9 +241,10 @@ def create_note(*, p: Principal, payload: dict) -> dict[str, Any]:
             INSERT INTO notes(id,group_id,title,body_md,shared_with,created_by,created_at,updated_at,version)
             VALUES(?,?,?,?,?,?,?,?,?)
             """,
-            (nid, str(group_id), title, body_md, _dumps_list([str(x) for x in shared_with]), p.user["id"], t, t, 1),
+            (nid, str(group_id), title, body_md, _dumps_list(shared_with), p.user["id"], t, t, 1),
         )
-        row = con.execute("SELECT * FROM notes WHERE id=?", (nid,)).fetchone()
+        set_shares(con, "note", nid, shared_with)
+        row = con.execute(BY_ID_SQL, (nid,)).fetchone()
     return _row_to_note(dict(row))
 
 
@@ -211,13 +252,8 @@ def get_note(*, p: Principal, note_id: str) -> dict[str, Any]:
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
     with tx() as con:
-        row = con.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        note = dict(row)
-    if note.get("deleted_at") is not None:
-        raise HTTPException(status_code=404, detail="Not found")
-    if not _can_see(p.user["id"], note):
+        note = _get_visible(con, p.user["id"], note_id) or _get_visible(con, p.user["id"], note_id, "notes_archive")
+    if not note or note.get("deleted_at") is not None:
         raise HTTPException(status_code=404, detail="Not found")
     return _row_to_note(note)
 
@@ -227,20 +263,15 @@ def delete_note(*, p: Principal, note_id: str) -> dict[str, Any]:
         raise HTTPException(status_code=403, detail="User session required")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        cur = dict(row)
-        if not _can_see(p.user["id"], cur):
+        unarchive(con, "notes", note_id)
+        cur = _get_visible(con, p.user["id"], note_id)
+        if not cur:
             raise HTTPException(status_code=404, detail="Not found")
         if cur.get("created_by") != p.user["id"]:
             raise HTTPException(status_code=403, detail="Only creator can delete")
 
         t = now()
-        con.execute(
-            "UPDATE notes SET deleted_at=?, updated_at=?, version=version+1 WHERE id=?",
-            (t, t, note_id),
-        )
+        con.execute(TRASH_SQL, (t, t, note_id))
 
     return {"ok": True, "deleted": True, "id": note_id}
 
@@ -250,7 +281,8 @@ def restore_note(*, p: Principal, note_id: str) -> dict[str, Any]:
         raise HTTPException(status_code=403, detail="User session required")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
+        unarchive(con, "notes", note_id)
+        row = con.execute(BY_ID_SQL, (note_id,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Not found")
         cur = dict(row)
@@ -258,11 +290,8 @@ def restore_note(*, p: Principal, note_id: str) -> dict[str, Any]:
             raise HTTPException(status_code=403, detail="Only creator can restore")
 
         t = now()
-        con.execute(
-            "UPDATE notes SET deleted_at=NULL, updated_at=?, version=version+1 WHERE id=?",
-            (t, note_id),
-        )
-        row2 = con.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
+        con.execute(RESTORE_SQL, (t, note_id))
+        row2 = con.execute(BY_ID_SQL, (note_id,)).fetchone()
 
     return _row_to_note(dict(row2))
 
@@ -288,7 +317,8 @@ def patch_note(*, p: Principal, note_id: str, payload: dict) -> dict[str, Any]:
         v = payload.get("shared_with")
         if not isinstance(v, list):
             raise HTTPException(status_code=400, detail="shared_with must be list")
-        fields["shared_with"] = _dumps_list([str(x) for x in v])
+        shared_with = [str(x) for x in v]
+        fields["shared_with"] = _dumps_list(shared_with)
 
     if "group_id" in payload:
         v = payload.get("group_id")
@@ -298,14 +328,12 @@ def patch_note(*, p: Principal, note_id: str, payload: dict) -> dict[str, Any]:
         raise HTTPException(status_code=400, detail="No fields to update")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
-        if not row:
+        unarchive(con, "notes", note_id)
+        cur = _get_visible(con, p.user["id"], note_id)
+        if not cur:
             raise HTTPException(status_code=404, detail="Not found")
-        cur = dict(row)
         if cur.get("deleted_at") is not None:
             raise HTTPException(status_code=409, detail="Note is in trash")
-        if not _can_see(p.user["id"], cur):
-            raise HTTPException(status_code=404, detail="Not found")
         if if_version is not None and int(cur.get("version") or 0) != if_version:
             raise HTTPException(status_code=409, detail="Version conflict")
 
@@ -318,28 +346,19 @@ def patch_note(*, p: Principal, note_id: str, payload: dict) -> dict[str, Any]:
         params.append(now())
         sets.append("version=version+1")
         params.append(note_id)
-        con.execute(f"UPDATE notes SET {', '.join(sets)} WHERE id=?", params)
-        row2 = con.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
+        con.execute(update_sql(sets), params)
+        if "shared_with" in fields:
+            set_shares(con, "note", note_id, shared_with)
+        row2 = con.execute(BY_ID_SQL, (note_id,)).fetchone()
     return _row_to_note(dict(row2))
 
 
-def _can_see(user_id: str, note: dict) -> bool:
-    if note.get("created_by") == user_id:
-        return True
-    sw = _loads_list(note.get("shared_with"))
-    if user_id in sw:
-        return True
+def _get_visible(con: sqlite3.Connection, user_id: str, note_id: str, table: str = "notes") -> dict | None:
+    return get_visible(con, table, NOTE_COLUMNS, VISIBLE_SQL, note_id, user_id)
 
-    gid = note.get("group_id")
-    if gid:
-        with tx() as con:
-            row = con.execute("SELECT shared_with FROM note_groups WHERE id=?", (str(gid),)).fetchone()
-            if row:
-                gsw = _loads_list(row["shared_with"])  # type: ignore[index]
-                if user_id in gsw:
-                    return True
 
-    return False
+GROUP_FIELDS = ("id", "name", "created_by", "shared_with", "created_at", "updated_at")
+NOTE_FIELDS = ("id", "group_id", "title", "body_md", "shared_with", "created_by", "created_at", "updated_at", "version")
 
 
 def _row_to_group(row: dict) -> dict[str, Any]:
@@ -347,7 +366,7 @@ def _row_to_group(row: dict) -> dict[str, Any]:
         "id": row.get("id"),
         "name": row.get("name"),
         "created_by": row.get("created_by"),
-        "shared_with": _loads_list(row.get("shared_with")),
+        "shared_with": shared_list(row.get("shared_with")),
         "created_at": row.get("created_at"),
         "updated_at": row.get("updated_at"),
     }
@@ -359,7 +378,7 @@ def _row_to_note(row: dict) -> dict[str, Any]:
         "group_id": row.get("group_id"),
         "title": row.get("title"),
         "body_md": row.get("body_md"),
-        "shared_with": _loads_list(row.get("shared_with")),
+        "shared_with": shared_list(row.get("shared_with")),
         "created_by": row.get("created_by"),
         "created_at": row.get("created_at"),
         "updated_at": row.get("updated_at"),
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import json
+import time
 
 import httpx
 
+from .metrics import ntfy_latency, ntfy_publish
 from .settings import settings
 
 
@@ -19,9 +21,17 @@ async def publish(*, topic: str, title: str, message: str, click_url: str | None
     if tags:
         headers["Tags"] = ",".join(tags)
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        r = await client.post(url, content=message.encode("utf-8"), headers=headers)
-        r.raise_for_status()
+    t0 = time.perf_counter()
+    try:
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            r = await client.post(url, content=message.encode("utf-8"), headers=headers)
+            r.raise_for_status()
+    except Exception:
+        ntfy_publish.inc(result="error")
+        raise
+    finally:
+        ntfy_latency.observe(time.perf_counter() - t0)
+    ntfy_publish.inc(result="ok")
 
 
 def topic_for_handle(handle: str) -> str:
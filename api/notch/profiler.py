@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Any
+
+from .metrics import event_loop_blocks, event_loop_lag
+from .settings import settings
+
+# In-process diagnostics: a sampling profiler and an event-loop lag monitor.
+#
+# The profiler samples every thread's stack with sys._current_frames() from a
+# helper thread (the event loop thread shows up while it runs sync code such as
+# SQLite or PBKDF2; worker threads show threadpool handlers), and samples the
+# await stacks of suspended asyncio tasks from inside the loop. Stacks are
+# returned in collapsed "frame;frame;frame count" form, which flamegraph.pl and
+# speedscope read directly.
+#
+# The lag monitor is a heartbeat coroutine plus a watchdog thread. When the
+# heartbeat is late by more than LOOP_LAG_THRESHOLD_MS the watchdog logs the
+# loop thread's current stack, i.e. whatever is blocking it.
+
+log = logging.getLogger("notch.loop")
+
+_profile_lock = threading.Lock()
+
+_beat = 0.0
+_loop_thread_id: int | None = None
+_lag_stats: dict[str, Any] = {"blocks": 0, "max_ms": 0.0, "last": None}
+
+
+def _frame_name(filename: str, name: str, lineno: int | None) -> str:
+    short = os.path.join(os.path.basename(os.path.dirname(filename)), os.path.basename(filename))
+    return f"{name} ({short}:{lineno})" if lineno else f"{name} ({short})"
+
+
+def _collapse(frame) -> str:
+    parts = [_frame_name(fs.filename, fs.name, fs.lineno) for fs in traceback.extract_stack(frame)]
+    return ";".join(parts)
+
+
+def _thread_names() -> dict[int, str]:
+    return {t.ident: t.name for t in threading.enumerate() if t.ident is not None}
+
+
+def _task_stack(task: asyncio.Task) -> str | None:
+    coro = task.get_coro()
+    parts: list[str] = []
+    # Walk the await chain from the outermost coroutine inward.
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        parts.append(_frame_name(frame.f_code.co_filename, frame.f_code.co_name, frame.f_lineno))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if not parts:
+        return None
+    return "task:" + (task.get_name() or "?") + ";" + ";".join(parts)
+
+
+async def profile(seconds: float, interval_ms: float = 5.0) -> dict[str, Any]:
+    """Sample all threads and asyncio tasks for `seconds`. One profile at a time."""
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("profile already running")
+    try:
+        seconds = max(0.1, min(float(seconds), float(settings.PROFILE_MAX_SECONDS)))
+        interval = max(0.001, float(interval_ms) / 1000)
+        stacks: Counter[str] = Counter()
+        tasks: Counter[str] = Counter()
+        stop = threading.Event()
+        counts = {"thread_samples": 0, "task_samples": 0}
+        sampler_id: list[int] = []
+
+        def _sample_threads() -> None:
+            sampler_id.append(threading.get_ident())
+            while not stop.is_set():
+                names = _thread_names()
+                for tid, frame in sys._current_frames().items():
+                    if tid == sampler_id[0]:
+                        continue
+                    stacks[f"thread:{names.get(tid, tid)};" + _collapse(frame)] += 1
+                counts["thread_samples"] += 1
+                stop.wait(interval)
+
+        t = threading.Thread(target=_sample_threads, name="notch-profiler", daemon=True)
+        t0 = time.perf_counter()
+        t.start()
+        try:
+            current = asyncio.current_task()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for task in asyncio.all_tasks():
+                    if task is current or task.done():
+                        continue
+                    s = _task_stack(task)
+                    if s:
+                        tasks[s] += 1
+                counts["task_samples"] += 1
+                await asyncio.sleep(interval)
+        finally:
+            stop.set()
+            await asyncio.to_thread(t.join)
+
+        merged = stacks + tasks
+        return {
+            "seconds": round(time.perf_counter() - t0, 3),
+            "interval_ms": interval * 1000,
+            **counts,
+            "collapsed": "\n".join(f"{s} {n}" for s, n in merged.most_common()) + "\n",
+            "top": [{"stack": s, "samples": n} for s, n in stacks.most_common(20)],
+            "top_tasks": [{"stack": s, "samples": n} for s, n in tasks.most_common(20)],
+        }
+    finally:
+        _profile_lock.release()
+
+
+async def lag_monitor() -> None:
+    """Heartbeat for the watchdog; also records loop lag in metrics."""
+    global _beat, _loop_thread_id
+    _loop_thread_id = threading.get_ident()
+    interval = 0.1
+    threading.Thread(target=_watchdog, name="notch-loop-watchdog", daemon=True).start()
+    while True:
+        t0 = time.monotonic()
+        _beat = t0
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - t0 - interval)
+        event_loop_lag.observe(lag)
+
+
+def _watchdog() -> None:
+    threshold = float(settings.LOOP_LAG_THRESHOLD_MS) / 1000
+    reported = 0.0
+    while True:
+        time.sleep(max(0.01, threshold / 4))
+        beat = _beat
+        if not beat or beat == reported:
+            continue
+        # A beat comes every 0.1s; anything later than that + threshold is a block.
+        blocked = time.monotonic() - beat - 0.1
+        if blocked < threshold:
+            continue
+        reported = beat
+        frame = sys._current_frames().get(_loop_thread_id or 0)
+        stack = "".join(traceback.format_stack(frame)[-12:]) if frame is not None else "(no frame)"
+        ms = blocked * 1000
+        event_loop_blocks.inc()
+        _lag_stats["blocks"] += 1
+        _lag_stats["last"] = {"at": int(time.time()), "blocked_ms": round(ms, 1), "stack": stack}
+        _lag_stats["max_ms"] = max(_lag_stats["max_ms"], round(ms, 1))
+        log.warning("event loop blocked for %.0fms+ (threshold %.0fms), loop thread is in:\n%s", ms, threshold * 1000, stack)
+
+
+def lag_stats() -> dict[str, Any]:
+    return {
+        "enabled": settings.LOOP_LAG_MONITOR_ENABLED,
+        "threshold_ms": settings.LOOP_LAG_THRESHOLD_MS,
+        **_lag_stats,
+    }
@@ -0,0 +1,214 @@
+"""Query plan regression check.
+
+Runs EXPLAIN QUERY PLAN for every statement the modules issue against a fresh
+schema and fails if any of them fully scans a large table.
+
+    python -m notch.queryplan
+
+Statements are the modules' own SQL constants and builders, so a query is
+checked as it is actually issued. When a module starts issuing a new one,
+export it (a *_SQL constant or a builder) and add it to queries().
+"""
+from __future__ import annotations
+
+import itertools
+import re
+import sqlite3
+import sys
+
+from .schema import migrate
+
+# Tables that grow with usage. A full scan of any of these is a regression.
+LARGE_TABLES = {
+    "todos",
+    "notes",
+    "todo_lists",
+    "note_groups",
+    "sessions",
+    "outbox_notifications",
+    "note_shares",
+    "item_shares",
+    "todos_archive",
+    "notes_archive",
+    "idempotency_keys",
+    "item_counts",
+}
+
+_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+
+def queries() -> list[tuple[str, str]]:
+    """(name, SQL) for every statement, taken from the modules that issue it."""
+    from . import agenda
+    from . import app
+    from . import archive
+    from . import auth
+    from . import counts
+    from . import defaults
+    from . import ics
+    from . import idempotency
+    from . import lists
+    from . import metrics
+    from . import note_shares
+    from . import notes
+    from . import retention
+    from . import scheduler
+    from . import shares
+    from . import todos
+    from . import transfer
+
+    out: list[tuple[str, str]] = [
+        ("auth.session_user", auth.SESSION_USER_SQL),
+        ("auth.session_touch", auth.SESSION_TOUCH_SQL),
+        ("auth.directory", auth.DIRECTORY_SQL),
+        ("app.login", app.LOGIN_SQL),
+        ("app.user_by_id", app.USER_SQL),
+        ("defaults.backfill", defaults.BACKFILL_SQL),
+        ("note_shares.by_token", note_shares.BY_TOKEN_SQL),
+        ("note_shares.note", note_shares.NOTE_SQL),
+        ("note_shares.save", note_shares.save_sql(["title", "body_md"])),
+        ("lists.by_id", lists.BY_ID_SQL),
+        ("lists.update", lists.update_sql(["name=?", "shared_with=?", "updated_at=?"])),
+        ("lists.reassign_todos", lists.REASSIGN_TODOS_SQL),
+        ("lists.reassign_archived", lists.REASSIGN_ARCHIVED_SQL),
+        ("lists.delete", lists.DELETE_SQL),
+        ("lists.list", lists.LIST_SQL),
+        ("notes.by_id", notes.BY_ID_SQL),
+        ("notes.update", notes.update_sql(["title=?", "body_md=?", "updated_at=?", "version=version+1"])),
+        ("notes.trash", notes.TRASH_SQL),
+        ("notes.restore", notes.RESTORE_SQL),
+        ("notes.group_by_id", notes.GROUP_BY_ID_SQL),
+        ("notes.group_update", notes.group_update_sql(["name=?", "shared_with=?", "updated_at=?"])),
+        ("notes.list_groups", notes.LIST_GROUPS_SQL),
+        ("todos.by_id", todos.BY_ID_SQL),
+        ("todos.update", todos.update_sql(["title=?", "done=?", "updated_at=?", "version=version+1"])),
+        ("todos.trash", todos.TRASH_SQL),
+        ("todos.restore", todos.RESTORE_SQL),
+        ("todos.purge", todos.PURGE_SQL),
+        ("scheduler.due", scheduler.DUE_SQL),
+        ("scheduler.mark_sent", scheduler.MARK_SENT_SQL),
+        ("scheduler.advance", scheduler.ADVANCE_SQL),
+        ("scheduler.flush", scheduler.flush_sql(0)),
+        ("scheduler.flush waiting", scheduler.flush_sql(2)),
+        ("scheduler.outbox_sent", scheduler.outbox_sent_sql(2)),
+        ("scheduler.outbox_failed", scheduler.outbox_failed_sql(2)),
+        ("scheduler.release_digest", scheduler.RELEASE_DIGEST_SQL),
+        ("retention.sessions", retention.PURGE_SESSIONS_SQL),
+        ("retention.note_shares", retention.PURGE_NOTE_SHARES_SQL),
+        ("retention.idempotency_keys", retention.PURGE_IDEMPOTENCY_KEYS_SQL),
+        ("retention.outbox", retention.PURGE_OUTBOX_SQL),
+        ("idempotency.release", idempotency.RELEASE_SQL),
+        ("idempotency.reserve", idempotency.RESERVE_SQL),
+        ("idempotency.get", idempotency.GET_SQL),
+        ("idempotency.delete", idempotency.DELETE_SQL),
+        ("idempotency.store", idempotency.STORE_SQL),
+        ("metrics.outbox_pending", metrics.OUTBOX_PENDING_SQL),
+        ("metrics.reminders_due", metrics.REMINDERS_DUE_SQL),
+        ("ics.token_user", ics.TOKEN_USER_SQL),
+        ("ics.get_token", ics.GET_TOKEN_SQL),
+        ("ics.set_token", ics.SET_TOKEN_SQL),
+        ("counts.ready", counts.READY_SQL),
+        ("counts.mark_ready", counts.MARK_READY_SQL),
+        ("counts.reset", counts.RESET_SQL),
+        ("counts.get", counts.GET_SQL),
+        ("shares.clear", shares.CLEAR_SQL),
+        ("shares.insert", shares.INSERT_SQL),
+        ("shares.viewers", shares.viewers_sql(2)),
+    ]
+    for table, column in (("todo_lists", "inbox_list_id"), ("note_groups", "general_group_id")):
+        for i, sql in enumerate(defaults.provision_queries(table, column)):
+            out.append((f"defaults.provision {table} {i}", sql))
+    for table in ("todos", "notes", "todos_archive", "notes_archive"):
+        for i, sql in enumerate(retention.trash_queries(table, 2)):
+            out.append((f"retention.trash {table} {i}", sql))
+    for kind in shares.KINDS:
+        out.append((f"shares.backfill {kind}", shares.backfill_sql(kind)))
+    for table, (archive_table, cols) in archive._TABLES.items():
+        out.append((f"archive.exists {table}", archive.archived_sql(table, "1")))
+        out.append((f"archive.get {table}", archive.archived_sql(table)))
+        for stamp, (src, dst) in ((True, (table, archive_table)), (False, (archive_table, table))):
+            for i, sql in enumerate(archive.move_queries(src, dst, cols, 2, stamp)):
+                out.append((f"archive.move {src} {i}", sql))
+    for name, table, where, _ in archive._policies():
+        out.append((f"archive.candidates {name}", archive.candidates_sql(table, where)))
+    for table in ("todos", "todos_archive"):
+        out.append((f"todos.visible {table}", f"SELECT * FROM {table} WHERE id=? AND {todos.VISIBLE_SQL}"))
+    for table in ("notes", "notes_archive"):
+        out.append((f"notes.visible {table}", f"SELECT * FROM {table} WHERE id=? AND {notes.VISIBLE_SQL}"))
+    for done, lst, inc_del, del_only, q, dig in itertools.product((False, True), repeat=6):
+        sql, _ = todos._list_sql(
+            user_id="u",
+            query="x" if q else None,
+            include_done=done,
+            list_id="l" if lst else None,
+            include_deleted=inc_del,
+            deleted_only=del_only,
+            limit=200,
+            digest_id="d" if dig else None,
+        )
+        out.append((f"todos.list done={done} list={lst} inc_del={inc_del} del_only={del_only} q={q} digest={dig}", sql))
+    for grp, inc_del, del_only, q in itertools.product((False, True), repeat=4):
+        sql, _ = notes._list_sql(
+            user_id="u",
+            query="x" if q else None,
+            group_id="g" if grp else None,
+            include_deleted=inc_del,
+            deleted_only=del_only,
+            limit=200,
+        )
+        out.append((f"notes.list group={grp} inc_del={inc_del} del_only={del_only} q={q}", sql))
+    for col in ("due_at", "remind_at"):
+        out.append((f"agenda.range {col}", agenda.range_sql(col)))
+    for i, sql in enumerate(counts.init_sql()):
+        out.append((f"counts.init {i}", sql))
+    # Trigger bodies, with the NEW/OLD row values as parameters.
+    for stmt in counts.trigger_sql():
+        name = stmt.split()[5]
+        body = stmt.split(" BEGIN ", 1)[1].rsplit(" END", 1)[0]
+        for i, sql in enumerate(s for s in body.split(";") if s.strip()):
+            out.append((f"counts.{name} {i}", re.sub(r"\b(?:NEW|OLD)\.\w+", "?", sql)))
+    for kind in ("list", "group", "todo", "note"):
+        for i, sql in enumerate(transfer.export_queries(kind)):
+            out.append((f"transfer.export {kind} {i}", sql))
+    return out
+
+
+def fresh_db() -> sqlite3.Connection:
+    con = sqlite3.connect(":memory:")
+    migrate(con)
+    return con
+
+
+def full_scans(con: sqlite3.Connection, sql: str) -> list[str]:
+    """Return the large tables that `sql` scans in full."""
+    rows = con.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")).fetchall()
+    scanned = []
+    for r in rows:
+        m = _SCAN_RE.match(r[3])
+        if m and m.group(1) in LARGE_TABLES:
+            scanned.append(m.group(1))
+    return scanned
+
+
+def check() -> list[tuple[str, list[str]]]:
+    con = fresh_db()
+    failures = []
+    for name, sql in queries():
+        scanned = full_scans(con, sql)
+        if scanned:
+            failures.append((name, scanned))
+    return failures
+
+
+def main() -> int:
+    failures = check()
+    for name, scanned in failures:
+        print(f"FULL SCAN {','.join(scanned)}: {name}")
+    if failures:
+        return 1
+    print("query plans ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
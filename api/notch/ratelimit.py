@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import threading
+import time
+
+# In-process, per-key limiters. State lives in this process only, which is fine
+# for a single-container deployment; keys are pruned so memory stays bounded.
+
+
+class TokenBucket:
+    """Per-key token buckets: bursts of up to `capacity`, refilled at `per_minute`."""
+
+    def __init__(self, capacity: float, per_minute: float, max_keys: int = 10000):
+        self.capacity = max(1.0, float(capacity))
+        self.rate = max(0.0, float(per_minute)) / 60.0
+        self.max_keys = max_keys
+        self._buckets: dict[str, tuple[float, float]] = {}  # key -> (tokens, updated at)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, n: float = 1.0) -> float:
+        """Take `n` tokens. Returns 0 if allowed, else seconds until they are available."""
+        t = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.capacity, t))
+            tokens = min(self.capacity, tokens + (t - last) * self.rate)
+            if tokens >= n:
+                self._buckets[key] = (tokens - n, t)
+                if len(self._buckets) > self.max_keys:
+                    self._prune(t)
+                return 0.0
+            self._buckets[key] = (tokens, t)
+            if self.rate <= 0:
+                return 60.0
+            return (n - tokens) / self.rate
+
+    def _prune(self, t: float) -> None:
+        # Drop buckets that have refilled completely; they hold no state.
+        full = [k for k, (tok, last) in self._buckets.items() if tok + (t - last) * self.rate >= self.capacity]
+        for k in full:
+            del self._buckets[k]
+        # Still too many (e.g. an address sweep): drop the oldest.
+        if len(self._buckets) > self.max_keys:
+            for k, _ in sorted(self._buckets.items(), key=lambda kv: kv[1][1])[: len(self._buckets) - self.max_keys]:
+                del self._buckets[k]
+
+
+class ConcurrencyLimit:
+    """At most `limit` concurrent holders per key."""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, int(limit))
+        self._active: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str) -> bool:
+        with self._lock:
+            n = self._active.get(key, 0)
+            if n >= self.limit:
+                return False
+            self._active[key] = n + 1
+            return True
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            n = self._active.get(key, 0) - 1
+            if n > 0:
+                self._active[key] = n
+            else:
+                self._active.pop(key, None)
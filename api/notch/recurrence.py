@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import calendar
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from .settings import settings
+
+# Recurring todos.
+#
+# todos.recur holds an iCalendar-style rule anchored at the todo's first
+# reminder, e.g.
+#
+#     DTSTART;TZID=America/Los_Angeles:20260105T090000
+#     RRULE:FREQ=WEEKLY;BYDAY=MO,TH
+#
+# Only the next occurrence is ever materialized: the scheduler moves remind_at
+# to it after each fire (and completing the todo does the same), so a weekly
+# chore stays one row and the pending-reminder index only holds what is due next.
+#
+# Supported: FREQ=DAILY|WEEKLY|MONTHLY|YEARLY, INTERVAL, BYDAY (WEEKLY only) and
+# UNTIL. Occurrences keep the wall-clock time of DTSTART in its time zone, so
+# 09:00 stays 09:00 across DST changes. Monthly/yearly rules skip months without
+# the anchor's day (the 31st, Feb 29th), like RFC 5545.
+
+FREQS = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+DAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+MAX_INTERVAL = 1000
+# Upper bound on candidate occurrences examined per lookup.
+_MAX_STEPS = 2000
+
+
+def _parse_until(v: str, tz: ZoneInfo) -> int:
+    if len(v) == 8:
+        # A bare date includes that whole day.
+        d = datetime.strptime(v, "%Y%m%d").date() + timedelta(days=1)
+        return int(datetime.combine(d, datetime.min.time(), tz).timestamp()) - 1
+    if v.endswith("Z"):
+        return int(datetime.strptime(v, "%Y%m%dT%H%M%SZ").replace(tzinfo=ZoneInfo("UTC")).timestamp())
+    return int(datetime.strptime(v, "%Y%m%dT%H%M%S").replace(tzinfo=tz).timestamp())
+
+
+def parse_rule(text: str) -> dict:
+    """Parse the RRULE part ("FREQ=WEEKLY;BYDAY=MO", optional "RRULE:" prefix).
+
+    Raises ValueError with a message fit for a 400.
+    """
+    body = text.strip()
+    if body.upper().startswith("RRULE:"):
+        body = body[6:]
+    parts: dict[str, str] = {}
+    for part in body.split(";"):
+        if not part.strip():
+            continue
+        k, sep, v = part.partition("=")
+        if not sep:
+            raise ValueError(f"expected KEY=VALUE, got {part!r}")
+        parts[k.strip().upper()] = v.strip().upper()
+
+    freq = parts.pop("FREQ", "")
+    if freq not in FREQS:
+        raise ValueError(f"FREQ must be one of {', '.join(FREQS)}")
+    rule: dict = {"freq": freq, "interval": 1, "byday": (), "until": None}
+    if "INTERVAL" in parts:
+        v = parts.pop("INTERVAL")
+        if not v.isdigit() or not 1 <= int(v) <= MAX_INTERVAL:
+            raise ValueError(f"INTERVAL must be 1..{MAX_INTERVAL}")
+        rule["interval"] = int(v)
+    if "BYDAY" in parts:
+        days = [d.strip() for d in parts.pop("BYDAY").split(",") if d.strip()]
+        if freq != "WEEKLY" or not days or any(d not in DAYS for d in days):
+            raise ValueError("BYDAY takes MO..SU and needs FREQ=WEEKLY")
+        rule["byday"] = tuple(sorted({DAYS.index(d) for d in days}))
+    if "UNTIL" in parts:
+        rule["until"] = parts.pop("UNTIL")
+        try:
+            _parse_until(rule["until"], ZoneInfo("UTC"))
+        except ValueError:
+            raise ValueError("UNTIL must be YYYYMMDD or YYYYMMDDTHHMMSSZ")
+    if "COUNT" in parts:
+        raise ValueError("COUNT is not supported; use UNTIL")
+    if parts:
+        raise ValueError(f"unsupported rule part: {', '.join(sorted(parts))}")
+    return rule
+
+
+def format_rule(rule: dict) -> str:
+    out = [f"FREQ={rule['freq']}"]
+    if rule["interval"] != 1:
+        out.append(f"INTERVAL={rule['interval']}")
+    if rule["byday"]:
+        out.append("BYDAY=" + ",".join(DAYS[d] for d in rule["byday"]))
+    if rule["until"]:
+        out.append(f"UNTIL={rule['until']}")
+    return "RRULE:" + ";".join(out)
+
+
+def split(recur: str) -> tuple[str | None, str]:
+    """(DTSTART line or None, RRULE text) of a stored or client-sent rule."""
+    dtstart = None
+    rrule = []
+    for line in recur.strip().splitlines():
+        if line.strip().upper().startswith("DTSTART"):
+            dtstart = line.strip()
+        elif line.strip():
+            rrule.append(line.strip())
+    return dtstart, ";".join(rrule)
+
+
+def anchored(recur: str, remind_at: int) -> str:
+    """Validate a rule and anchor it at `remind_at` in settings.TZ (the stored form)."""
+    _, rrule = split(recur)
+    rule = format_rule(parse_rule(rrule))
+    tz = settings.TZ
+    start = datetime.fromtimestamp(int(remind_at), ZoneInfo(tz)).strftime("%Y%m%dT%H%M%S")
+    return f"DTSTART;TZID={tz}:{start}\n{rule}"
+
+
+def ical_rrule(recur: str) -> str:
+    """The RRULE line of a stored rule as calendar apps expect it (UNTIL in UTC)."""
+    dtstart, rrule = split(recur)
+    rule = parse_rule(rrule)
+    if rule["until"] and not rule["until"].endswith("Z"):
+        tz = _start(dtstart).tzinfo if dtstart else ZoneInfo("UTC")
+        until = datetime.fromtimestamp(_parse_until(rule["until"], tz), ZoneInfo("UTC"))
+        rule["until"] = until.strftime("%Y%m%dT%H%M%SZ")
+    return format_rule(rule)
+
+
+def _start(dtstart: str) -> datetime:
+    head, _, value = dtstart.partition(":")
+    tz = ZoneInfo("UTC")
+    for param in head.split(";")[1:]:
+        k, _, v = param.partition("=")
+        if k.upper() == "TZID":
+            tz = ZoneInfo(v)
+    if value.endswith("Z"):
+        return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=ZoneInfo("UTC"))
+    return datetime.strptime(value, "%Y%m%dT%H%M%S").replace(tzinfo=tz)
+
+
+def _add_months(d: date, months: int) -> date | None:
+    y, m = divmod(d.month - 1 + months, 12)
+    y += d.year
+    if d.day > calendar.monthrange(y, m + 1)[1]:
+        return None
+    return d.replace(year=y, month=m + 1, day=d.day)
+
+
+def _candidates(rule: dict, start: datetime, after: datetime):
+    """Occurrence dates from the first period that can hold one after `after`."""
+    d0 = start.date()
+    n = rule["interval"]
+    freq = rule["freq"]
+    if freq == "DAILY":
+        k = max(0, (after.date() - d0).days // n - 1)
+        while True:
+            yield d0 + timedelta(days=k * n)
+            k += 1
+    elif freq == "WEEKLY":
+        week0 = d0 - timedelta(days=d0.weekday())
+        days = rule["byday"] or (d0.weekday(),)
+        k = max(0, (after.date() - week0).days // (7 * n) - 1)
+        while True:
+            week = week0 + timedelta(weeks=k * n)
+            for wd in days:
+                d = week + timedelta(days=wd)
+                if d >= d0:
+                    yield d
+            k += 1
+    else:
+        step = n if freq == "MONTHLY" else 12 * n
+        months = (after.year - d0.year) * 12 + after.month - d0.month
+        k = max(0, months // step - 1)
+        while True:
+            d = _add_months(d0, k * step)
+            if d is not None:
+                yield d
+            k += 1
+
+
+def next_after(recur: str, after: int) -> int | None:
+    """First occurrence of a stored rule strictly after `after`, or None once it has ended."""
+    dtstart, rrule = split(recur)
+    if not dtstart:
+        return None
+    rule = parse_rule(rrule)
+    start = _start(dtstart)
+    tz = start.tzinfo
+    until = _parse_until(rule["until"], tz) if rule["until"] else None
+    after_dt = datetime.fromtimestamp(int(after), tz)
+    for i, d in enumerate(_candidates(rule, start, after_dt)):
+        if i >= _MAX_STEPS:
+            return None
+        ts = int(datetime.combine(d, start.timetz().replace(tzinfo=None), tz).timestamp())
+        if until is not None and ts > until:
+            return None
+        if ts > after:
+            return ts
+    return None
+
+
+def advance(todo: dict, after: int) -> dict | None:
+    """Field updates moving a recurring todo to its first occurrence after `after`.
+
+    None once the rule has ended (or can't be read), i.e. the todo behaves like
+    a one-off from then on. due_at keeps its offset from remind_at.
+    """
+    try:
+        nxt = next_after(todo["recur"], after)
+    except (ValueError, KeyError):
+        return None
+    if nxt is None:
+        return None
+    out = {"remind_at": nxt, "remind_sent_at": None}
+    if todo.get("due_at") is not None and todo.get("remind_at") is not None:
+        out["due_at"] = int(todo["due_at"]) + nxt - int(todo["remind_at"])
+    return out
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any
+
+from .db import tx
+from .settings import settings
+
+# Retention policies, run from the maintenance loop every RETENTION_INTERVAL_SECONDS.
+#
+# Rows are deleted RETENTION_BATCH_SIZE at a time, each batch in its own short
+# transaction with a yield in between, so a large backlog never holds the write
+# lock for long. RETENTION_OUTBOX_DAYS / RETENTION_TRASH_DAYS of 0 keep rows
+# forever; expired sessions and share links are always purged once
+# RETENTION_EXPIRED_GRACE_DAYS have passed since expiry, idempotency keys as
+# soon as they expire.
+
+PURGE_SESSIONS_SQL = "DELETE FROM sessions WHERE rowid IN (SELECT rowid FROM sessions WHERE expires_at <= ? LIMIT ?)"
+PURGE_NOTE_SHARES_SQL = (
+    "DELETE FROM note_shares WHERE rowid IN (SELECT rowid FROM note_shares WHERE expires_at <= ? LIMIT ?)"
+)
+PURGE_IDEMPOTENCY_KEYS_SQL = (
+    "DELETE FROM idempotency_keys WHERE (user_id, service, key) IN"
+    " (SELECT user_id, service, key FROM idempotency_keys WHERE expires_at <= ? LIMIT ?)"
+)
+# Pending rows are never purged; only delivery history ages out.
+PURGE_OUTBOX_SQL = (
+    "DELETE FROM outbox_notifications WHERE rowid IN (SELECT rowid FROM outbox_notifications"
+    " WHERE status IN ('sent','error') AND created_at <= ? LIMIT ?)"
+)
+
+
+def trash_queries(table: str, n: int) -> list[str]:
+    """(old Trash ids, delete rows, delete their item_shares) for `n` ids."""
+    marks = ",".join("?" for _ in range(n))
+    return [
+        f"SELECT id FROM {table} WHERE deleted_at IS NOT NULL AND deleted_at <= ? LIMIT ?",
+        f"DELETE FROM {table} WHERE id IN ({marks})",
+        f"DELETE FROM item_shares WHERE kind=? AND item_id IN ({marks})",
+    ]
+
+
+_next_run = 0.0
+_last_report: dict[str, Any] | None = None
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def _days(n: int) -> int:
+    return int(n) * 86400
+
+
+def _purge_sessions(cutoff: int, batch: int) -> int:
+    with tx() as con:
+        cur = con.execute(PURGE_SESSIONS_SQL, (cutoff, batch))
+        return cur.rowcount
+
+
+def _purge_note_shares(cutoff: int, batch: int) -> int:
+    with tx() as con:
+        cur = con.execute(PURGE_NOTE_SHARES_SQL, (cutoff, batch))
+        return cur.rowcount
+
+
+def _purge_idempotency_keys(cutoff: int, batch: int) -> int:
+    with tx() as con:
+        cur = con.execute(PURGE_IDEMPOTENCY_KEYS_SQL, (cutoff, batch))
+        return cur.rowcount
+
+
+def _purge_outbox(cutoff: int, batch: int) -> int:
+    with tx() as con:
+        cur = con.execute(PURGE_OUTBOX_SQL, (cutoff, batch))
+        return cur.rowcount
+
+
+def _purge_trash(table: str, kind: str, cutoff: int, batch: int) -> int:
+    with tx() as con:
+        rows = con.execute(trash_queries(table, 0)[0], (cutoff, batch)).fetchall()
+        ids = [r["id"] for r in rows]
+        if not ids:
+            return 0
+        _, delete_rows, delete_shares = trash_queries(table, len(ids))
+        con.execute(delete_rows, ids)
+        con.execute(delete_shares, [kind, *ids])
+        return len(ids)
+
+
+def _policies() -> list[tuple[str, int | None, Any]]:
+    """(name, retention days or None to keep forever, purge fn(cutoff, batch))."""
+    outbox_days = int(settings.RETENTION_OUTBOX_DAYS) or None
+    trash_days = int(settings.RETENTION_TRASH_DAYS) or None
+    return [
+        ("sessions", int(settings.RETENTION_EXPIRED_GRACE_DAYS), _purge_sessions),
+        ("note_shares", int(settings.RETENTION_EXPIRED_GRACE_DAYS), _purge_note_shares),
+        ("idempotency_keys", 0, _purge_idempotency_keys),
+        ("outbox_notifications", outbox_days, _purge_outbox),
+        ("todos_trash", trash_days, lambda c, b: _purge_trash("todos", "todo", c, b)),
+        ("notes_trash", trash_days, lambda c, b: _purge_trash("notes", "note", c, b)),
+        ("todos_archive_trash", trash_days, lambda c, b: _purge_trash("todos_archive", "todo", c, b)),
+        ("notes_archive_trash", trash_days, lambda c, b: _purge_trash("notes_archive", "note", c, b)),
+    ]
+
+
+def table_counts() -> dict[str, int]:
+    with tx() as con:
+        return {
+            "sessions": con.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "note_shares": con.execute("SELECT COUNT(*) FROM note_shares").fetchone()[0],
+            "idempotency_keys": con.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0],
+            "outbox_notifications": con.execute("SELECT COUNT(*) FROM outbox_notifications").fetchone()[0],
+            "todos_trash": con.execute("SELECT COUNT(*) FROM todos WHERE deleted_at IS NOT NULL").fetchone()[0],
+            "notes_trash": con.execute("SELECT COUNT(*) FROM notes WHERE deleted_at IS NOT NULL").fetchone()[0],
+            "todos_archive_trash": con.execute("SELECT COUNT(*) FROM todos_archive WHERE deleted_at IS NOT NULL").fetchone()[0],
+            "notes_archive_trash": con.execute("SELECT COUNT(*) FROM notes_archive WHERE deleted_at IS NOT NULL").fetchone()[0],
+        }
+
+
+async def run_once(pause: float = 0.01) -> dict[str, Any]:
+    """Apply every policy. Returns deleted row counts per policy."""
+    global _last_report
+    t0 = time.perf_counter()
+    batch = max(1, int(settings.RETENTION_BATCH_SIZE))
+    deleted: dict[str, int] = {}
+    for name, days, purge in _policies():
+        deleted[name] = 0
+        if days is None:
+            continue
+        cutoff = now() - _days(days)
+        while True:
+            n = purge(cutoff, batch)
+            deleted[name] += n
+            if n < batch:
+                break
+            await asyncio.sleep(pause)
+    _last_report = {
+        "at": now(),
+        "duration_ms": round((time.perf_counter() - t0) * 1000, 2),
+        "deleted": deleted,
+    }
+    return deleted
+
+
+async def run_due() -> bool:
+    global _next_run
+    if not settings.RETENTION_ENABLED:
+        return False
+    t = time.monotonic()
+    if t < _next_run:
+        return False
+    _next_run = t + float(settings.RETENTION_INTERVAL_SECONDS)
+    await run_once()
+    return True
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "enabled": settings.RETENTION_ENABLED,
+        "policies": {name: days for name, days, _ in _policies()},
+        "last_run": _last_report,
+        "rows": table_counts(),
+    }
@@ -1,12 +1,80 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import sqlite3
 import time
 import uuid
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
+from . import recurrence
+from .auth import user_by_id
 from .db import tx
+from .metrics import operation_latency, reminder_lag, reminder_pushes, reminders_delivered, reminders_processed
 from .ntfy import publish, topic_for_handle
 from .settings import settings
+from .shares import touch_todos
+
+# Reminder delivery goes through the outbox in two steps:
+#
+# 1. enqueue: every due todo becomes one outbox row per recipient, and the todo
+#    is marked sent (or moved to its next occurrence) in the same transaction.
+# 2. flush: pending rows are grouped per user. A user gets at most one push per
+#    NOTIFY_COALESCE_SECONDS, so a burst (everything due at 9:00) arrives as one
+#    digest that links to /app/todos?digest=<id>. Users with a daily digest hour
+#    have their rows held until that hour.
+#
+# A failed push leaves its rows pending and counts an attempt on each; the user
+# is retried after RETRY_SECONDS, doubling per attempt up to RETRY_MAX_SECONDS.
+# Rows that have failed MAX_ATTEMPTS times are marked 'error' (and purged by
+# retention like sent rows), so a dead topic is not retried forever.
+
+ENQUEUE_BATCH = 500
+MAX_ENQUEUE_BATCHES = 20
+DIGEST_TITLES = 10
+RETRY_SECONDS = 2
+RETRY_MAX_SECONDS = 600
+MAX_ATTEMPTS = 10
+
+FLUSH_LIMIT = 20000
+
+DUE_SQL = (
+    "SELECT * FROM todos WHERE done=0 AND remind_at IS NOT NULL AND remind_at <= ? AND remind_sent_at IS NULL"
+    " ORDER BY remind_at ASC LIMIT ?"
+)
+MARK_SENT_SQL = "UPDATE todos SET remind_sent_at=? WHERE id=?"
+ADVANCE_SQL = "UPDATE todos SET remind_at=?, due_at=?, updated_at=?, version=version+1 WHERE id=?"
+RELEASE_DIGEST_SQL = (
+    "UPDATE outbox_notifications SET send_after=created_at WHERE user_id=? AND status='pending' AND send_after>created_at"
+)
+
+
+def flush_sql(n: int) -> str:
+    """Pending rows that are due, skipping `n` users who must wait (params: now, the users, limit)."""
+    marks = ",".join("?" for _ in range(n))
+    return (
+        "SELECT id, user_id, topic, title, message, click_url, tags, created_at, send_after, attempts"
+        " FROM outbox_notifications WHERE status='pending' AND send_after <= ?"
+        f" AND user_id NOT IN ({marks}) ORDER BY send_after ASC LIMIT ?"
+    )
+
+
+def outbox_sent_sql(n: int) -> str:
+    marks = ",".join("?" for _ in range(n))
+    return f"UPDATE outbox_notifications SET status='sent', sent_at=?, digest_id=? WHERE id IN ({marks})"
+
+
+def outbox_failed_sql(n: int) -> str:
+    marks = ",".join("?" for _ in range(n))
+    return (
+        "UPDATE outbox_notifications SET last_error=?, attempts=attempts+1,"
+        f" status=CASE WHEN attempts+1 >= ? THEN 'error' ELSE status END WHERE id IN ({marks})"
+    )
+
+
+# user id -> earliest time of the next push (coalescing window or retry backoff).
+_next_push: dict[str, float] = {}
 
 
 def now() -> int:
@@ -25,6 +93,23 @@ def _loads_list(s: str | None) -> list[str]:
     return []
 
 
+_wake = asyncio.Event()
+
+
+def wake() -> None:
+    """Cut the current poll interval short (call from the event loop thread)."""
+    _wake.set()
+
+
+async def wait(timeout: float) -> None:
+    """Sleep until the next poll: `timeout` seconds or an earlier wake()."""
+    try:
+        await asyncio.wait_for(_wake.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    _wake.clear()
+
+
 async def run_once() -> int:
     """Find due reminders and send notifications.
 
@@ -33,33 +118,25 @@ async def run_once() -> int:
     if not settings.SCHEDULER_ENABLED:
         return 0
 
-    due = []
-    with tx() as con:
-        rows = con.execute(
-            """
-            SELECT * FROM todos
-            WHERE done=0
-              AND remind_at IS NOT NULL
-              AND remind_at <= ?
-              AND remind_sent_at IS NULL
-            ORDER BY remind_at ASC
-            LIMIT 25
-            """,
-            (now(),),
-        ).fetchall()
-        due = [dict(r) for r in rows]
+    t0 = time.perf_counter()
+    try:
+        return await _run_once()
+    finally:
+        operation_latency.observe(time.perf_counter() - t0, op="scheduler_run_once")
+
 
+async def _run_once() -> int:
     processed = 0
-    for todo in due:
-        processed += 1
-        await _notify_for_todo(todo)
+    for _ in range(MAX_ENQUEUE_BATCHES):
+        n = _enqueue_due()
+        processed += n
+        if n < ENQUEUE_BATCH:
+            break
+    await _flush()
     return processed
 
 
-async def _notify_for_todo(todo: dict) -> None:
-    todo_id = todo["id"]
-
-    # Determine recipients (user ids)
+def _recipients(todo: dict) -> list[str]:
     # If assigned_to is set AND shared_with has entries, notify everyone.
     recipients_set: set[str] = set()
     if todo.get("assigned_to"):
@@ -67,65 +144,125 @@ async def _notify_for_todo(todo: dict) -> None:
     for uid in _loads_list(todo.get("shared_with")):
         if uid:
             recipients_set.add(str(uid))
-    recipients: list[str] = [r for r in recipients_set if r]
+    return sorted(r for r in recipients_set if r)
 
-    # If nobody to notify, mark sent so we don't loop.
-    if not recipients:
-        with tx() as con:
-            con.execute("UPDATE todos SET remind_sent_at=? WHERE id=?", (now(), todo_id))
-        return
 
-    # Resolve handles
+def next_digest_at(hour: int, t: int) -> int:
+    """The next `hour`:00 in settings.TZ after `t`."""
+    tz = ZoneInfo(settings.TZ)
+    local = datetime.fromtimestamp(t, tz)
+    at = local.replace(hour=int(hour) % 24, minute=0, second=0, microsecond=0)
+    if at.timestamp() <= t:
+        at = datetime.combine(at.date() + timedelta(days=1), at.time(), tz)
+    return int(at.timestamp())
+
+
+def _enqueue_due() -> int:
+    """Move one batch of due reminders into the outbox. Returns todos handled."""
+    t = now()
     with tx() as con:
-        user_rows = con.execute(
-            f"SELECT id,handle,display_name FROM users WHERE id IN ({','.join('?' for _ in recipients)})",
-            recipients,
-        ).fetchall()
-        users = {r["id"]: dict(r) for r in user_rows}
-
-    title = "Reminder"
-    message = (todo.get("title") or "").strip() or "(untitled)"
-    click = settings.APP_BASE_URL.rstrip("/") + f"/app/todos/{todo_id}"
-
-    any_error = False
-    last_error = None
-
-    for uid in recipients:
-        u = users.get(uid)
-        if not u:
-            continue
-        topic = topic_for_handle(u["handle"])
-        outbox_id = str(uuid.uuid4())
-        t = now()
-        with tx() as con:
-            con.execute(
-                """
-                INSERT INTO outbox_notifications(id,user_id,topic,title,message,click_url,priority,tags,status,last_error,created_at,sent_at)
-                VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
-                """,
-                (outbox_id, uid, topic, title, message, click, None, json.dumps(["todo"], ensure_ascii=False), "pending", None, t, None),
-            )
-
-        try:
-            await publish(topic=topic, title=title, message=message, click_url=click, tags=["todo"])
-            with tx() as con:
-                con.execute(
-                    "UPDATE outbox_notifications SET status=?, sent_at=? WHERE id=?",
-                    ("sent", now(), outbox_id),
-                )
-        except Exception as exc:
-            any_error = True
-            last_error = str(exc)
-            with tx() as con:
-                con.execute(
-                    "UPDATE outbox_notifications SET status=?, last_error=? WHERE id=?",
-                    ("error", last_error, outbox_id),
+        rows = con.execute(DUE_SQL, (t, ENQUEUE_BATCH)).fetchall()
+        if not rows:
+            return 0
+        digest_hours = {
+            r["id"]: r["digest_hour"]
+            for r in con.execute("SELECT id, digest_hour FROM users WHERE digest_hour IS NOT NULL")
+        }
+        tags = json.dumps(["todo"], ensure_ascii=False)
+        base = settings.APP_BASE_URL.rstrip("/")
+        outbox = []
+        for r in rows:
+            todo = dict(r)
+            reminders_processed.inc()
+            message = (todo.get("title") or "").strip() or "(untitled)"
+            click = base + f"/app/todos/{todo['id']}"
+            for uid in _recipients(todo):
+                u = user_by_id(uid)
+                if not u:
+                    continue
+                hour = digest_hours.get(uid)
+                send_after = int(todo["remind_at"]) if hour is None else next_digest_at(hour, t)
+                outbox.append(
+                    (str(uuid.uuid4()), uid, topic_for_handle(u["handle"]), "Reminder", message, click, None, tags,
+                     "pending", None, t, None, todo["id"], send_after)
                 )
+            _mark_sent(con, todo, t)
+        con.executemany(
+            """
+            INSERT INTO outbox_notifications(id,user_id,topic,title,message,click_url,priority,tags,status,last_error,created_at,sent_at,todo_id,send_after)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            outbox,
+        )
+    return len(rows)
 
-    if not any_error:
-        with tx() as con:
-            con.execute("UPDATE todos SET remind_sent_at=? WHERE id=?", (now(), todo_id))
+
+def _mark_sent(con: sqlite3.Connection, todo: dict, t: int) -> None:
+    """Mark a reminder sent; a recurring todo moves on to its next occurrence instead."""
+    nxt = recurrence.advance(todo, max(t, int(todo["remind_at"]))) if todo.get("recur") else None
+    if nxt is None:
+        con.execute(MARK_SENT_SQL, (t, todo["id"]))
     else:
-        # Leave unsent so we can retry later; but avoid hammering: push it forward a bit.
+        con.execute(ADVANCE_SQL, (nxt["remind_at"], nxt.get("due_at", todo.get("due_at")), t, todo["id"]))
+        touch_todos(con, [todo["id"]])
+
+
+async def _flush() -> None:
+    """Send pending outbox rows, one push per user."""
+    t = now()
+    # Users in a coalescing window or retry backoff are left out in SQL, so a
+    # large backlog of one failing user can't fill FLUSH_LIMIT.
+    clock = time.time()
+    for uid in [u for u, at in _next_push.items() if at <= clock]:
+        del _next_push[uid]
+    waiting = list(_next_push)
+    with tx() as con:
+        rows = [dict(r) for r in con.execute(flush_sql(len(waiting)), (t, *waiting, FLUSH_LIMIT))]
+    by_user: dict[str, list[dict]] = {}
+    for r in rows:
+        by_user.setdefault(r["user_id"], []).append(r)
+
+    window = max(0, int(settings.NOTIFY_COALESCE_SECONDS))
+    for uid, items in by_user.items():
+        # Rows held for a daily digest were queued before their send time.
+        daily = any(r["send_after"] > r["created_at"] for r in items)
+        if window or daily:
+            failed = [] if await _push(uid, items, daily) else items
+        else:
+            failed = [r for r in items if not await _push(uid, [r], False)]
+        if failed:
+            attempts = 1 + max(int(r["attempts"] or 0) for r in failed)
+            _next_push[uid] = time.time() + min(RETRY_MAX_SECONDS, RETRY_SECONDS * 2 ** (attempts - 1))
+        elif window:
+            _next_push[uid] = time.time() + window
+
+
+async def _push(uid: str, items: list[dict], daily: bool) -> bool:
+    first = items[0]
+    digest_id = None
+    if len(items) == 1:
+        title, message, click = first["title"], first["message"], first["click_url"]
+    else:
+        digest_id = str(uuid.uuid4())
+        title = f"{len(items)} reminders" + (" today" if daily else "")
+        lines = [f"• {r['message']}" for r in items[:DIGEST_TITLES]]
+        if len(items) > DIGEST_TITLES:
+            lines.append(f"…and {len(items) - DIGEST_TITLES} more")
+        message = "\n".join(lines)
+        click = settings.APP_BASE_URL.rstrip("/") + f"/app/todos?digest={digest_id}"
+    ids = [r["id"] for r in items]
+    try:
+        await publish(topic=first["topic"], title=title, message=message, click_url=click, tags=["todo"])
+    except Exception as exc:
         with tx() as con:
-            con.execute("UPDATE todos SET remind_at=? WHERE id=?", (now() + 30, todo_id))
+            con.execute(outbox_failed_sql(len(ids)), [str(exc), MAX_ATTEMPTS, *ids])
+        return False
+    t = now()
+    with tx() as con:
+        con.execute(outbox_sent_sql(len(ids)), [t, digest_id, *ids])
+    reminder_pushes.inc(kind="daily" if daily else "digest" if digest_id else "single")
+    reminders_delivered.inc(len(items))
+    if not daily:
+        for r in items:
+            reminder_lag.observe(max(0.0, time.time() - float(r["send_after"])))
+    return True
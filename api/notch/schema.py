@@ -1,27 +1,414 @@
 from __future__ import annotations
 
+import asyncio
+import sqlite3
+import time
 from pathlib import Path
+from typing import Callable
 
-from .db import tx
+from .db import create_if_missing, tx
+from . import counts, defaults, shares
 
+# Schema versioning
+#
+# PRAGMA user_version holds the number of the last applied migration. Startup
+# reads it and returns immediately when the DB is current, so boot time does not
+# grow with migration history.
+#
+# Each migration runs in its own transaction together with its user_version bump.
+# Anything proportional to table size (backfills, rebuilds) must not run there:
+# the migration enqueues a named job instead, and run_pending_jobs() works
+# through it in small batches after boot. Job cursors are persisted in
+# schema_jobs, so an interrupted job resumes where it stopped. The exception is
+# data that requests depend on for correctness (item_shares, migration 13): it
+# is filled in the migration with set-based SQL, before the app serves anything.
 
-def _try(con, sql: str) -> None:
-    try:
-        con.execute(sql)
-    except Exception:
-        # best-effort migration; safe to ignore if already applied
-        pass
 
+def now() -> int:
+    return int(time.time())
 
-def apply_schema() -> None:
-    sql_path = Path(__file__).with_name("schema.sql")
-    sql = sql_path.read_text("utf-8")
+
+def _statements(sql: str) -> list[str]:
+    out: list[str] = []
+    buf = ""
+    for line in sql.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            out.append(buf.strip())
+            buf = ""
+    return out
+
+
+def _has_column(con: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(r[1] == column for r in con.execute(f"PRAGMA table_info({table})"))
+
+
+def _add_column(con: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+    if not _has_column(con, table, column):
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _enqueue_job(con: sqlite3.Connection, name: str) -> None:
+    con.execute(
+        "INSERT OR REPLACE INTO schema_jobs(name,cursor,created_at,done_at) VALUES(?,NULL,?,NULL)",
+        (name, now()),
+    )
+
+
+def _m1_baseline(con: sqlite3.Connection) -> None:
+    for stmt in _statements(Path(__file__).with_name("schema.sql").read_text("utf-8")):
+        con.execute(stmt)
+    # Pre-versioning DBs may predate these columns.
+    _add_column(con, "todos", "list_id", "TEXT")
+    _add_column(con, "todos", "deleted_at", "INTEGER")
+    _add_column(con, "notes", "group_id", "TEXT")
+    _add_column(con, "notes", "deleted_at", "INTEGER")
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_jobs (
+          name TEXT PRIMARY KEY,
+          cursor TEXT,
+          created_at INTEGER NOT NULL,
+          done_at INTEGER
+        )
+        """
+    )
+
+
+def _m2_listing_indexes(con: sqlite3.Connection) -> None:
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_owner ON todos(created_by, done, deleted_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_assigned ON todos(assigned_to)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_list ON todos(list_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_notes_owner ON notes(created_by, updated_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_notes_group ON notes(group_id)")
+    # Index of shared_with membership (kind = todo|note|list|group).
+    # shared_with JSON stays the source of truth; this mirrors it so visibility
+    # checks can use an index instead of instr() over every row.
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS item_shares (
+          user_id TEXT NOT NULL,
+          kind TEXT NOT NULL,
+          item_id TEXT NOT NULL,
+          PRIMARY KEY (user_id, kind, item_id)
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_item_shares_item ON item_shares(kind, item_id)")
+
+
+def _m3_retention_indexes(con: sqlite3.Connection) -> None:
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+    # Partial: only Trash rows are indexed, so live rows cost nothing.
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_trash ON todos(deleted_at) WHERE deleted_at IS NOT NULL")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_notes_trash ON notes(deleted_at) WHERE deleted_at IS NOT NULL")
+
+
+def _m4_archive_tables(con: sqlite3.Connection) -> None:
+    # Cold storage for long-completed todos and old Trash (see archive.py).
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS todos_archive (
+          id TEXT PRIMARY KEY,
+          list_id TEXT,
+          title TEXT NOT NULL,
+          notes TEXT,
+          done INTEGER NOT NULL DEFAULT 0,
+          due_at INTEGER,
+          remind_at INTEGER,
+          remind_sent_at INTEGER,
+          assigned_to TEXT,
+          shared_with TEXT NOT NULL DEFAULT '[]',
+          created_by TEXT NOT NULL,
+          created_at INTEGER NOT NULL,
+          updated_at INTEGER NOT NULL,
+          deleted_at INTEGER,
+          version INTEGER NOT NULL DEFAULT 1,
+          archived_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_archive_owner ON todos_archive(created_by)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_archive_assigned ON todos_archive(assigned_to)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_todos_archive_list ON todos_archive(list_id)")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_todos_archive_trash ON todos_archive(deleted_at) WHERE deleted_at IS NOT NULL"
+    )
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS notes_archive (
+          id TEXT PRIMARY KEY,
+          group_id TEXT,
+          title TEXT NOT NULL,
+          body_md TEXT NOT NULL,
+          shared_with TEXT NOT NULL DEFAULT '[]',
+          created_by TEXT NOT NULL,
+          created_at INTEGER NOT NULL,
+          updated_at INTEGER NOT NULL,
+          deleted_at INTEGER,
+          version INTEGER NOT NULL DEFAULT 1,
+          archived_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_notes_archive_owner ON notes_archive(created_by, updated_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_notes_archive_group ON notes_archive(group_id)")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notes_archive_trash ON notes_archive(deleted_at) WHERE deleted_at IS NOT NULL"
+    )
+    # Finds archive candidates among completed todos without touching open ones.
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_todos_done_updated ON todos(updated_at) WHERE done=1 AND deleted_at IS NULL"
+    )
+
+
+def _m5_default_containers(con: sqlite3.Connection) -> None:
+    # Ids of each user's Inbox list / General group (see defaults.py).
+    _add_column(con, "users", "inbox_list_id", "TEXT")
+    _add_column(con, "users", "general_group_id", "TEXT")
+    _enqueue_job(con, "default_containers_backfill")
+
+
+def _m6_import_ids(con: sqlite3.Connection) -> None:
+    # Source id -> local id for imported rows whose ids had to be remapped (see transfer.py).
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS import_ids (
+          user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          kind TEXT NOT NULL,
+          source_id TEXT NOT NULL,
+          local_id TEXT NOT NULL,
+          created_at INTEGER NOT NULL,
+          PRIMARY KEY (user_id, kind, source_id)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def _m7_idempotency_keys(con: sqlite3.Connection) -> None:
+    # Stored responses for Idempotency-Key retries (see idempotency.py).
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+          user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          key TEXT NOT NULL,
+          fingerprint BLOB NOT NULL,
+          status INTEGER,
+          response BLOB,
+          created_at INTEGER NOT NULL,
+          expires_at INTEGER NOT NULL,
+          PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)")
+
+
+def _m8_todo_recurrence(con: sqlite3.Connection) -> None:
+    # Recurrence rules (see recurrence.py); remind_at only ever holds the next occurrence.
+    _add_column(con, "todos", "recur", "TEXT")
+    _add_column(con, "todos_archive", "recur", "TEXT")
+    # Index only reminders still to be sent, so fired and completed ones cost nothing.
+    con.execute("DROP INDEX IF EXISTS idx_todos_remind")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_todos_remind_pending ON todos(remind_at)"
+        " WHERE done=0 AND remind_sent_at IS NULL AND remind_at IS NOT NULL"
+    )
+
+
+def _m9_notification_digests(con: sqlite3.Connection) -> None:
+    # Coalesced / daily reminder digests (see scheduler.py).
+    _add_column(con, "outbox_notifications", "todo_id", "TEXT")
+    _add_column(con, "outbox_notifications", "send_after", "INTEGER")
+    _add_column(con, "outbox_notifications", "digest_id", "TEXT")
+    _add_column(con, "users", "digest_hour", "INTEGER")
+    # Rows left pending by the old sender belong to todos that were never marked sent;
+    # the scheduler enqueues those again.
+    con.execute(
+        "UPDATE outbox_notifications SET status='error', last_error='superseded' WHERE status='pending' AND send_after IS NULL"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox_notifications(send_after) WHERE status='pending'"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_digest ON outbox_notifications(digest_id, user_id) WHERE digest_id IS NOT NULL"
+    )
+
+
+def _m10_agenda_indexes(con: sqlite3.Connection) -> None:
+    # Agenda range queries (see agenda.py): one per visibility branch and time
+    # column, holding only open todos that have that time set.
+    for name, user_col in (("owner", "created_by"), ("assigned", "assigned_to")):
+        for col in ("due_at", "remind_at"):
+            con.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_todos_agenda_{name}_{col[:-3]} ON todos({user_col}, {col})"
+                f" WHERE done=0 AND deleted_at IS NULL AND {col} IS NOT NULL"
+            )
+    # Secret for the per-user ICS feed URL (see ics.py).
+    _add_column(con, "users", "calendar_token", "TEXT")
+    con.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_calendar_token ON users(calendar_token) WHERE calendar_token IS NOT NULL"
+    )
+
+
+def _m11_item_counts(con: sqlite3.Connection) -> None:
+    # Sidebar counters kept by triggers (see counts.py). Users are initialized
+    # on first read, so nothing here grows with the data.
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS item_counts (
+          user_id TEXT NOT NULL,
+          kind TEXT NOT NULL,
+          container_id TEXT NOT NULL,
+          state TEXT NOT NULL,
+          n INTEGER NOT NULL,
+          PRIMARY KEY (user_id, kind, container_id, state)
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS item_counts_ready (user_id TEXT PRIMARY KEY) WITHOUT ROWID")
+    for stmt in counts.trigger_sql():
+        con.execute(stmt)
+
+
+def _m12_outbox_attempts(con: sqlite3.Connection) -> None:
+    # Failed pushes per outbox row, for retry backoff (see scheduler.py).
+    _add_column(con, "outbox_notifications", "attempts", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _m13_item_shares_backfill(con: sqlite3.Connection) -> None:
+    # Visibility checks read only item_shares, so it is filled here, with one
+    # set-based pass per table, before the app serves anything. DBs on which an
+    # older release finished the batched item_shares_backfill job skip it; a
+    # job left pending is finished here and marked done.
+    if con.execute("SELECT 1 FROM schema_jobs WHERE name='item_shares_backfill' AND done_at IS NOT NULL").fetchone():
+        return
+    for kind in shares.KINDS:
+        con.execute(shares.backfill_sql(kind))
+    con.execute("UPDATE schema_jobs SET cursor=NULL, done_at=? WHERE name='item_shares_backfill'", (now(),))
+
+
+def _m14_export_indexes(con: sqlite3.Connection) -> None:
+    # Exports page through a user's rows by id (see transfer.py).
+    for table in ("todos", "todos_archive", "notes", "notes_archive"):
+        con.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_export ON {table}(created_by, id)")
+
+
+def _m15_idempotency_service_scope(con: sqlite3.Connection) -> None:
+    # SERVICE_TOKEN requests act as a user but get their own Idempotency-Key
+    # namespace (see idempotency.py). Rebuilt in place: rows expire after
+    # IDEMPOTENCY_TTL_SECONDS, so the table stays small.
+    con.execute(
+        """
+        CREATE TABLE idempotency_keys_new (
+          user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          service INTEGER NOT NULL DEFAULT 0,
+          key TEXT NOT NULL,
+          fingerprint BLOB NOT NULL,
+          status INTEGER,
+          response BLOB,
+          created_at INTEGER NOT NULL,
+          expires_at INTEGER NOT NULL,
+          PRIMARY KEY (user_id, service, key)
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute(
+        "INSERT INTO idempotency_keys_new(user_id,service,key,fingerprint,status,response,created_at,expires_at)"
+        " SELECT user_id,0,key,fingerprint,status,response,created_at,expires_at FROM idempotency_keys"
+    )
+    con.execute("DROP TABLE idempotency_keys")
+    con.execute("ALTER TABLE idempotency_keys_new RENAME TO idempotency_keys")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)")
+
+
+# (version, name, apply). Append only; never renumber or edit a shipped migration.
+MIGRATIONS: list[tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "baseline", _m1_baseline),
+    (2, "listing_indexes", _m2_listing_indexes),
+    (3, "retention_indexes", _m3_retention_indexes),
+    (4, "archive_tables", _m4_archive_tables),
+    (5, "default_containers", _m5_default_containers),
+    (6, "import_ids", _m6_import_ids),
+    (7, "idempotency_keys", _m7_idempotency_keys),
+    (8, "todo_recurrence", _m8_todo_recurrence),
+    (9, "notification_digests", _m9_notification_digests),
+    (10, "agenda_indexes", _m10_agenda_indexes),
+    (11, "item_counts", _m11_item_counts),
+    (12, "outbox_attempts", _m12_outbox_attempts),
+    (13, "item_shares_backfill", _m13_item_shares_backfill),
+    (14, "export_indexes", _m14_export_indexes),
+    (15, "idempotency_service_scope", _m15_idempotency_service_scope),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+# Resumable background jobs: fn(con, cursor) -> next cursor, or None when done.
+JOBS: dict[str, Callable[[sqlite3.Connection, str | None], str | None]] = {
+    "default_containers_backfill": defaults.backfill_batch,
+}
+
+
+def user_version(con: sqlite3.Connection) -> int:
+    return int(con.execute("PRAGMA user_version").fetchone()[0])
+
+
+def migrate(con: sqlite3.Connection) -> list[int]:
+    """Apply pending migrations on `con`; return the versions applied."""
+    applied: list[int] = []
+    if user_version(con) >= LATEST:
+        return applied
+    for version, _name, fn in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock up front, so a second process
+        # booting at the same time waits and then sees the bumped version.
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if user_version(con) >= version:
+                con.execute("ROLLBACK")
+                continue
+            fn(con)
+            con.execute(f"PRAGMA user_version = {int(version)}")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        applied.append(version)
+    return applied
+
+
+def apply_schema() -> list[int]:
+    create_if_missing()
     with tx() as con:
-        con.executescript(sql)
-
-        # Best-effort migrations for early-stage schema changes.
-        # (SQLite doesn't support ALTER TABLE .. ADD COLUMN IF NOT EXISTS in all versions.)
-        _try(con, "ALTER TABLE todos ADD COLUMN list_id TEXT")
-        _try(con, "ALTER TABLE todos ADD COLUMN deleted_at INTEGER")
-        _try(con, "ALTER TABLE notes ADD COLUMN group_id TEXT")
-        _try(con, "ALTER TABLE notes ADD COLUMN deleted_at INTEGER")
+        return migrate(con)
+
+
+def pending_jobs() -> list[str]:
+    with tx() as con:
+        rows = con.execute("SELECT name FROM schema_jobs WHERE done_at IS NULL ORDER BY created_at").fetchall()
+    return [r["name"] for r in rows]
+
+
+def run_job_step(name: str) -> bool:
+    """Run one batch of a background job. Returns True when the job is finished."""
+    fn = JOBS[name]
+    with tx() as con:
+        row = con.execute("SELECT cursor, done_at FROM schema_jobs WHERE name=?", (name,)).fetchone()
+        if not row or row["done_at"] is not None:
+            return True
+        cursor = fn(con, row["cursor"])
+        if cursor is None:
+            con.execute("UPDATE schema_jobs SET cursor=NULL, done_at=? WHERE name=?", (now(), name))
+            return True
+        con.execute("UPDATE schema_jobs SET cursor=? WHERE name=?", (cursor, name))
+    return False
+
+
+async def run_pending_jobs(pause: float = 0.05) -> None:
+    """Work through pending background jobs one short transaction at a time."""
+    for name in pending_jobs():
+        if name not in JOBS:
+            continue
+        while not run_job_step(name):
+            # Yield between batches so requests are served while jobs run.
+            await asyncio.sleep(pause)
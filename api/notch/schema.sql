@@ -1,4 +1,7 @@
 -- Notch schema (MVP)
+--
+-- Baseline schema, applied by migration 1. Later changes are numbered
+-- migrations in schema.py; don't edit this file to change the schema.
 
 CREATE TABLE IF NOT EXISTS users (
   id TEXT PRIMARY KEY,
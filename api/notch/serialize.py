@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import json
+from functools import lru_cache
+from typing import Any, Callable, Sequence
+
+# Response serialization for the hot list endpoints.
+#
+# row_serializer() resolves column positions once per cursor and builds each
+# response object straight from the sqlite3.Row (no dict(row) copy, no per-key
+# name lookups). shared_with JSON is parsed through a small LRU cache: the same
+# handful of share sets repeat across most rows. Endpoints return plain dicts;
+# the app's default_response_class (ORJSONResponse) encodes them.
+
+
+@lru_cache(maxsize=4096)
+def _parse_list(s: str) -> tuple[str, ...]:
+    try:
+        v = json.loads(s)
+    except Exception:
+        return ()
+    if isinstance(v, list):
+        return tuple(str(x) for x in v)
+    return ()
+
+
+def shared_list(s: str | None) -> tuple[str, ...]:
+    """Parsed shared_with value. Cached and immutable: don't mutate, copy with list()."""
+    if not s:
+        return ()
+    return _parse_list(s)
+
+
+def row_serializer(
+    description: Sequence[Sequence[Any]],
+    fields: Sequence[str],
+    *,
+    bools: Sequence[str] = (),
+    lists: Sequence[str] = (),
+) -> Callable[[Sequence[Any]], dict[str, Any]]:
+    """Return a function mapping a result row to {field: value} for `fields`, in order."""
+    pos = {d[0]: i for i, d in enumerate(description)}
+    plan = [(f, pos[f], bool if f in bools else shared_list if f in lists else None) for f in fields]
+
+    def to_dict(row: Sequence[Any]) -> dict[str, Any]:
+        return {f: (conv(row[i]) if conv else row[i]) for f, i, conv in plan}
+
+    return to_dict
@@ -28,6 +28,92 @@ class Settings(BaseSettings):
     # Scheduler
     SCHEDULER_ENABLED: bool = True
     SCHEDULER_POLL_SECONDS: float = 1.0
+    # Each user gets at most one reminder push per NOTIFY_COALESCE_SECONDS;
+    # reminders coming due in between are merged into one digest (0 = one push
+    # per reminder).
+    NOTIFY_COALESCE_SECONDS: int = 60
+
+    # Metrics (/metrics, Prometheus text format). Scrapes send
+    # "Authorization: Bearer <METRICS_TOKEN>"; without a token only admins can read it.
+    METRICS_ENABLED: bool = True
+    METRICS_TOKEN: str | None = None
+
+    # Password hashing runs in a process pool of AUTH_HASH_WORKERS (0 = default
+    # thread pool); more than AUTH_HASH_QUEUE hashes in flight get a 503.
+    AUTH_HASH_WORKERS: int = 2
+    AUTH_HASH_QUEUE: int = 16
+
+    # Login limits (token buckets: burst, then N per minute), checked before hashing.
+    # LOGIN_HANDLE_* apply per (handle, client IP), LOGIN_IP_* per client IP.
+    LOGIN_HANDLE_BURST: int = 5
+    LOGIN_HANDLE_PER_MINUTE: float = 10
+    LOGIN_IP_BURST: int = 20
+    LOGIN_IP_PER_MINUTE: float = 60
+    LOGIN_IP_CONCURRENCY: int = 4
+    # Use X-Forwarded-For for the client IP (only behind a trusted reverse proxy).
+    TRUST_PROXY_HEADERS: bool = False
+
+    # Public share-link limits (token buckets per link and per client IP), and
+    # how long saves to the same note are batched into one UPDATE (0 = off).
+    SHARE_TOKEN_BURST: int = 60
+    SHARE_TOKEN_PER_MINUTE: float = 300
+    SHARE_IP_BURST: int = 30
+    SHARE_IP_PER_MINUTE: float = 120
+    SHARE_SAVE_BURST: int = 10
+    SHARE_SAVE_PER_MINUTE: float = 60
+    SHARE_SAVE_COALESCE_MS: int = 500
+
+    # SQL tracing: statements slower than SQL_SLOW_MS (0 = off) are logged with
+    # their query plan. Requests sent with "X-Notch-Trace: 1" (or every request
+    # when SQL_TRACE_ALL) keep a statement trace readable via /api/admin/sql-trace.
+    SQL_SLOW_MS: float = 100.0
+    SQL_TRACE_ALL: bool = False
+    SQL_TRACE_BUFFER: int = 200
+
+    # Diagnostics: event-loop lag monitor logs the loop thread's stack when it is
+    # blocked longer than LOOP_LAG_THRESHOLD_MS; /api/admin/profile samples for
+    # at most PROFILE_MAX_SECONDS.
+    LOOP_LAG_MONITOR_ENABLED: bool = True
+    LOOP_LAG_THRESHOLD_MS: float = 200.0
+    PROFILE_MAX_SECONDS: float = 60.0
+
+    # Idempotency-Key: how long a stored response is replayed for retries.
+    IDEMPOTENCY_TTL_SECONDS: int = 86400
+
+    # Import: records applied per transaction by POST /api/import.
+    IMPORT_BATCH_SIZE: int = 500
+
+    # Backups: online snapshots (SQLite backup API, BACKUP_PAGES_PER_STEP pages per
+    # step with BACKUP_STEP_PAUSE_MS between steps), gzipped into BACKUP_DIR
+    # (default: "backups" next to the DB). The newest BACKUP_KEEP are kept.
+    BACKUP_ENABLED: bool = True
+    BACKUP_DIR: str = ""
+    BACKUP_INTERVAL_SECONDS: int = 86400
+    BACKUP_KEEP: int = 7
+    BACKUP_PAGES_PER_STEP: int = 256
+    BACKUP_STEP_PAUSE_MS: float = 5.0
+
+    # DB maintenance (checkpoint / optimize / incremental vacuum)
+    MAINTENANCE_ENABLED: bool = True
+    MAINTENANCE_IDLE_SECONDS: float = 30.0
+    MAINTENANCE_CHECKPOINT_SECONDS: int = 60
+    MAINTENANCE_OPTIMIZE_SECONDS: int = 6 * 3600
+    MAINTENANCE_VACUUM_PAGES: int = 256
+
+    # Retention (days; 0 = keep forever for outbox/trash)
+    RETENTION_ENABLED: bool = True
+    RETENTION_INTERVAL_SECONDS: int = 3600
+    RETENTION_BATCH_SIZE: int = 500
+    RETENTION_EXPIRED_GRACE_DAYS: int = 7
+    RETENTION_OUTBOX_DAYS: int = 30
+    RETENTION_TRASH_DAYS: int = 30
+
+    # Archive (hot/cold split; days, 0 = never archive)
+    ARCHIVE_ENABLED: bool = True
+    ARCHIVE_INTERVAL_SECONDS: int = 3600
+    ARCHIVE_BATCH_SIZE: int = 500
+    ARCHIVE_DONE_DAYS: int = 30
+    ARCHIVE_TRASH_DAYS: int = 7
 
 
 settings = Settings()
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import sqlite3
+
+# item_shares mirrors each row's shared_with JSON so visibility checks can use
+# an index. Every write path that changes shared_with must call set_shares().
+KINDS = ("todo", "note", "list", "group")
+
+CLEAR_SQL = "DELETE FROM item_shares WHERE kind=? AND item_id=?"
+INSERT_SQL = "INSERT OR IGNORE INTO item_shares(user_id,kind,item_id) VALUES(?,?,?)"
+
+
+def shared_ids_sql(kind: str) -> str:
+    """Subquery selecting ids of `kind` shared with a user (one `?` param: user id)."""
+    if kind not in KINDS:
+        raise ValueError(f"unknown share kind: {kind}")
+    return f"SELECT item_id FROM item_shares WHERE user_id=? AND kind='{kind}'"
+
+
+def get_visible(
+    con: sqlite3.Connection, table: str, columns: str, visible_sql: str, item_id: str, user_id: str
+) -> dict | None:
+    """Fetch one row by id only if `visible_sql` (with every ? bound to user_id) holds.
+
+    Permission check and fetch in a single statement, so callers never need a
+    second lookup (or connection) to resolve group/list sharing.
+    """
+    params = [str(item_id)] + [user_id] * visible_sql.count("?")
+    row = con.execute(f"SELECT {columns} FROM {table} WHERE id=? AND {visible_sql}", params).fetchone()
+    return dict(row) if row else None
+
+
+def viewers_sql(n: int) -> str:
+    """Creators, assignees and sharees of `n` todos (params: the ids, three times)."""
+    marks = ",".join("?" for _ in range(n))
+    return (
+        f"SELECT created_by FROM todos WHERE id IN ({marks})"
+        f" UNION SELECT assigned_to FROM todos WHERE id IN ({marks})"
+        f" UNION SELECT user_id FROM item_shares WHERE kind='todo' AND item_id IN ({marks})"
+    )
+
+
+def todos_key(user_id: str) -> str:
+    """db.generation key that changes whenever a todo visible to `user_id` is written."""
+    return f"todos:{user_id}"
+
+
+def touch_viewers(con: sqlite3.Connection, user_ids: list[str | None]) -> None:
+    """Bump todos_key() of `user_ids` when `con` commits."""
+    for u in set(user_ids):
+        if u:
+            con.note_write(todos_key(str(u)))
+
+
+def touch_todos(con: sqlite3.Connection, todo_ids: list[str]) -> None:
+    """Bump todos_key() of everyone who can currently see `todo_ids`.
+
+    Call it before a write that may take a todo away from someone (purge,
+    reassign, unshare) and after one that may give it to someone.
+    """
+    ids = [str(i) for i in todo_ids]
+    for i in range(0, len(ids), 300):
+        chunk = ids[i : i + 300]
+        touch_viewers(con, [r[0] for r in con.execute(viewers_sql(len(chunk)), chunk * 3).fetchall()])
+
+
+def set_shares(con: sqlite3.Connection, kind: str, item_id: str, user_ids: list[str]) -> None:
+    clear_shares(con, kind, item_id)
+    uids = {str(u) for u in user_ids if u}
+    if uids:
+        con.executemany(
+            INSERT_SQL,
+            [(u, kind, str(item_id)) for u in uids],
+        )
+
+
+def clear_shares(con: sqlite3.Connection, kind: str, item_id: str) -> None:
+    con.execute(CLEAR_SQL, (kind, str(item_id)))
+
+
+_TABLES = {"todo": "todos", "note": "notes", "list": "todo_lists", "group": "note_groups"}
+
+
+def backfill_sql(kind: str) -> str:
+    """Mirror every shared_with value of `kind` into item_shares in one statement."""
+    src = "CASE WHEN json_valid(t.shared_with) THEN CASE WHEN json_type(t.shared_with)='array' THEN t.shared_with END END"
+    return (
+        f"INSERT OR IGNORE INTO item_shares(user_id,kind,item_id)"
+        f" SELECT CAST(j.value AS TEXT),'{kind}',t.id FROM {_TABLES[kind]} t, json_each({src}) j"
+        f" WHERE t.shared_with IS NOT NULL AND j.value IS NOT NULL AND CAST(j.value AS TEXT) != ''"
+    )
@@ -1,47 +1,67 @@
 from __future__ import annotations
 
 import json
+import re
+import sqlite3
 import time
 import uuid
+from datetime import date, datetime, time as dt_time, timedelta
 from typing import Any
+from zoneinfo import ZoneInfo
 
 from fastapi import HTTPException
 
+from . import recurrence, scheduler, shares
+from .archive import TODO_COLUMNS, unarchive
 from .auth import Principal
 from .db import tx
-from .lists import ensure_default_list
+from .lists import default_list_id
+from .serialize import row_serializer, shared_list
+from .settings import settings
+from .shares import clear_shares, get_visible, set_shares, shared_ids_sql, touch_todos, touch_viewers
 
 
-def now() -> int:
-    return int(time.time())
+VISIBLE_SQL = f"(created_by=? OR assigned_to=? OR id IN ({shared_ids_sql('todo')}))"
 
+BY_ID_SQL = "SELECT * FROM todos WHERE id=?"
+TRASH_SQL = "UPDATE todos SET deleted_at=?, updated_at=?, version=version+1 WHERE id=?"
+RESTORE_SQL = "UPDATE todos SET deleted_at=NULL, updated_at=?, version=version+1 WHERE id=?"
+PURGE_SQL = "DELETE FROM todos WHERE id=?"
+
+
+def update_sql(sets: list[str]) -> str:
+    return f"UPDATE todos SET {', '.join(sets)} WHERE id=?"
 
-def _loads_list(s: str | None) -> list[str]:
-    if not s:
-        return []
-    try:
-        v = json.loads(s)
-        if isinstance(v, list):
-            return [str(x) for x in v]
-    except Exception:
-        pass
-    return []
+
+def now() -> int:
+    return int(time.time())
 
 
 def _dumps_list(v: list[str] | None) -> str:
     return json.dumps(v or [], ensure_ascii=False)
 
 
-def create_todo(*, p: Principal, payload: dict) -> dict[str, Any]:
-    if p.kind != "user":
-        raise HTTPException(status_code=403, detail="User session required")
+def _recur(value: Any, remind_at: int | None) -> str | None:
+    """Validate a client-sent recurrence rule and anchor it at remind_at."""
+    if value is None or value == "":
+        return None
+    if not isinstance(value, str):
+        raise HTTPException(status_code=400, detail="recur must be a string")
+    if remind_at is None:
+        raise HTTPException(status_code=400, detail="recur needs remind_at")
+    try:
+        return recurrence.anchored(value, remind_at)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid recur: {exc}")
+
 
+def _new_todo(payload: dict, *, user_id: str, t: int, default_list: str | None = None) -> tuple[dict[str, Any], list[str]]:
+    """Validate a create payload into a full todos row and its shared_with user ids."""
     title = (payload.get("title") or "").strip()
     if not title:
         raise HTTPException(status_code=400, detail="Missing title")
 
     # Todos are title-only (no description field)
-    notes = None
     due_at = payload.get("due_at")
     remind_at = payload.get("remind_at")
     list_id = payload.get("list_id")
@@ -57,40 +77,196 @@ def create_todo(*, p: Principal, payload: dict) -> dict[str, Any]:
         except Exception:
             raise HTTPException(status_code=400, detail="due_at/remind_at must be unix seconds")
 
-    due_at_i = to_int(due_at)
-    remind_at_i = to_int(remind_at)
-
     if assigned_to is not None and assigned_to != "":
         assigned_to = str(assigned_to)
     else:
         assigned_to = None
 
+    remind_at = to_int(remind_at)
+    recur = _recur(payload.get("recur"), remind_at)
+
     if isinstance(shared_with, list):
-        shared_with_s = _dumps_list([str(x) for x in shared_with])
+        shared_with = [str(x) for x in shared_with]
     elif shared_with is None:
-        shared_with_s = _dumps_list([])
+        shared_with = []
     else:
         raise HTTPException(status_code=400, detail="shared_with must be a list")
 
     # Default list = Inbox
     if not list_id:
-        inbox = ensure_default_list(p.user["id"])
-        list_id = inbox["id"]
+        list_id = default_list or default_list_id(user_id)
+
+    row = {
+        "id": str(uuid.uuid4()),
+        "list_id": str(list_id),
+        "title": title,
+        "notes": None,
+        "done": 0,
+        "due_at": to_int(due_at),
+        "remind_at": remind_at,
+        "remind_sent_at": None,
+        "assigned_to": assigned_to,
+        "shared_with": _dumps_list(shared_with),
+        "created_by": user_id,
+        "created_at": t,
+        "updated_at": t,
+        "version": 1,
+        "recur": recur,
+    }
+    return row, shared_with
 
-    tid = str(uuid.uuid4())
-    t = now()
+
+_INSERT_SQL = """
+    INSERT INTO todos(id,list_id,title,notes,done,due_at,remind_at,remind_sent_at,assigned_to,shared_with,created_by,created_at,updated_at,version,recur)
+    VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+
+def _insert_params(row: dict[str, Any]) -> tuple:
+    return (
+        row["id"], row["list_id"], row["title"], row["notes"], row["done"], row["due_at"], row["remind_at"],
+        row["remind_sent_at"], row["assigned_to"], row["shared_with"], row["created_by"],
+        row["created_at"], row["updated_at"], row["version"], row["recur"],
+    )
+
+
+def create_todo(*, p: Principal, payload: dict) -> dict[str, Any]:
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+
+    row, shared_with = _new_todo(payload, user_id=p.user["id"], t=now())
     with tx() as con:
-        con.execute(
-            """
-            INSERT INTO todos(id,list_id,title,notes,done,due_at,remind_at,remind_sent_at,assigned_to,shared_with,created_by,created_at,updated_at,version)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (tid, str(list_id), title, notes, 0, due_at_i, remind_at_i, None, assigned_to, shared_with_s, p.user["id"], t, t, 1),
-        )
-        row = con.execute("SELECT * FROM todos WHERE id=?", (tid,)).fetchone()
+        con.execute(_INSERT_SQL, _insert_params(row))
+        set_shares(con, "todo", row["id"], shared_with)
+        touch_viewers(con, [row["created_by"], row["assigned_to"], *shared_with])
+        row = con.execute(BY_ID_SQL, (row["id"],)).fetchone()
     return _row_to_todo(dict(row))
 
 
+MAX_BULK_TODOS = 500
+
+_BULLET_RE = re.compile(r"^(?:[-*+\u2022]|\d+[.)])\s+")
+_CHECKBOX_RE = re.compile(r"^\[([ xX])\]\s*")
+_HINT_RE = re.compile(r"(?<!\S)(due|remind|every):(\S+)", re.IGNORECASE)
+_RELATIVE_RE = re.compile(r"^\+(\d+)([mhd])$")
+_UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400}
+_EVERY = {
+    "day": "FREQ=DAILY",
+    "week": "FREQ=WEEKLY",
+    "month": "FREQ=MONTHLY",
+    "year": "FREQ=YEARLY",
+    "weekday": "FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR",
+}
+# Hints that name only a day ("today", "2026-03-01") land at this local hour.
+DEFAULT_HINT_HOUR = 9
+
+
+def _parse_when(value: str, t: int) -> int:
+    """A due:/remind: hint value as unix seconds (raises ValueError)."""
+    v = value.strip().lower()
+    m = _RELATIVE_RE.match(v)
+    if m:
+        return t + int(m.group(1)) * _UNIT_SECONDS[m.group(2)]
+    if v.isdigit():
+        return int(v)
+    tz = ZoneInfo(settings.TZ)
+    today = datetime.fromtimestamp(t, tz).date()
+    if v in ("today", "tomorrow"):
+        day = today if v == "today" else today + timedelta(days=1)
+        return int(datetime.combine(day, dt_time(DEFAULT_HINT_HOUR), tz).timestamp())
+    if len(v) == 10:
+        day = date.fromisoformat(v)
+        return int(datetime.combine(day, dt_time(DEFAULT_HINT_HOUR), tz).timestamp())
+    when = datetime.fromisoformat(v.upper())
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=tz)
+    return int(when.timestamp())
+
+
+def parse_text(text: str, *, t: int | None = None) -> list[dict[str, Any]]:
+    """Parse a pasted checklist into create payloads, one per non-blank line.
+
+    Bullets ("-", "*", "1.") are stripped, "[x]" marks a todo done, and
+    "due:<when>" / "remind:<when>" hints set the times, where <when> is
+    today, tomorrow, +30m/+2h/+1d, an ISO date or datetime (in settings.TZ)
+    or unix seconds. "every:day|week|month|year|weekday" or "every:mo,th"
+    makes the reminder recur.
+    """
+    t = now() if t is None else t
+    out: list[dict[str, Any]] = []
+    for n, line in enumerate(text.splitlines(), start=1):
+        line = _BULLET_RE.sub("", line.strip())
+        item: dict[str, Any] = {}
+        m = _CHECKBOX_RE.match(line)
+        if m:
+            item["done"] = m.group(1) != " "
+            line = line[m.end():]
+        for hint in _HINT_RE.finditer(line):
+            kind, value = hint.group(1).lower(), hint.group(2).lower()
+            if kind == "every":
+                # every:week, every:weekday, every:mo,th
+                item["recur"] = _EVERY.get(value) or f"FREQ=WEEKLY;BYDAY={value.upper()}"
+                continue
+            try:
+                item[f"{kind}_at"] = _parse_when(value, t)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"line {n}: invalid {hint.group(0).strip()}")
+        item["title"] = " ".join(_HINT_RE.sub(" ", line).split())
+        if item["title"]:
+            out.append(item)
+    return out
+
+
+def create_todos(*, p: Principal, payload: dict) -> list[dict[str, Any]]:
+    """Create many todos in one transaction.
+
+    Takes either "todos" (a list of create payloads) or "text" (see parse_text).
+    "list_id" and "shared_with" at the top level apply to every item that
+    doesn't set its own.
+    """
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+
+    t = now()
+    if isinstance(payload.get("text"), str):
+        items = parse_text(payload["text"], t=t)
+    elif isinstance(payload.get("todos"), list):
+        items = payload["todos"]
+    else:
+        raise HTTPException(status_code=400, detail="Expected todos (list) or text")
+    if not items:
+        raise HTTPException(status_code=400, detail="No todos")
+    if len(items) > MAX_BULK_TODOS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_TODOS} todos per request")
+
+    uid = p.user["id"]
+    defaults = {k: payload[k] for k in ("list_id", "shared_with") if payload.get(k) is not None}
+    default_list = None if defaults.get("list_id") else default_list_id(uid)
+    rows = []
+    share_rows = []
+    viewers = {uid}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"todos[{i}]: expected an object")
+        try:
+            row, shared_with = _new_todo({**defaults, **item}, user_id=uid, t=t, default_list=default_list)
+        except HTTPException as exc:
+            raise HTTPException(status_code=exc.status_code, detail=f"todos[{i}]: {exc.detail}")
+        row["done"] = 1 if item.get("done") else 0
+        rows.append(row)
+        share_rows.extend((u, "todo", row["id"]) for u in set(shared_with) if u)
+        viewers.update([row["assigned_to"], *shared_with])
+
+    with tx() as con:
+        con.executemany(_INSERT_SQL, [_insert_params(r) for r in rows])
+        con.executemany(shares.INSERT_SQL, share_rows)
+        touch_viewers(con, list(viewers))
+    # Reminders already due go out now rather than on the next poll.
+    if any(r["remind_at"] is not None and r["remind_at"] <= t and not r["done"] for r in rows):
+        scheduler.wake()
+    return [_row_to_todo(r) for r in rows]
+
+
 def list_todos(
     *,
     p: Principal,
@@ -99,15 +275,42 @@ def list_todos(
     list_id: str | None = None,
     include_deleted: bool = False,
     deleted_only: bool = False,
+    digest_id: str | None = None,
     limit: int = 200,
 ) -> list[dict[str, Any]]:
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
 
+    sql, params = _list_sql(
+        user_id=p.user["id"],
+        query=query,
+        include_done=include_done,
+        list_id=list_id,
+        include_deleted=include_deleted,
+        deleted_only=deleted_only,
+        digest_id=digest_id,
+        limit=limit,
+    )
+    with tx() as con:
+        return _rows_to_todos(con.execute(sql, params))
+
+
+def _list_sql(
+    *,
+    user_id: str,
+    query: str | None,
+    include_done: bool,
+    list_id: str | None,
+    include_deleted: bool,
+    deleted_only: bool,
+    limit: int,
+    digest_id: str | None = None,
+) -> tuple[str, list[Any]]:
+    """Build the list_todos query (also used by the query plan check)."""
     q = (query or "").strip().lower()
     params: list[Any] = []
-    where = ["(created_by=? OR assigned_to=? OR instr(shared_with, ?) > 0)"]
-    params.extend([p.user["id"], p.user["id"], p.user["id"]])
+    where = [VISIBLE_SQL]
+    params.extend([user_id, user_id, user_id])
 
     if not include_done:
         where.append("done=0")
@@ -116,6 +319,11 @@ def list_todos(
         where.append("list_id=?")
         params.append(str(list_id))
 
+    if digest_id:
+        # The todos one reminder digest push was about (its click-through link).
+        where.append("id IN (SELECT todo_id FROM outbox_notifications WHERE digest_id=? AND user_id=?)")
+        params.extend([str(digest_id), user_id])
+
     if not include_deleted:
         where.append("deleted_at IS NULL")
     if deleted_only:
@@ -126,30 +334,28 @@ def list_todos(
         params.extend([f"%{q}%"])
 
     # Sort: undone first, then due date, then remind time.
-    sql = (
-        "SELECT * FROM todos WHERE "
-        + " AND ".join(where)
-        + " ORDER BY done ASC, COALESCE(due_at, 2147483647) ASC, COALESCE(remind_at, 2147483647) ASC, updated_at DESC LIMIT ?"
-    )
+    order = " ORDER BY done ASC, COALESCE(due_at, 2147483647) ASC, COALESCE(remind_at, 2147483647) ASC, updated_at DESC LIMIT ?"
+    w = " AND ".join(where)
+    if include_done or include_deleted or deleted_only:
+        # Completed and trashed todos may have been moved to the archive.
+        sql = (
+            f"SELECT * FROM (SELECT {TODO_COLUMNS} FROM todos WHERE {w}"
+            f" UNION ALL SELECT {TODO_COLUMNS} FROM todos_archive WHERE {w})" + order
+        )
+        params = params + params
+    else:
+        sql = f"SELECT * FROM todos WHERE {w}" + order
     params.append(int(limit))
-
-    with tx() as con:
-        rows = con.execute(sql, params).fetchall()
-    return [_row_to_todo(dict(r)) for r in rows]
+    return sql, params
 
 
 def get_todo(*, p: Principal, todo_id: str) -> dict[str, Any]:
     if p.kind != "user":
         raise HTTPException(status_code=403, detail="User session required")
     with tx() as con:
-        row = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        todo = dict(row)
-    if todo.get("deleted_at") is not None:
-        raise HTTPException(status_code=404, detail="Not found")
-    # Permissions: same check as list
-    if not _can_see(p.user["id"], todo):
+        # Permissions: same check as list
+        todo = _get_visible(con, p.user["id"], todo_id) or _get_visible(con, p.user["id"], todo_id, "todos_archive")
+    if not todo or todo.get("deleted_at") is not None:
         raise HTTPException(status_code=404, detail="Not found")
     return _row_to_todo(todo)
 
@@ -159,21 +365,17 @@ def delete_todo(*, p: Principal, todo_id: str) -> dict[str, Any]:
         raise HTTPException(status_code=403, detail="User session required")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        cur = dict(row)
-        if not _can_see(p.user["id"], cur):
+        unarchive(con, "todos", todo_id)
+        cur = _get_visible(con, p.user["id"], todo_id)
+        if not cur:
             raise HTTPException(status_code=404, detail="Not found")
         # Only creator can delete (safer than allowing shared users to delete your data).
         if cur.get("created_by") != p.user["id"]:
             raise HTTPException(status_code=403, detail="Only creator can delete")
 
         t = now()
-        con.execute(
-            "UPDATE todos SET deleted_at=?, updated_at=?, version=version+1 WHERE id=?",
-            (t, t, todo_id),
-        )
+        con.execute(TRASH_SQL, (t, t, todo_id))
+        touch_todos(con, [todo_id])
 
     return {"ok": True, "deleted": True, "id": todo_id}
 
@@ -188,18 +390,18 @@ def purge_todo(*, p: Principal, todo_id: str) -> dict[str, Any]:
         raise HTTPException(status_code=403, detail="User session required")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Not found")
-        cur = dict(row)
-        if not _can_see(p.user["id"], cur):
+        unarchive(con, "todos", todo_id)
+        cur = _get_visible(con, p.user["id"], todo_id)
+        if not cur:
             raise HTTPException(status_code=404, detail="Not found")
 
         # Only allow purge from Trash (safety)
         if cur.get("deleted_at") is None:
             raise HTTPException(status_code=409, detail="Todo is not in Trash")
 
-        con.execute("DELETE FROM todos WHERE id=?", (todo_id,))
+        touch_todos(con, [todo_id])
+        con.execute(PURGE_SQL, (todo_id,))
+        clear_shares(con, "todo", todo_id)
 
     return {"ok": True, "purged": True, "id": todo_id}
 
@@ -209,7 +411,8 @@ def restore_todo(*, p: Principal, todo_id: str) -> dict[str, Any]:
         raise HTTPException(status_code=403, detail="User session required")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
+        unarchive(con, "todos", todo_id)
+        row = con.execute(BY_ID_SQL, (todo_id,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Not found")
         cur = dict(row)
@@ -217,11 +420,9 @@ def restore_todo(*, p: Principal, todo_id: str) -> dict[str, Any]:
             raise HTTPException(status_code=403, detail="Only creator can restore")
 
         t = now()
-        con.execute(
-            "UPDATE todos SET deleted_at=NULL, updated_at=?, version=version+1 WHERE id=?",
-            (t, todo_id),
-        )
-        row2 = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
+        con.execute(RESTORE_SQL, (t, todo_id))
+        touch_todos(con, [todo_id])
+        row2 = con.execute(BY_ID_SQL, (todo_id,)).fetchone()
 
     return _row_to_todo(dict(row2))
 
@@ -272,24 +473,41 @@ def patch_todo(*, p: Principal, todo_id: str, payload: dict) -> dict[str, Any]:
         v = payload.get("shared_with")
         if not isinstance(v, list):
             raise HTTPException(status_code=400, detail="shared_with must be list")
-        fields["shared_with"] = _dumps_list([str(x) for x in v])
+        shared_with = [str(x) for x in v]
+        fields["shared_with"] = _dumps_list(shared_with)
+
+    if "recur" in payload:
+        fields["recur"] = payload.get("recur")
 
     if not fields:
         raise HTTPException(status_code=400, detail="No fields to update")
 
     with tx() as con:
-        row = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
-        if not row:
+        unarchive(con, "todos", todo_id)
+        cur = _get_visible(con, p.user["id"], todo_id)
+        if not cur:
             raise HTTPException(status_code=404, detail="Not found")
-        cur = dict(row)
         if cur.get("deleted_at") is not None:
             raise HTTPException(status_code=409, detail="Todo is in trash")
-        if not _can_see(p.user["id"], cur):
-            raise HTTPException(status_code=404, detail="Not found")
 
         if if_version is not None and int(cur.get("version") or 0) != if_version:
             raise HTTPException(status_code=409, detail="Version conflict")
 
+        # A new reminder time or rule re-anchors the rule; clearing the reminder ends it.
+        if "recur" in fields or ("remind_at" in fields and cur.get("recur")):
+            remind = fields.get("remind_at", cur.get("remind_at"))
+            rule = fields["recur"] if "recur" in fields else (cur.get("recur") if remind is not None else None)
+            fields["recur"] = _recur(rule, remind)
+
+        # Completing a recurring todo reopens it at its next occurrence (after
+        # the current one, even when that is still in the future).
+        if fields.get("done") == 1 and not cur.get("done"):
+            merged = {**cur, **fields}
+            if merged.get("recur") and merged.get("remind_at") is not None:
+                nxt = recurrence.advance(merged, max(now(), int(merged["remind_at"])))
+                if nxt:
+                    fields.update(nxt, done=0)
+
         # If remind_at is changed, clear remind_sent_at so it can notify again.
         if "remind_at" in fields:
             old = cur.get("remind_at")
@@ -317,18 +535,29 @@ def patch_todo(*, p: Principal, todo_id: str, payload: dict) -> dict[str, Any]:
 
         params.append(todo_id)
 
-        con.execute(f"UPDATE todos SET {', '.join(sets)} WHERE id=?", params)
-        row2 = con.execute("SELECT * FROM todos WHERE id=?", (todo_id,)).fetchone()
+        touch_todos(con, [todo_id])
+        con.execute(update_sql(sets), params)
+        if "shared_with" in fields:
+            set_shares(con, "todo", todo_id, shared_with)
+        if "shared_with" in fields or "assigned_to" in fields:
+            touch_todos(con, [todo_id])
+        row2 = con.execute(BY_ID_SQL, (todo_id,)).fetchone()
     return _row_to_todo(dict(row2))
 
 
-def _can_see(user_id: str, todo: dict) -> bool:
-    if todo.get("created_by") == user_id:
-        return True
-    if todo.get("assigned_to") == user_id:
-        return True
-    sw = _loads_list(todo.get("shared_with"))
-    return user_id in sw
+def _get_visible(con: sqlite3.Connection, user_id: str, todo_id: str, table: str = "todos") -> dict | None:
+    return get_visible(con, table, TODO_COLUMNS, VISIBLE_SQL, todo_id, user_id)
+
+
+TODO_FIELDS = (
+    "id", "list_id", "title", "done", "due_at", "remind_at", "remind_sent_at",
+    "assigned_to", "shared_with", "created_by", "created_at", "updated_at", "version", "recur",
+)
+
+
+def _rows_to_todos(cur: sqlite3.Cursor) -> list[dict[str, Any]]:
+    to_dict = row_serializer(cur.description, TODO_FIELDS, bools=("done",), lists=("shared_with",))
+    return [to_dict(r) for r in cur.fetchall()]
 
 
 def _row_to_todo(row: dict) -> dict[str, Any]:
@@ -342,9 +571,10 @@ def _row_to_todo(row: dict) -> dict[str, Any]:
         "remind_at": row.get("remind_at"),
         "remind_sent_at": row.get("remind_sent_at"),
         "assigned_to": row.get("assigned_to"),
-        "shared_with": _loads_list(row.get("shared_with")),
+        "shared_with": shared_list(row.get("shared_with")),
         "created_by": row.get("created_by"),
         "created_at": row.get("created_at"),
         "updated_at": row.get("updated_at"),
         "version": row.get("version"),
+        "recur": row.get("recur"),
     }
@@ -0,0 +1,400 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import time
+import uuid
+from typing import Any, AsyncIterator, Iterator
+
+import orjson
+from fastapi import HTTPException
+
+from . import db
+from . import recurrence
+from .archive import NOTE_COLUMNS, TODO_COLUMNS
+from .auth import Principal, default_containers, user_by_handle, user_by_id, user_directory
+from .lists import default_list_id
+from .notes import default_group_id
+from .serialize import shared_list
+from .settings import settings
+from .shares import set_shares, shared_ids_sql, touch_viewers
+
+# NDJSON export / import of one user's data.
+#
+# An export is one JSON object per line: a "meta" record, then the user's own
+# lists, groups, todos and notes (hot and archive tables), then an "end" record
+# with counts. Rows are read in pages keyed by id, each in its own short read
+# transaction: memory does not grow with the account, and a slow download never
+# holds a WAL snapshot open (which would stop checkpoints and grow the WAL).
+# The export is therefore not a single snapshot; a row edited mid-stream is
+# exported in whichever state its page saw, but still exactly once.
+# Sharing travels as shared_with user ids; meta.users maps them to handles so
+# an import on another instance can resolve them.
+#
+# Import keeps source ids where they are free. Ids already taken by another
+# user's rows get a fresh uuid, recorded in import_ids (migration 6), so
+# re-running the same import skips what is already there instead of
+# duplicating it. The exported Inbox / General map onto the importing user's
+# own defaults.
+
+FORMAT = "notch-export"
+VERSION = 1
+
+MAX_LINE_BYTES = 8 * 1024 * 1024
+
+_EXPORT_BATCH = 500
+
+# kind -> (table, archive table, exported columns)
+_KINDS = {
+    "list": ("todo_lists", None, "id,name,shared_with,created_at,updated_at"),
+    "group": ("note_groups", None, "id,name,shared_with,created_at,updated_at"),
+    "todo": ("todos", "todos_archive", TODO_COLUMNS.replace("created_by,", "")),
+    "note": ("notes", "notes_archive", NOTE_COLUMNS.replace("created_by,", "")),
+}
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def export_queries(kind: str) -> list[str]:
+    """Paged SELECTs for one kind of record (params: user id, last id, limit). Also used by the query plan check."""
+    table, archive_table, cols = _KINDS[kind]
+    return [f"SELECT {cols} FROM {t} WHERE created_by=? AND id>? ORDER BY id LIMIT ?" for t in (table, archive_table) if t]
+
+
+def _line(record: dict[str, Any]) -> bytes:
+    return orjson.dumps(record) + b"\n"
+
+
+def export_ndjson(*, p: Principal) -> Iterator[bytes]:
+    """Yield the user's export as NDJSON chunks."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    uid = p.user["id"]
+    # Make sure Inbox / General exist so meta.defaults is always filled in.
+    defaults = {"inbox_list_id": default_list_id(uid), "general_group_id": default_group_id(uid)}
+    users = {u["id"]: u["handle"] for u in user_directory()["sorted"]}
+    return _export(uid, defaults, users)
+
+
+def _export(uid: str, defaults: dict[str, str], users: dict[str, str]) -> Iterator[bytes]:
+    yield _line(
+        {
+            "type": "meta",
+            "format": FORMAT,
+            "version": VERSION,
+            "exported_at": now(),
+            "user": {"id": uid, "handle": users.get(uid)},
+            "defaults": defaults,
+            "users": users,
+        }
+    )
+    counts: dict[str, int] = {}
+    for kind in _KINDS:
+        counts[kind] = 0
+        for sql in export_queries(kind):
+            after = ""
+            while True:
+                with db.tx() as con:
+                    cur = con.execute(sql, (uid, after, _EXPORT_BATCH))
+                    names = [d[0] for d in cur.description]
+                    rows = cur.fetchall()
+                chunk = []
+                for r in rows:
+                    rec = {"type": kind, **dict(zip(names, r))}
+                    rec["shared_with"] = shared_list(rec.get("shared_with"))
+                    chunk.append(_line(rec))
+                counts[kind] += len(rows)
+                if chunk:
+                    yield b"".join(chunk)
+                if len(rows) < _EXPORT_BATCH:
+                    break
+                after = rows[-1]["id"]
+    yield _line({"type": "end", "counts": counts})
+
+
+def _int(v: Any) -> int | None:
+    if v is None or v == "":
+        return None
+    return int(v)
+
+
+class _Importer:
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.users: dict[str, str] = {}  # source user id -> local user id
+        self.defaults: dict[str, str] = {}  # source default container id -> local id
+        self.ids: dict[str, dict[str, str]] = {"list": {}, "group": {}}  # source -> local, for references
+        self.created = {k: 0 for k in _KINDS}
+        self.skipped = {k: 0 for k in _KINDS}
+        self.errors: list[dict[str, Any]] = []
+        self.error_count = 0
+        self.lines = 0
+        self.ended = False
+
+    def error(self, line: int, msg: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < 20:
+            self.errors.append({"line": line, "error": msg})
+
+    def meta(self, rec: dict[str, Any]) -> None:
+        if rec.get("format") != FORMAT or int(rec.get("version") or 0) > VERSION:
+            raise ValueError("not a notch export (or a newer version)")
+        for src_id, handle in (rec.get("users") or {}).items():
+            u = user_by_handle(str(handle)) if handle else None
+            if u:
+                self.users[str(src_id)] = u["id"]
+        mine = default_containers(self.uid)
+        src = rec.get("defaults") or {}
+        if src.get("inbox_list_id"):
+            self.defaults[str(src["inbox_list_id"])] = mine.get("inbox_list_id") or default_list_id(self.uid)
+        if src.get("general_group_id"):
+            self.defaults[str(src["general_group_id"])] = mine.get("general_group_id") or default_group_id(self.uid)
+
+    def _user(self, src_id: Any) -> str | None:
+        if not src_id:
+            return None
+        src_id = str(src_id)
+        if src_id in self.users:
+            return self.users[src_id]
+        # No meta mapping (hand-written file): accept ids that exist here.
+        return src_id if user_by_id(src_id) else None
+
+    def _shared_with(self, rec: dict[str, Any]) -> list[str]:
+        v = rec.get("shared_with") or []
+        if not isinstance(v, (list, tuple)):
+            raise ValueError("shared_with must be a list")
+        out = []
+        for src in v:
+            u = self._user(src)
+            if u and u != self.uid and u not in out:
+                out.append(u)
+        return out
+
+    def _prefetch(self, con: sqlite3.Connection, batch: list[tuple[int, dict[str, Any]]]) -> None:
+        """Load id mappings and current owners for a batch's ids (a few queries per batch, not per record)."""
+        self._mapped: dict[tuple[str, str], str] = {}
+        self._owners: dict[tuple[str, str], str] = {}
+        self._new_maps: list[tuple[str, str, str, str, int]] = []
+        ids: dict[str, list[str]] = {}
+        for _, rec in batch:
+            if rec.get("type") in _KINDS and rec.get("id"):
+                ids.setdefault(rec["type"], []).append(str(rec["id"]))
+        for kind, src_ids in ids.items():
+            table, archive_table, _ = _KINDS[kind]
+            for i in range(0, len(src_ids), 500):
+                chunk = src_ids[i : i + 500]
+                marks = ",".join("?" for _ in chunk)
+                for r in con.execute(
+                    f"SELECT source_id, local_id FROM import_ids WHERE user_id=? AND kind=? AND source_id IN ({marks})",
+                    [self.uid, kind, *chunk],
+                ):
+                    self._mapped[(kind, r[0])] = r[1]
+                look = chunk + [self._mapped[(kind, s)] for s in chunk if (kind, s) in self._mapped]
+                marks = ",".join("?" for _ in look)
+                for t in (table, archive_table):
+                    if t:
+                        for r in con.execute(f"SELECT id, created_by FROM {t} WHERE id IN ({marks})", look):
+                            self._owners[(kind, r[0])] = r[1]
+
+    def _resolve_id(self, con: sqlite3.Connection, kind: str, src_id: str) -> tuple[str, bool]:
+        """Local id for a source id, and whether that row already exists."""
+        local_id = self._mapped.get((kind, src_id))
+        if local_id and self._owners.get((kind, local_id)) == self.uid:
+            return local_id, True
+        existing = self._owners.get((kind, src_id))
+        if existing == self.uid:
+            return src_id, True
+        local_id = src_id if existing is None else str(uuid.uuid4())
+        if local_id != src_id:
+            self._new_maps.append((self.uid, kind, src_id, local_id, now()))
+            self._mapped[(kind, src_id)] = local_id
+        # A repeat of the same id later in this batch is then skipped.
+        self._owners[(kind, local_id)] = self.uid
+        return local_id, False
+
+    def _container(self, con: sqlite3.Connection, kind: str, src_id: Any) -> str:
+        default = default_list_id(self.uid) if kind == "list" else default_group_id(self.uid)
+        if not src_id:
+            return default
+        src_id = str(src_id)
+        if src_id in self.defaults:
+            return self.defaults[src_id]
+        if src_id in self.ids[kind]:
+            return self.ids[kind][src_id]
+        # Not part of this export, e.g. a list someone else shared: keep it if visible here.
+        table = "todo_lists" if kind == "list" else "note_groups"
+        row = con.execute(
+            f"SELECT 1 FROM {table} WHERE id=? AND (created_by=? OR id IN ({shared_ids_sql(kind)}))",
+            (src_id, self.uid, self.uid),
+        ).fetchone()
+        return src_id if row else default
+
+    def record(self, con: sqlite3.Connection, rec: dict[str, Any]) -> None:
+        kind = rec.get("type")
+        if kind == "end":
+            self.ended = True
+            return
+        if kind not in _KINDS:
+            raise ValueError(f"unknown record type: {kind!r}")
+        src_id = str(rec.get("id") or "")
+        if not src_id:
+            raise ValueError("missing id")
+        if kind in self.ids and src_id in self.defaults:
+            # The exported Inbox / General: merge into ours.
+            self.ids[kind][src_id] = self.defaults[src_id]
+            self.skipped[kind] += 1
+            return
+
+        # Validate everything before the first write, so a bad record leaves nothing behind.
+        text = str(rec.get("name" if kind in ("list", "group") else "title") or "").strip()
+        if not text:
+            raise ValueError("missing name" if kind in ("list", "group") else "missing title")
+        t = now()
+        created_at = _int(rec.get("created_at")) or t
+        updated_at = _int(rec.get("updated_at")) or created_at
+        deleted_at = _int(rec.get("deleted_at"))
+        version = _int(rec.get("version")) or 1
+        if kind == "todo":
+            due_at, remind_at, remind_sent_at = (_int(rec.get(k)) for k in ("due_at", "remind_at", "remind_sent_at"))
+            recur = rec.get("recur")
+            if recur and remind_at is not None:
+                recur = recurrence.anchored(str(recur), remind_at)
+            else:
+                recur = None
+        shared_with = self._shared_with(rec)
+
+        local_id, exists = self._resolve_id(con, kind, src_id)
+        if kind in self.ids:
+            self.ids[kind][src_id] = local_id
+        if exists:
+            self.skipped[kind] += 1
+            return
+
+        sw = orjson.dumps(shared_with).decode()
+        if kind in ("list", "group"):
+            con.execute(
+                f"INSERT INTO {_KINDS[kind][0]}(id,name,created_by,shared_with,created_at,updated_at) VALUES(?,?,?,?,?,?)",
+                (local_id, text, self.uid, sw, created_at, updated_at),
+            )
+        elif kind == "todo":
+            assigned_to = self._user(rec.get("assigned_to"))
+            con.execute(
+                f"INSERT INTO todos({TODO_COLUMNS}) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (
+                    local_id,
+                    self._container(con, "list", rec.get("list_id")),
+                    text,
+                    rec.get("notes"),
+                    1 if rec.get("done") else 0,
+                    due_at,
+                    remind_at,
+                    remind_sent_at,
+                    assigned_to,
+                    sw,
+                    self.uid,
+                    created_at,
+                    updated_at,
+                    deleted_at,
+                    version,
+                    recur,
+                ),
+            )
+        else:
+            con.execute(
+                f"INSERT INTO notes({NOTE_COLUMNS}) VALUES(?,?,?,?,?,?,?,?,?,?)",
+                (
+                    local_id,
+                    self._container(con, "group", rec.get("group_id")),
+                    text,
+                    str(rec.get("body_md") or ""),
+                    sw,
+                    self.uid,
+                    created_at,
+                    updated_at,
+                    deleted_at,
+                    version,
+                ),
+            )
+        if shared_with:
+            set_shares(con, kind, local_id, shared_with)
+        if kind == "todo":
+            touch_viewers(con, [self.uid, assigned_to, *shared_with])
+        self.created[kind] += 1
+
+    def apply(self, batch: list[tuple[int, dict[str, Any]]]) -> None:
+        """Apply one batch of records in a single transaction."""
+        with db.tx() as con:
+            self._prefetch(con, batch)
+            for lineno, rec in batch:
+                try:
+                    self.record(con, rec)
+                except (ValueError, TypeError) as e:
+                    self.error(lineno, str(e))
+            if self._new_maps:
+                con.executemany(
+                    "INSERT OR REPLACE INTO import_ids(user_id,kind,source_id,local_id,created_at) VALUES(?,?,?,?,?)",
+                    self._new_maps,
+                )
+
+    def result(self) -> dict[str, Any]:
+        return {
+            "lines": self.lines,
+            "created": self.created,
+            "skipped": self.skipped,
+            "errors": sorted(self.errors, key=lambda e: e["line"]),
+            "error_count": self.error_count,
+            "complete": self.ended,
+        }
+
+
+async def import_ndjson(*, p: Principal, chunks: AsyncIterator[bytes]) -> dict[str, Any]:
+    """Import an NDJSON export from a streamed body, IMPORT_BATCH_SIZE records per transaction."""
+    if p.kind != "user":
+        raise HTTPException(status_code=403, detail="User session required")
+    imp = _Importer(p.user["id"])
+    batch_size = max(1, int(settings.IMPORT_BATCH_SIZE))
+    batch: list[tuple[int, dict[str, Any]]] = []
+    buf = b""
+
+    async def flush() -> None:
+        if batch:
+            await asyncio.to_thread(imp.apply, list(batch))
+            batch.clear()
+
+    async def handle(line: bytes) -> None:
+        imp.lines += 1
+        if not line.strip():
+            return
+        try:
+            rec = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            imp.error(imp.lines, f"invalid JSON: {e}")
+            return
+        if not isinstance(rec, dict):
+            imp.error(imp.lines, "record must be an object")
+            return
+        if rec.get("type") == "meta":
+            # References in later records depend on it; apply before anything else.
+            await flush()
+            try:
+                imp.meta(rec)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return
+        batch.append((imp.lines, rec))
+        if len(batch) >= batch_size:
+            await flush()
+
+    async for chunk in chunks:
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        if len(buf) > MAX_LINE_BYTES:
+            raise HTTPException(status_code=413, detail="Line too long")
+        for line in lines:
+            await handle(line)
+    if buf:
+        await handle(buf)
+    await flush()
+    return imp.result()
@@ -15,6 +15,8 @@ export type Todo = {
   created_at: number;
   updated_at: number;
   version: number;
+  // Recurrence rule anchored at the first reminder ("DTSTART...\nRRULE:FREQ=WEEKLY").
+  recur?: string | null;
 };
 
 const TOKEN_KEY = 'notch_token';
@@ -28,11 +30,44 @@ export function setToken(t: string | null) {
   else localStorage.setItem(TOKEN_KEY, t);
 }
 
+function idempotencyKey(): string {
+  // crypto.randomUUID needs a secure context; plain-http LAN installs don't have one.
+  if (typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function' && window.isSecureContext) {
+    return crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+const RETRY_DELAYS_MS = [500, 1500, 4000];
+
+// POST/PATCH send an Idempotency-Key and are retried with the same key on network
+// errors and on responses carrying Retry-After, so a retry never creates a duplicate.
+export async function fetchWithRetry(path: string, opts: RequestInit & { headers: Record<string, string> }): Promise<Response> {
+  const method = (opts.method || 'GET').toUpperCase();
+  if (method !== 'POST' && method !== 'PATCH') return fetch(path, opts);
+  const init = { ...opts, headers: { 'Idempotency-Key': idempotencyKey(), ...opts.headers } };
+  for (let attempt = 0; ; attempt++) {
+    const last = attempt >= RETRY_DELAYS_MS.length;
+    let res: Response;
+    try {
+      res = await fetch(path, init);
+    } catch (e) {
+      if (last) throw e;
+      await new Promise((r) => setTimeout(r, RETRY_DELAYS_MS[attempt]));
+      continue;
+    }
+    const retryAfter = Number(res.headers.get('Retry-After')) || 0;
+    const retryable = [502, 503, 504].includes(res.status) || (res.status === 409 && retryAfter > 0);
+    if (last || !retryable) return res;
+    await new Promise((r) => setTimeout(r, Math.max(RETRY_DELAYS_MS[attempt], retryAfter * 1000)));
+  }
+}
+
 async function req(path: string, opts: RequestInit = {}) {
   const token = getToken();
   const headers: any = { 'Content-Type': 'application/json', ...(opts.headers || {}) };
   if (token) headers['Authorization'] = `Bearer ${token}`;
-  const res = await fetch(path, { ...opts, headers });
+  const res = await fetchWithRetry(path, { ...opts, headers });
   const text = await res.text();
   let json: any = null;
   try { json = text ? JSON.parse(text) : null; } catch { /* ignore */ }
@@ -68,6 +103,51 @@ export async function adminCreateUser(handle: string, password: string, display_
 
 export type TodoList = { id: string; name: string; created_by: string; shared_with: string[]; created_at: number; updated_at: number };
 
+export type NotificationPrefs = { daily_digest_hour: number | null; coalesce_seconds: number };
+
+export async function getNotificationPrefs(): Promise<NotificationPrefs> {
+  const j = await req('/api/me/notifications');
+  return j.notifications;
+}
+
+export async function setDailyDigestHour(hour: number | null): Promise<NotificationPrefs> {
+  const j = await req('/api/me/notifications', { method: 'PATCH', body: JSON.stringify({ daily_digest_hour: hour }) });
+  return j.notifications;
+}
+
+export type AgendaEntry = { at: number; kind: 'due' | 'remind'; todo: Todo };
+export type AgendaDay = { date: string; count: number; due: number; remind: number; items: AgendaEntry[] };
+export type Agenda = { tz: string; start: number; end: number; count: number; truncated: boolean; overdue: AgendaEntry[]; days: AgendaDay[] };
+
+export async function getAgenda(days = 7, start?: string): Promise<Agenda> {
+  const q = new URLSearchParams({ days: String(days) });
+  if (start) q.set('start', start);
+  return await req(`/api/agenda?${q.toString()}`);
+}
+
+export async function getUpcoming(hours = 24, limit = 50): Promise<AgendaEntry[]> {
+  const j = await req(`/api/agenda/upcoming?hours=${hours}&limit=${limit}`);
+  return j.items;
+}
+
+export async function getCalendarUrl(create = false): Promise<string | null> {
+  const j = await req('/api/me/calendar', create ? { method: 'POST' } : {});
+  return j.url;
+}
+
+export type TodoCounts = { open: number; done: number; trash: number };
+export type NoteCounts = { live: number; trash: number };
+export type Counts = {
+  lists: Record<string, TodoCounts>;
+  groups: Record<string, NoteCounts>;
+  todos: TodoCounts;
+  notes: NoteCounts;
+};
+
+export async function getCounts(): Promise<Counts> {
+  return await req('/api/counts');
+}
+
 export async function listLists(): Promise<TodoList[]> {
   const j = await req('/api/lists');
   return j.lists;
@@ -88,10 +168,11 @@ export async function deleteList(id: string): Promise<{ ok: boolean; deleted: bo
   return j;
 }
 
-export async function listTodos(includeDone = false, listId?: string | null, opts: { deleted_only?: boolean } = {}): Promise<Todo[]> {
+export async function listTodos(includeDone = false, listId?: string | null, opts: { deleted_only?: boolean; digest?: string | null } = {}): Promise<Todo[]> {
   const qs = new URLSearchParams();
   qs.set('include_done', includeDone ? '1' : '0');
   if (listId) qs.set('list_id', listId);
+  if (opts.digest) qs.set('digest', opts.digest);
   if (opts.deleted_only) {
     qs.set('include_deleted', '1');
     qs.set('deleted_only', '1');
@@ -107,6 +188,15 @@ export async function createTodo(title: string, listId?: string | null): Promise
   return j.todo;
 }
 
+// Many todos in one request: a pasted checklist (one per line, with optional
+// due:/remind: hints) or explicit create payloads.
+export async function createTodos(input: { text: string } | { todos: any[] }, listId?: string | null): Promise<Todo[]> {
+  const body: any = { ...input };
+  if (listId) body.list_id = listId;
+  const j = await req('/api/todos/bulk', { method: 'POST', body: JSON.stringify(body) });
+  return j.todos;
+}
+
 export async function patchTodo(id: string, patch: any): Promise<Todo> {
   const j = await req(`/api/todos/${encodeURIComponent(id)}`, { method: 'PATCH', body: JSON.stringify(patch) });
   return j.todo;
@@ -1,4 +1,4 @@
-import { getToken } from './api';
+import { fetchWithRetry, getToken } from './api';
 
 export type NoteGroup = {
   id: string;
@@ -25,7 +25,7 @@ async function req(path: string, opts: RequestInit = {}) {
   const token = getToken();
   const headers: any = { 'Content-Type': 'application/json', ...(opts.headers || {}) };
   if (token) headers['Authorization'] = `Bearer ${token}`;
-  const res = await fetch(path, { ...opts, headers });
+  const res = await fetchWithRetry(path, { ...opts, headers });
   const text = await res.text();
 
   let json: any = null;